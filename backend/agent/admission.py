@@ -0,0 +1,330 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
+from agent.metrics import ADMISSION_DECISIONS, ADMISSION_WAIT, observe
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed by admission control."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Request-rate limiter refilled at ``rate`` tokens per second up to ``burst``.
+
+    Tokens can be reserved ahead of time: the balance goes negative and the
+    caller is told how long to wait for its turn.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, max_wait: float) -> Tuple[bool, float]:
+        """Reserve one token if it becomes available within ``max_wait`` seconds.
+
+        Returns:
+            Whether the token was reserved, and the wait until it is usable.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self._paused_until - now)
+            if self._tokens < 1:
+                wait = max(wait, (1 - self._tokens) / self.rate)
+            if wait > max_wait:
+                return False, wait
+            self._tokens -= 1
+            return True, wait
+
+    def refund(self) -> None:
+        """Return a reserved token whose request was shed before it ran."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.burst, self._tokens + 1)
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for ``seconds``, e.g. after the API reported overload."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+
+class Ticket:
+    """An admitted request; call ``release`` (or leave the ``with`` block) when it is done."""
+
+    __slots__ = ("_controller", "thread_id", "client_id", "_released")
+
+    def __init__(self, controller: "AdmissionController", thread_id: str, client_id: Optional[str]):
+        self._controller = controller
+        self.thread_id = thread_id
+        self.client_id = client_id
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._controller._release(self.thread_id, self.client_id)
+
+    def __enter__(self) -> "Ticket":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.release()
+
+    async def __aenter__(self) -> "Ticket":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        self.release()
+
+    def __del__(self):
+        # Safety net for streams whose response is dropped before it starts
+        self.release()
+
+
+class AdmissionController:
+    """Admission control in front of the agent.
+
+    A request is admitted when its thread and client are under their
+    concurrency caps, the rate bucket has a token for it and a global
+    execution slot frees up. Requests that cannot be admitted within
+    ``queue_timeout`` seconds, or that find the wait queue full, are shed
+    at once with ``Overloaded`` so they never hold a worker.
+    """
+
+    def __init__(
+        self,
+        rate: float = 50 / 60,
+        burst: int = 10,
+        max_concurrency: int = 16,
+        per_thread: int = 2,
+        per_client: int = 4,
+        queue_size: int = 32,
+        queue_timeout: float = 5.0,
+        retry_after: float = 2.0,
+    ):
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.max_concurrency = max_concurrency
+        self.per_thread = per_thread
+        self.per_client = per_client
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._threads: Counter = Counter()
+        self._clients: Counter = Counter()
+
+    def acquire(self, thread_id: str, client_id: Optional[str] = None) -> Ticket:
+        """Wait for admission, blocking for at most ``queue_timeout`` seconds.
+
+        Raises:
+            Overloaded: If the request was shed.
+        """
+        start = time.monotonic()
+        try:
+            ticket = self._acquire(thread_id, client_id, start + self.queue_timeout)
+        except Overloaded:
+            ADMISSION_DECISIONS.labels("shed").inc()
+            raise
+        self._admitted(start)
+        return ticket
+
+    async def aacquire(self, thread_id: str, client_id: Optional[str] = None) -> Ticket:
+        """Async variant of ``acquire``; waits yield to the event loop."""
+        start = time.monotonic()
+        try:
+            ticket = await self._aacquire(thread_id, client_id, start + self.queue_timeout)
+        except Overloaded:
+            ADMISSION_DECISIONS.labels("shed").inc()
+            raise
+        self._admitted(start)
+        return ticket
+
+    def _admitted(self, start: float) -> None:
+        ADMISSION_DECISIONS.labels("admitted").inc()
+        observe(ADMISSION_WAIT, time.monotonic() - start)
+
+    def _acquire(self, thread_id: str, client_id: Optional[str], deadline: float) -> Ticket:
+        self._enter(thread_id, client_id)
+        reserved = False
+        try:
+            delay = self._reserve(deadline)
+            reserved = self.bucket is not None
+            if delay:
+                time.sleep(delay)
+            with self._cond:
+                while self._active >= self.max_concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise self._at_capacity()
+                    self._cond.wait(remaining)
+                self._admit()
+        except BaseException:
+            self._abandon(thread_id, client_id, reserved)
+            raise
+        return Ticket(self, thread_id, client_id)
+
+    async def _aacquire(self, thread_id: str, client_id: Optional[str], deadline: float) -> Ticket:
+        self._enter(thread_id, client_id)
+        reserved = False
+        try:
+            delay = self._reserve(deadline)
+            reserved = self.bucket is not None
+            if delay:
+                await asyncio.sleep(delay)
+            backoff = 0.005
+            while True:
+                with self._cond:
+                    if self._active < self.max_concurrency:
+                        self._admit()
+                        break
+                if time.monotonic() >= deadline:
+                    raise self._at_capacity()
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 0.05)
+        except BaseException:
+            self._abandon(thread_id, client_id, reserved)
+            raise
+        return Ticket(self, thread_id, client_id)
+
+    @contextmanager
+    def admit(self, thread_id: str, client_id: Optional[str] = None) -> Iterator[Ticket]:
+        """Context manager around ``acquire`` and ``Ticket.release``."""
+        with self.acquire(thread_id, client_id) as ticket:
+            yield ticket
+
+    @asynccontextmanager
+    async def aadmit(self, thread_id: str, client_id: Optional[str] = None) -> AsyncIterator[Ticket]:
+        """Async context manager around ``aacquire`` and ``Ticket.release``."""
+        with await self.aacquire(thread_id, client_id) as ticket:
+            yield ticket
+
+    def pause(self, seconds: float) -> None:
+        """Hold back new model calls for ``seconds`` after the API reported overload."""
+        if self.bucket is not None:
+            self.bucket.pause(seconds)
+            logger.warning(f"Admission paused for {seconds:.1f}s after upstream overload")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return current admission counters."""
+        with self._cond:
+            snapshot = {"active": self._active, "waiting": self._waiting}
+        snapshot["tokens"] = round(self.bucket.tokens, 2) if self.bucket is not None else None
+        return snapshot
+
+    def _enter(self, thread_id: str, client_id: Optional[str]) -> None:
+        with self._cond:
+            if self.per_thread and self._threads[thread_id] >= self.per_thread:
+                raise Overloaded("Too many concurrent requests for this thread", self.retry_after)
+            if client_id and self.per_client and self._clients[client_id] >= self.per_client:
+                raise Overloaded("Too many concurrent requests from this client", self.retry_after)
+            if self._active >= self.max_concurrency and self._waiting >= self.queue_size:
+                raise self._at_capacity()
+            self._threads[thread_id] += 1
+            if client_id:
+                self._clients[client_id] += 1
+            self._waiting += 1
+
+    def _reserve(self, deadline: float) -> float:
+        if self.bucket is None:
+            return 0.0
+        reserved, wait = self.bucket.reserve(deadline - time.monotonic())
+        if not reserved:
+            raise Overloaded("Rate limit reached", wait)
+        return wait
+
+    def _admit(self) -> None:
+        self._waiting -= 1
+        self._active += 1
+
+    def _at_capacity(self) -> Overloaded:
+        return Overloaded("Server is at capacity", self.retry_after)
+
+    def _abandon(self, thread_id: str, client_id: Optional[str], reserved: bool = False) -> None:
+        with self._cond:
+            self._waiting -= 1
+            self._forget(thread_id, client_id)
+        if reserved:
+            # The request never ran, so it should not count against the rate
+            self.bucket.refund()
+
+    def _release(self, thread_id: str, client_id: Optional[str]) -> None:
+        with self._cond:
+            self._active -= 1
+            self._forget(thread_id, client_id)
+            self._cond.notify()
+
+    def _forget(self, thread_id: str, client_id: Optional[str]) -> None:
+        self._threads[thread_id] -= 1
+        if self._threads[thread_id] <= 0:
+            del self._threads[thread_id]
+        if client_id:
+            self._clients[client_id] -= 1
+            if self._clients[client_id] <= 0:
+                del self._clients[client_id]
+
+
+def retry_after_header(seconds: float) -> str:
+    """Format a ``Retry-After`` value in whole seconds, at least 1."""
+    return str(max(1, math.ceil(seconds)))
+
+
+_admission: Optional[AdmissionController] = None
+_admission_lock = threading.Lock()
+
+
+def get_admission() -> AdmissionController:
+    """Return the admission controller for this process, creating it on first use.
+
+    Limits are per worker process; size ``AGENT_RATE_LIMIT_RPM`` to the
+    account's Anthropic limit divided by the number of workers.
+    """
+    global _admission
+    if _admission is None:
+        with _admission_lock:
+            if _admission is None:
+                _admission = AdmissionController(
+                    rate=float(os.getenv("AGENT_RATE_LIMIT_RPM", "50")) / 60,
+                    burst=int(os.getenv("AGENT_RATE_LIMIT_BURST", "10")),
+                    max_concurrency=int(os.getenv("AGENT_MAX_CONCURRENCY", "16")),
+                    per_thread=int(os.getenv("AGENT_MAX_PER_THREAD", "2")),
+                    per_client=int(os.getenv("AGENT_MAX_PER_CLIENT", "4")),
+                    queue_size=int(os.getenv("AGENT_ADMISSION_QUEUE_SIZE", "32")),
+                    queue_timeout=float(os.getenv("AGENT_ADMISSION_QUEUE_TIMEOUT", "5")),
+                )
+    return _admission
+
+
+def _reset_after_fork() -> None:
+    global _admission
+    _admission = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,79 +1,406 @@
-from typing import List, Dict, Any
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from langchain_core.runnables import RunnableConfig
-from langchain.chat_models import init_chat_model
+from typing import TYPE_CHECKING, Callable, List, Dict, Any, AsyncIterator, Iterator, Optional, Tuple, Union
 import os
+import threading
 from dotenv import load_dotenv
-import json
-from agent.character import AGENT_CHARACTER_PROMPT
+import logging
+from asgiref.sync import sync_to_async
 from agent.mcp import ModelContextProtocol
+from agent.message import Message, Role
+from agent.metrics import CONTEXT, CONVERT, MODEL, RESPONSE_CACHE_LOOKUPS, record_usage, span
+from agent.pool import get_model
+from agent.response_cache import get_response_cache
+from agent.store import get_store
+from agent.summarizer import get_summarizer
+from agent.tool_executor import get_tool_executor, tools_enabled
+
+if TYPE_CHECKING:
+    # LangChain is imported on first use so worker boot and management commands stay fast
+    from langchain_core.messages import BaseMessage
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
 class Agent:
     def __init__(self):
-        # Get API key from environment
-        api_key = os.getenv("ANTHROPIC_API_KEY")
-        if not api_key:
-            raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
-        
-        # Initialize the LLM
-        self.model = init_chat_model(
-            "anthropic:claude-3-7-sonnet-latest",
-            temperature=0.7,  # Increased for more creative responses
-            anthropic_api_key=api_key
-        )
-        
-        # Initialize MCP with system prompt
-        self.mcp = ModelContextProtocol(
-            system_prompt=AGENT_CHARACTER_PROMPT
-        )
-
-    def invoke(self, messages: List[Dict[str, str]], thread_id: str = "default") -> Dict[str, Any]:
+        # LLM clients come from the per-worker pool, one per model call; building
+        # them now raises early if ANTHROPIC_API_KEY is missing
+        get_model()
+        
+        # Per-thread MCP state lives in the process-wide conversation store
+        self.store = get_store()
+        self.summarizer = get_summarizer()
+        
+        # Mark the stable context prefix as cacheable (Anthropic prompt caching)
+        self.prompt_cache = os.getenv("AGENT_PROMPT_CACHE", "true").lower() == "true"
+        
+        # Opt-in cache of complete replies for repeated opening prompts
+        self.response_cache = get_response_cache()
+        
+        # Optional tools: bound to each pooled client and run in parallel between model calls
+        self.tools = get_tool_executor() if tools_enabled() else None
+        self.max_tool_rounds = int(os.getenv("AGENT_TOOL_MAX_ROUNDS", "3"))
+        
+        # The turn runs as a LangGraph graph (LangGraph loads on first use)
+        from agent.graph import get_graph
+        
+        self.graph = get_graph()
+        self.agraph = get_graph(asynchronous=True)
+
+    def invoke(self, messages: List[Dict[str, str]], thread_id: str = "default", turn_cursor: Optional[int] = None, language: Optional[str] = None) -> Dict[str, Any]:
         """Invoke the agent with a list of messages.
         
+        Only turns the thread has not ingested yet are processed, so clients
+        may keep sending their full history or just the new messages.
+        
         Args:
             messages: List of message dictionaries with 'role' and 'content' keys.
             thread_id: Unique identifier for the conversation thread.
+            turn_cursor: Index of ``messages[0]`` in the conversation. When omitted,
+                ``messages`` is treated as the full client history.
+            language: Optional client language hint, part of the response cache key.
             
         Returns:
-            The agent's response.
+            The agent's response and the thread's new turn cursor.
         """
-        print("Received messages:", json.dumps(messages, indent=2))
-        print(f"Thread ID: {thread_id}")
+        logger.debug(f"Invoking agent for thread {thread_id} with {len(messages)} message(s)")
+        
+        with self.store.session(thread_id) as mcp:
+            state = self.graph.invoke(
+                _turn_input(messages, turn_cursor, language),
+                self._graph_config(thread_id),
+                context=self._turn_context(mcp),
+            )
+        
+        # Only return the new assistant message
+        return {"content": state["reply"], "turn_cursor": state["cursor"]}
+
+    def stream(self, messages: List[Dict[str, str]], thread_id: str = "default", turn_cursor: Optional[int] = None, language: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Stream the agent's response token by token.
         
-        # Update MCP thread ID
-        self.mcp.thread_id = thread_id
+        The thread stays checked out until the stream finishes; the assembled
+        reply is committed to the thread's context only if it completes.
         
-        # Process each message through MCP
-        for msg in messages:
-            print(f"Processing message - Role: {msg['role']}, Content: {msg['content']}")
-            # Get full context from MCP
-            context = self.mcp.process_message(msg)
+        Args:
+            messages: List of message dictionaries with 'role' and 'content' keys.
+            thread_id: Unique identifier for the conversation thread.
+            turn_cursor: Index of ``messages[0]`` in the conversation.
+            language: Optional client language hint, part of the response cache key.
             
-            # Convert context to LangChain format
-            langchain_messages = []
-            for ctx_msg in context:
-                if ctx_msg["role"] == "system":
-                    langchain_messages.append(SystemMessage(content=ctx_msg["content"]))
-                elif ctx_msg["role"] == "user":
-                    langchain_messages.append(HumanMessage(content=ctx_msg["content"]))
-                elif ctx_msg["role"] == "assistant":
-                    langchain_messages.append(AIMessage(content=ctx_msg["content"]))
-        
-        print("Converted messages to LangChain format:", langchain_messages)
-        
-        # Get response from the model
-        response = self.model.invoke(langchain_messages)
-        print("Model response:", response)
-        print("Response content:", response.content)
-        
-        # Add assistant's response to context
-        assistant_msg = {"role": "assistant", "content": response.content}
-        self.mcp.process_message(assistant_msg)
+        Yields:
+            ``{"type": "token", "content": ...}`` events followed by one
+            ``{"type": "done", "content": ..., "turn_cursor": ...}`` event.
+            A ``{"type": "reset"}`` event means the tokens so far led up
+            to tool calls and are not part of the reply; the reply starts
+            over with the next token.
+        """
+        with self.store.session(thread_id) as mcp:
+            state = None
+            context = self._turn_context(mcp, stream=True)
+            events = self.graph.stream(
+                _turn_input(messages, turn_cursor, language),
+                self._graph_config(thread_id),
+                context=context,
+                stream_mode=["custom", "values"],
+            )
+            try:
+                for mode, chunk in events:
+                    if mode == "custom":
+                        yield dict(chunk)
+                    else:
+                        state = chunk
+            finally:
+                # If the client went away, stop the model instead of waiting for its reply
+                context.closed = True
+                events.close()
         
-        # Only return the new assistant message
-        result = {"content": response.content}
-        print("Final response:", json.dumps(result, indent=2))
-        return result 
\ No newline at end of file
+        yield {"type": "done", "content": state["reply"], "turn_cursor": state["cursor"]}
+
+    async def ainvoke(self, messages: List[Dict[str, str]], thread_id: str = "default", turn_cursor: Optional[int] = None, language: Optional[str] = None) -> Dict[str, Any]:
+        """Async variant of ``invoke`` built on the model's async API."""
+        async with self.store.asession(thread_id) as mcp:
+            state = await self.agraph.ainvoke(
+                _turn_input(messages, turn_cursor, language),
+                self._graph_config(thread_id),
+                context=self._turn_context(mcp),
+            )
+        
+        return {"content": state["reply"], "turn_cursor": state["cursor"]}
+
+    async def astream(self, messages: List[Dict[str, str]], thread_id: str = "default", turn_cursor: Optional[int] = None, language: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Async variant of ``stream`` built on ``model.astream``."""
+        async with self.store.asession(thread_id) as mcp:
+            state = None
+            context = self._turn_context(mcp, stream=True)
+            events = self.agraph.astream(
+                _turn_input(messages, turn_cursor, language),
+                self._graph_config(thread_id),
+                context=context,
+                stream_mode=["custom", "values"],
+            )
+            try:
+                async for mode, chunk in events:
+                    if mode == "custom":
+                        yield dict(chunk)
+                    else:
+                        state = chunk
+            finally:
+                context.closed = True
+                await events.aclose()
+        
+        yield {"type": "done", "content": state["reply"], "turn_cursor": state["cursor"]}
+
+    def _turn_context(self, mcp: ModelContextProtocol, stream: bool = False) -> Any:
+        from agent.graph import TurnContext
+
+        return TurnContext(self, mcp, stream)
+
+    def _graph_config(self, thread_id: str) -> Dict[str, Any]:
+        # prepare, commit and two steps per tool round
+        return {"configurable": {"thread_id": thread_id}, "recursion_limit": 2 * self.max_tool_rounds + 4}
+
+    def _more_tools(self, round_: int, response: Any) -> bool:
+        """Whether the model asked for tools and may still get their results."""
+        if self.tools is None or not getattr(response, "tool_calls", None):
+            return False
+        if round_ >= self.max_tool_rounds:
+            logger.warning(f"Model still requested tools after {self.max_tool_rounds} round(s); returning its text")
+            return False
+        return True
+
+    def _chat_model(self) -> Any:
+        """Return the next pooled client, with the tools bound if enabled."""
+        model = get_model()
+        return self.tools.bind(model) if self.tools is not None else model
+
+    def _call_model(self, messages: List["BaseMessage"]) -> Tuple[str, "BaseMessage"]:
+        """Call the model once and return its reply text and response."""
+        with span(MODEL):
+            response = self._chat_model().invoke(messages)
+        record_usage(response.usage_metadata)
+        return _content_text(response.content), response
+
+    async def _acall_model(self, messages: List["BaseMessage"]) -> Tuple[str, "BaseMessage"]:
+        """Async variant of ``_call_model``."""
+        with span(MODEL):
+            response = await self._chat_model().ainvoke(messages)
+        record_usage(response.usage_metadata)
+        return _content_text(response.content), response
+
+    def _stream_model(self, messages: List["BaseMessage"], emit: Callable[[str], None]) -> Tuple[str, Optional["BaseMessage"]]:
+        """Stream one model call, passing each piece of text to ``emit``.
+        
+        Returns:
+            The reply text and, when tools are enabled, the merged response
+            carrying its tool calls (None otherwise).
+        """
+        from langchain_core.messages.ai import add_usage
+
+        usage = None
+        response = None
+        parts = []
+        with span(MODEL):
+            for chunk in self._chat_model().stream(messages):
+                if chunk.usage_metadata:
+                    usage = add_usage(usage, chunk.usage_metadata)
+                if self.tools is not None:
+                    # Tool calls arrive in pieces; only merge chunks when they can occur
+                    response = chunk if response is None else response + chunk
+                text = _content_text(chunk.content)
+                if text:
+                    parts.append(text)
+                    emit(text)
+        record_usage(usage)
+        return "".join(parts), response
+
+    async def _astream_model(self, messages: List["BaseMessage"], emit: Callable[[str], None]) -> Tuple[str, Optional["BaseMessage"]]:
+        """Async variant of ``_stream_model``."""
+        from langchain_core.messages.ai import add_usage
+
+        usage = None
+        response = None
+        parts = []
+        with span(MODEL):
+            async for chunk in self._chat_model().astream(messages):
+                if chunk.usage_metadata:
+                    usage = add_usage(usage, chunk.usage_metadata)
+                if self.tools is not None:
+                    response = chunk if response is None else response + chunk
+                text = _content_text(chunk.content)
+                if text:
+                    parts.append(text)
+                    emit(text)
+        record_usage(usage)
+        return "".join(parts), response
+
+    def _prepare(self, mcp: ModelContextProtocol, messages: List[Dict[str, str]], turn_cursor: Optional[int], language: Optional[str] = None) -> Tuple[Optional[List["BaseMessage"]], Optional[str], Optional[str]]:
+        """Ingest the new turns and prepare the model call.
+        
+        Returns:
+            The LangChain messages for the model, the response cache key (None
+            if the turn is not cacheable) and the cached reply on a cache hit,
+            in which case no messages are built.
+        """
+        new_messages = self._ingest(mcp, messages, turn_cursor)
+        cache_key = self._cache_key(mcp, language)
+        cached = self._cached_reply(mcp, cache_key) if cache_key else None
+        if cached is not None:
+            return None, None, cached
+        return self._build_prompt(mcp, new_messages), cache_key, None
+
+    async def _aprepare(self, mcp: ModelContextProtocol, messages: List[Dict[str, str]], turn_cursor: Optional[int], language: Optional[str] = None) -> Tuple[Optional[List["BaseMessage"]], Optional[str], Optional[str]]:
+        """Async variant of ``_prepare``; the response cache lookup runs off the event loop."""
+        new_messages = self._ingest(mcp, messages, turn_cursor)
+        cache_key = self._cache_key(mcp, language)
+        cached = await sync_to_async(self._cached_reply, thread_sensitive=False)(mcp, cache_key) if cache_key else None
+        if cached is not None:
+            return None, None, cached
+        return self._build_prompt(mcp, new_messages), cache_key, None
+
+    def _ingest(self, mcp: ModelContextProtocol, messages: List[Dict[str, str]], turn_cursor: Optional[int]) -> List[Dict[str, str]]:
+        """Ingest the turns this thread has not seen yet and return them."""
+        with span(CONTEXT):
+            new_messages = self._new_turns(mcp, messages, turn_cursor)
+            for msg in new_messages:
+                mcp.ingest_message(msg)
+        return new_messages
+
+    def _cache_key(self, mcp: ModelContextProtocol, language: Optional[str]) -> Optional[str]:
+        if self.response_cache is None:
+            return None
+        return self.response_cache.key_for(mcp.context_window.messages, language)
+
+    def _cached_reply(self, mcp: ModelContextProtocol, cache_key: str) -> Optional[str]:
+        cached = self.response_cache.get(cache_key)
+        RESPONSE_CACHE_LOOKUPS.labels("miss" if cached is None else "hit").inc()
+        if cached is not None:
+            logger.info(f"Response cache hit for thread {mcp.thread_id}")
+        return cached
+
+    def _build_prompt(self, mcp: ModelContextProtocol, new_messages: List[Dict[str, str]]) -> List["BaseMessage"]:
+        # Build the full context once and convert it to LangChain format
+        with span(CONTEXT):
+            context = mcp.build_context(new_messages[-1]["content"])
+        with span(CONVERT):
+            return self._to_langchain(context)
+
+    def _commit(self, mcp: ModelContextProtocol, content: str, cache_key: Optional[str] = None) -> int:
+        """Add the assistant's response to context and return the new turn cursor."""
+        cursor = self._record_reply(mcp, content)
+        if cache_key:
+            self.response_cache.set(cache_key, content)
+        return cursor
+
+    async def _acommit(self, mcp: ModelContextProtocol, content: str, cache_key: Optional[str] = None) -> int:
+        """Async variant of ``_commit``; the response cache write runs off the event loop."""
+        cursor = self._record_reply(mcp, content)
+        if cache_key:
+            await sync_to_async(self.response_cache.set, thread_sensitive=False)(cache_key, content)
+        return cursor
+
+    def _record_reply(self, mcp: ModelContextProtocol, content: str) -> int:
+        mcp.ingest_message(Message(Role.ASSISTANT, content))
+        # Fold evicted turns into the thread's summary off the request path
+        self.summarizer.maybe_schedule(mcp.thread_id, mcp.context_window)
+        return mcp.turn_cursor
+
+    @staticmethod
+    def _new_turns(mcp: ModelContextProtocol, messages: List[Dict[str, str]], turn_cursor: Optional[int]) -> List[Dict[str, str]]:
+        """Return the messages the thread has not ingested yet."""
+        start = turn_cursor if turn_cursor is not None else 0
+        new_messages = messages[max(mcp.turn_cursor - start, 0):]
+        if not new_messages:
+            # The client restarted its history on a known thread: treat the last message as new
+            new_messages = messages[-1:]
+        return new_messages
+
+    def _to_langchain(self, context: List[Message]) -> List["BaseMessage"]:
+        """Convert MCP context messages to LangChain message objects.
+        
+        Leading system messages become the blocks of one system message.
+        System messages that follow the conversation (per-turn state and
+        facts) are attached to the next user message, so the system prompt
+        and earlier turns form a stable, cacheable prefix. With prompt caching
+        on, the system prompt and the last earlier turn are marked as cache
+        breakpoints. Other turns reuse the message's cached LangChain object.
+        """
+        from langchain_core.messages import HumanMessage, SystemMessage
+
+        system_blocks = []
+        pending = []
+        langchain_messages = []
+        for ctx_msg in context:
+            if ctx_msg.role is Role.SYSTEM:
+                (pending if langchain_messages else system_blocks).append(ctx_msg.content)
+            elif ctx_msg.role is Role.USER and pending:
+                blocks = [{"type": "text", "text": text} for text in pending + [ctx_msg.content]]
+                langchain_messages.append(HumanMessage(content=blocks))
+                pending = []
+            else:
+                langchain_messages.append(ctx_msg.to_langchain())
+        system_blocks.extend(pending)
+        
+        if not self.prompt_cache:
+            system = [SystemMessage(content="\n\n".join(system_blocks))] if system_blocks else []
+            return system + langchain_messages
+        
+        system = []
+        if system_blocks:
+            blocks = [{"type": "text", "text": text} for text in system_blocks]
+            blocks[0]["cache_control"] = {"type": "ephemeral"}
+            system.append(SystemMessage(content=blocks))
+        if len(langchain_messages) > 1:
+            langchain_messages[-2] = _with_cache_breakpoint(langchain_messages[-2])
+        return system + langchain_messages
+
+
+def _turn_input(messages: List[Dict[str, str]], turn_cursor: Optional[int], language: Optional[str]) -> Dict[str, Any]:
+    return {"messages": messages, "turn_cursor": turn_cursor, "language": language}
+
+
+def _with_cache_breakpoint(message: "BaseMessage") -> "BaseMessage":
+    """Return a copy of ``message`` whose last content block is a cache breakpoint."""
+    if isinstance(message.content, str):
+        blocks = [{"type": "text", "text": message.content}]
+    else:
+        blocks = [dict(block) if isinstance(block, dict) else {"type": "text", "text": block} for block in message.content]
+    blocks[-1]["cache_control"] = {"type": "ephemeral"}
+    return message.model_copy(update={"content": blocks})
+
+
+def _content_text(content: Union[str, List[Any]]) -> str:
+    """Return the text of a message (chunk) whose content may be a list of blocks."""
+    if isinstance(content, str):
+        return content
+    return "".join(
+        block if isinstance(block, str) else block.get("text", "")
+        for block in content
+        if isinstance(block, str) or block.get("type") == "text"
+    )
+
+
+_agent: Optional[Agent] = None
+_agent_lock = threading.Lock()
+
+
+def get_agent() -> Agent:
+    """Return the agent for this process, creating it on first use.
+
+    The agent holds no per-request state, so every view shares one.
+    """
+    global _agent
+    if _agent is None:
+        with _agent_lock:
+            if _agent is None:
+                _agent = Agent()
+                logger.info("Agent initialized successfully")
+    return _agent
+
+
+def _reset_after_fork() -> None:
+    global _agent
+    _agent = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
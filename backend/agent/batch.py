@@ -0,0 +1,346 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import AbstractAsyncContextManager, AbstractContextManager, nullcontext
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from pydantic import BaseModel, Field, field_validator
+from agent.admission import AdmissionController, Overloaded, Ticket, get_admission
+from agent.character import AGENT_CHARACTER_PROMPT
+from agent.mcp import ModelContextProtocol
+from agent.message import Role
+from agent.pool import DEFAULT_MODEL, DEFAULT_TEMPERATURE, ConfigurationError, get_model
+from agent.retry import acall_with_retry, call_with_retry, cancel_on
+
+logger = logging.getLogger(__name__)
+
+_ROLES = frozenset(role.value for role in Role)
+
+
+class BatchJob(BaseModel):
+    """One conversation turn in a batch request."""
+    thread_id: str = Field(default="default", min_length=1)
+    messages: List[Dict[str, str]] = Field(min_length=1)
+    turn_cursor: Optional[int] = Field(default=None, ge=0, strict=True)  # Strict so true/false are rejected
+
+    @field_validator("messages")
+    @classmethod
+    def _check_messages(cls, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        for message in messages:
+            if "content" not in message or message.get("role") not in _ROLES:
+                raise ValueError("each message needs a role (system, user or assistant) and content")
+        return messages
+
+
+def parse_jobs(data: Dict[str, Any], max_jobs: int) -> List[BatchJob]:
+    """Validate the ``jobs`` of a batch request body.
+
+    Raises:
+        ValueError: If the jobs are missing, too many or malformed.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Request body must be a JSON object")
+    jobs = data.get("jobs")
+    if not isinstance(jobs, list) or not jobs:
+        raise ValueError("jobs must be a non-empty list")
+    if len(jobs) > max_jobs:
+        raise ValueError(f"A batch may contain at most {max_jobs} jobs")
+    return [BatchJob.model_validate(job) for job in jobs]
+
+
+def batch_parallelism(data: Dict[str, Any]) -> int:
+    """Return the requested parallelism, capped by ``AGENT_BATCH_MAX_PARALLELISM``."""
+    limit = int(os.getenv("AGENT_BATCH_MAX_PARALLELISM", "8"))
+    requested = data.get("parallelism", limit)
+    if not isinstance(requested, int) or requested < 1:
+        raise ValueError("parallelism must be a positive integer")
+    return min(requested, limit)
+
+
+class BatchAdmission:
+    """Admission control for the jobs of one online batch.
+
+    Every job takes its own ticket when it runs, so a batch spends the
+    same rate and concurrency budget as the chat requests it replaces.
+    The first job's ticket is taken up front: a batch that cannot be
+    admitted at all is rejected before its response starts.
+    """
+
+    def __init__(self, admission: AdmissionController, client_id: Optional[str], first: Ticket):
+        self.admission = admission
+        self.client_id = client_id
+        self._first = first
+
+    @classmethod
+    def acquire(cls, jobs: List[BatchJob], client_id: Optional[str] = None) -> "BatchAdmission":
+        """Admit the first job of ``jobs``.
+
+        Raises:
+            Overloaded: If the batch was shed.
+        """
+        admission = get_admission()
+        return cls(admission, client_id, admission.acquire(jobs[0].thread_id, client_id))
+
+    @classmethod
+    async def aacquire(cls, jobs: List[BatchJob], client_id: Optional[str] = None) -> "BatchAdmission":
+        """Async variant of ``acquire``."""
+        admission = get_admission()
+        return cls(admission, client_id, await admission.aacquire(jobs[0].thread_id, client_id))
+
+    def parallelism(self, requested: int) -> int:
+        """Cap ``requested`` so the batch's own jobs never exceed the per-client limit."""
+        per_client = self.admission.per_client if self.client_id else 0
+        return min(requested, per_client) if per_client else requested
+
+    def admit(self, index: int, job: BatchJob) -> AbstractContextManager:
+        """Return the admission context for job ``index``."""
+        return self._first if index == 0 else self.admission.admit(job.thread_id, self.client_id)
+
+    def aadmit(self, index: int, job: BatchJob) -> AbstractAsyncContextManager:
+        """Async variant of ``admit``."""
+        return self._first if index == 0 else self.admission.aadmit(job.thread_id, self.client_id)
+
+    def release(self) -> None:
+        """Release the first job's ticket if that job never ran."""
+        self._first.release()
+
+
+def _chains(jobs: List[BatchJob]) -> List[List[Tuple[int, BatchJob]]]:
+    """Group jobs by thread, keeping request order within each thread."""
+    chains: Dict[str, List[Tuple[int, BatchJob]]] = {}
+    for index, job in enumerate(jobs):
+        chains.setdefault(job.thread_id, []).append((index, job))
+    return list(chains.values())
+
+
+def _result(index: int, job: BatchJob, response: Optional[Dict[str, Any]] = None, error: Optional[Exception] = None) -> Dict[str, Any]:
+    if isinstance(error, Overloaded):
+        logger.warning(f"Batch job {index} for thread {job.thread_id} shed: {str(error)}")
+        return {"index": index, "thread_id": job.thread_id, "status": "shed", "error": str(error), "retry_after": error.retry_after}
+    if error is not None:
+        logger.warning(f"Batch job {index} for thread {job.thread_id} failed: {str(error)}")
+        return {"index": index, "thread_id": job.thread_id, "status": "error", "error": str(error)}
+    return {"index": index, "thread_id": job.thread_id, "status": "ok", **response}
+
+
+def run_batch(agent: Any, jobs: List[BatchJob], parallelism: int, admission: Optional[BatchAdmission] = None) -> Iterator[Dict[str, Any]]:
+    """Run batch jobs on at most ``parallelism`` threads, yielding results as they finish.
+
+    Jobs for the same thread run one after another in request order; other
+    threads run concurrently. A failed or shed job is reported and does not
+    stop the batch.
+    """
+    results: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+    if admission is not None:
+        parallelism = admission.parallelism(parallelism)
+
+    stopped = threading.Event()
+
+    def run_chain(chain: List[Tuple[int, BatchJob]]) -> None:
+        for index, job in chain:
+            if stopped.is_set():
+                return
+            try:
+                with admission.admit(index, job) if admission is not None else nullcontext(), cancel_on(stopped):
+                    response = call_with_retry(agent.invoke, job.messages, job.thread_id, job.turn_cursor)
+                results.put(_result(index, job, response))
+            except Exception as e:
+                results.put(_result(index, job, error=e))
+
+    executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="batch")
+    try:
+        for chain in _chains(jobs):
+            executor.submit(run_chain, chain)
+        for _ in range(len(jobs)):
+            yield results.get()
+    finally:
+        # Drop chains that have not started and stop retry backoffs if the client went away
+        stopped.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        if admission is not None:
+            admission.release()
+
+
+async def arun_batch(agent: Any, jobs: List[BatchJob], parallelism: int, admission: Optional[BatchAdmission] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Async variant of ``run_batch`` built on ``Agent.ainvoke``."""
+    results: asyncio.Queue = asyncio.Queue()
+    if admission is not None:
+        parallelism = admission.parallelism(parallelism)
+    semaphore = asyncio.Semaphore(parallelism)
+
+    async def run_chain(chain: List[Tuple[int, BatchJob]]) -> None:
+        async with semaphore:
+            for index, job in chain:
+                try:
+                    async with admission.aadmit(index, job) if admission is not None else nullcontext():
+                        response = await acall_with_retry(agent.ainvoke, job.messages, job.thread_id, job.turn_cursor)
+                    results.put_nowait(_result(index, job, response))
+                except Exception as e:
+                    results.put_nowait(_result(index, job, error=e))
+
+    tasks = [asyncio.ensure_future(run_chain(chain)) for chain in _chains(jobs)]
+    try:
+        for _ in range(len(jobs)):
+            yield await results.get()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if admission is not None:
+            admission.release()
+
+
+# Offline batches go through the Anthropic Message Batches API (or a local stand-in)
+
+def _to_anthropic(messages: List[Any]) -> Tuple[Any, List[Dict[str, Any]]]:
+    """Split LangChain messages into Messages API ``system`` and ``messages`` params."""
+    system = ""
+    converted = []
+    for message in messages:
+        if message.type == "system":
+            system = message.content
+        else:
+            converted.append({"role": "user" if message.type == "human" else "assistant", "content": message.content})
+    return system, converted
+
+
+def build_batch_request(agent: Any, index: int, job: BatchJob, max_tokens: int) -> Dict[str, Any]:
+    """Build one Message Batches request for a job.
+
+    Offline jobs are stateless: the context is built from the job's own
+    messages in a scratch protocol and the thread's stored state is neither
+    read nor updated.
+    """
+    mcp = ModelContextProtocol(system_prompt=AGENT_CHARACTER_PROMPT, thread_id=job.thread_id)
+    for msg in job.messages:
+        mcp.ingest_message(msg)
+    system, messages = _to_anthropic(agent._to_langchain(mcp.build_context(job.messages[-1]["content"])))
+    return {
+        "custom_id": f"job-{index}",
+        "params": {
+            "model": DEFAULT_MODEL.split(":", 1)[-1],
+            "max_tokens": max_tokens,
+            "temperature": DEFAULT_TEMPERATURE,
+            "system": system,
+            "messages": messages,
+        },
+    }
+
+
+class AnthropicBatchBackend:
+    """Submits offline batches to the Anthropic Message Batches API."""
+
+    def __init__(self):
+        import anthropic
+
+        api_key = os.getenv("ANTHROPIC_API_KEY")
+        if not api_key:
+            raise ConfigurationError("ANTHROPIC_API_KEY not found in environment variables")
+        self.client = anthropic.Anthropic(api_key=api_key)
+
+    def submit(self, requests: List[Dict[str, Any]]) -> str:
+        return self.client.messages.batches.create(requests=requests).id
+
+    def status(self, batch_id: str) -> Dict[str, Any]:
+        batch = self.client.messages.batches.retrieve(batch_id)
+        return {"batch_id": batch.id, "status": batch.processing_status, "counts": batch.request_counts.model_dump()}
+
+    def results(self, batch_id: str) -> Iterator[Dict[str, Any]]:
+        for entry in self.client.messages.batches.results(batch_id):
+            result = entry.result
+            if result.type == "succeeded":
+                content = "".join(block.text for block in result.message.content if block.type == "text")
+                yield {"custom_id": entry.custom_id, "status": "ok", "content": content}
+            else:
+                error = getattr(result, "error", None)
+                yield {"custom_id": entry.custom_id, "status": result.type, "error": str(error) if error else result.type}
+
+
+class LocalBatchBackend:
+    """In-process stand-in for the Message Batches API, for development and tests.
+
+    Requests run through the pooled chat model on the backend's own
+    executor as soon as they are submitted; ``status`` and ``results`` only
+    read what has finished.
+    """
+
+    def __init__(self):
+        self._batches: Dict[str, List[Tuple[str, Future]]] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("AGENT_BATCH_MAX_PARALLELISM", "8")),
+            thread_name_prefix="batch-local",
+        )
+
+    def submit(self, requests: List[Dict[str, Any]]) -> str:
+        batch_id = f"local_{uuid.uuid4().hex}"
+        futures = [(request["custom_id"], self._executor.submit(self._run, request["params"])) for request in requests]
+        with self._lock:
+            self._batches[batch_id] = futures
+        return batch_id
+
+    def status(self, batch_id: str) -> Dict[str, Any]:
+        futures = [future for _, future in self._get(batch_id)]
+        done = [future for future in futures if future.done()]
+        errored = sum(1 for future in done if future.exception() is not None)
+        processing = len(futures) - len(done)
+        return {
+            "batch_id": batch_id,
+            "status": "in_progress" if processing else "ended",
+            "counts": {"processing": processing, "succeeded": len(done) - errored, "errored": errored},
+        }
+
+    def results(self, batch_id: str) -> Iterator[Dict[str, Any]]:
+        for custom_id, future in self._get(batch_id):
+            error = future.exception()
+            if error is None:
+                yield {"custom_id": custom_id, "status": "ok", "content": future.result()}
+            else:
+                yield {"custom_id": custom_id, "status": "errored", "error": str(error)}
+
+    @staticmethod
+    def _run(params: Dict[str, Any]) -> str:
+        messages = [{"role": "system", "content": params["system"]}] + params["messages"]
+        return get_model().invoke(messages).content
+
+    def _get(self, batch_id: str) -> List[Tuple[str, Future]]:
+        with self._lock:
+            if batch_id not in self._batches:
+                raise KeyError(batch_id)
+            return self._batches[batch_id]
+
+
+_backend: Optional[Any] = None
+_backend_lock = threading.Lock()
+
+
+def get_batch_backend() -> Any:
+    """Return the offline batch backend selected by ``AGENT_BATCH_BACKEND`` (``anthropic`` or ``local``)."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if os.getenv("AGENT_BATCH_BACKEND", "anthropic").lower() == "local":
+                    _backend = LocalBatchBackend()
+                else:
+                    _backend = AnthropicBatchBackend()
+    return _backend
+
+
+def submit_offline(agent: Any, jobs: List[BatchJob]) -> str:
+    """Submit jobs as one offline batch and return its ID."""
+    max_tokens = int(os.getenv("AGENT_BATCH_MAX_TOKENS", "1024"))
+    requests = [build_batch_request(agent, index, job, max_tokens) for index, job in enumerate(jobs)]
+    batch_id = get_batch_backend().submit(requests)
+    logger.info(f"Submitted offline batch {batch_id} with {len(requests)} job(s)")
+    return batch_id
+
+
+def _reset_after_fork() -> None:
+    global _backend
+    _backend = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
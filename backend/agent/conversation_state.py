@@ -1,9 +1,6 @@
 from typing import Dict, List, Optional, Any
 from pydantic import BaseModel, Field
 from datetime import datetime
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from langgraph.graph import StateGraph, END
-from langchain_core.runnables import RunnableConfig
 
 class ConversationState(BaseModel):
     """Represents the current state of a conversation."""
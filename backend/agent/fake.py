@@ -0,0 +1,80 @@
+import asyncio
+import hashlib
+import os
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+WORDS = ("woof", "tail", "wag", "fetch", "pawsome", "sniff", "treat", "walk", "ball", "human")
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic local chat model for benchmarks and load tests.
+
+    Replies are derived from a hash of the prompt, so the same conversation
+    always gets the same answer. ``latency`` is the delay before the first
+    token and ``token_rate`` the tokens per second after it (0 for instant).
+    """
+    latency: float = 0.0
+    token_rate: float = 0.0
+    reply_tokens: int = 40
+
+    @classmethod
+    def from_env(cls) -> "FakeChatModel":
+        """Build a model from the ``AGENT_FAKE_LLM_*`` environment variables."""
+        return cls(
+            latency=float(os.getenv("AGENT_FAKE_LLM_LATENCY", "0.5")),
+            token_rate=float(os.getenv("AGENT_FAKE_LLM_TOKEN_RATE", "80")),
+            reply_tokens=int(os.getenv("AGENT_FAKE_LLM_REPLY_TOKENS", "40")),
+        )
+
+    def bind_tools(self, tools: Any, **kwargs: Any) -> "FakeChatModel":
+        """Accept tools so tool-enabled agents run; the fake never calls them."""
+        return self
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        digest = hashlib.sha256(repr([message.content for message in messages]).encode("utf-8")).digest()
+        return [WORDS[digest[i % len(digest)] % len(WORDS)] + " " for i in range(self.reply_tokens)]
+
+    def _usage(self, messages: List[BaseMessage], output_tokens: int) -> dict:
+        input_tokens = sum(len(str(message.content)) // 4 + 4 for message in messages)
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+    def _total_delay(self) -> float:
+        return self.latency + (self.reply_tokens / self.token_rate if self.token_rate else 0.0)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        tokens = self._tokens(messages)
+        time.sleep(self._total_delay())
+        message = AIMessage(content="".join(tokens).strip(), usage_metadata=self._usage(messages, len(tokens)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        tokens = self._tokens(messages)
+        await asyncio.sleep(self._total_delay())
+        message = AIMessage(content="".join(tokens).strip(), usage_metadata=self._usage(messages, len(tokens)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        tokens = self._tokens(messages)
+        time.sleep(self.latency)
+        for token in tokens:
+            if self.token_rate:
+                time.sleep(1 / self.token_rate)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(messages, len(tokens))))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        tokens = self._tokens(messages)
+        await asyncio.sleep(self.latency)
+        for token in tokens:
+            if self.token_rate:
+                await asyncio.sleep(1 / self.token_rate)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(messages, len(tokens))))
@@ -0,0 +1,210 @@
+"""
+One agent turn as a LangGraph ``StateGraph``:
+
+    prepare -> model -> (tools -> model)* -> commit
+
+``prepare`` ingests the new turns into the thread's MCP and builds the
+prompt (or finds a cached reply), ``model`` calls the chat model, ``tools``
+runs the tool calls it asked for, and ``commit`` adds the reply to the
+thread's context. The agent and the MCP travel in the run context, not the
+state. The graph is not checkpointed: the conversation store persists the
+MCP, which is all a thread needs to resume, and a turn that fails is
+retried from the start.
+"""
+import os
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+from typing_extensions import TypedDict
+from langgraph.graph import END, START, StateGraph
+from langgraph.runtime import Runtime
+from agent.mcp import ModelContextProtocol
+from agent.retry import check_cancelled
+
+if TYPE_CHECKING:
+    from agent.agent import Agent
+
+PREPARE = "prepare"
+MODEL = "model"
+TOOLS = "tools"
+COMMIT = "commit"
+
+
+class TurnState(TypedDict, total=False):
+    """Graph state of one turn."""
+    messages: List[Dict[str, str]]  # Request messages; may be the client's whole history
+    turn_cursor: Optional[int]
+    language: Optional[str]
+    prompt: List[Any]  # Built from the MCP by ``prepare``
+    steps: List[Any]  # Model and tool messages of this turn
+    reply: str
+    cache_key: Optional[str]
+    cached: bool
+    rounds: int  # Tool rounds run so far
+    more_tools: bool  # The last model round asked for tools that will run
+    cursor: int  # The thread's turn cursor after the commit
+
+
+@dataclass
+class TurnContext:
+    """Per-run objects the nodes share."""
+    agent: "Agent"
+    mcp: ModelContextProtocol
+    stream: bool = False  # Emit token and reset events through the ``custom`` stream mode
+    closed: bool = False  # Set once the consumer stops reading the stream
+
+
+class StreamClosed(Exception):
+    """Raised in the model node when nobody reads the stream anymore."""
+
+
+# Streamed after a round whose text led up to tool calls: the reply starts over
+RESET = {"type": "reset"}
+
+
+def _emitter(runtime: Runtime[TurnContext]) -> Callable[[str], None]:
+    ctx = runtime.context
+    writer = runtime.stream_writer
+
+    def emit(text: str) -> None:
+        # Stop the model stream at its next chunk instead of finishing the reply
+        if ctx.closed:
+            raise StreamClosed()
+        writer({"type": "token", "content": text})
+    return emit
+
+
+def prepare(state: TurnState, runtime: Runtime[TurnContext]) -> Dict[str, Any]:
+    ctx = runtime.context
+    prompt, cache_key, cached = ctx.agent._prepare(ctx.mcp, state["messages"], state.get("turn_cursor"), state.get("language"))
+    if cached is not None and ctx.stream:
+        runtime.stream_writer({"type": "token", "content": cached})
+    return {
+        "prompt": prompt or [],
+        "cache_key": cache_key,
+        "cached": cached is not None,
+        "reply": cached or "",
+        "steps": [],
+        "rounds": 0,
+    }
+
+
+def call_model(state: TurnState, runtime: Runtime[TurnContext]) -> Dict[str, Any]:
+    ctx = runtime.context
+    messages = state["prompt"] + state["steps"]
+    if ctx.stream:
+        text, response = ctx.agent._stream_model(messages, _emitter(runtime))
+    else:
+        text, response = ctx.agent._call_model(messages)
+    return _model_update(state, runtime, text, response)
+
+
+def run_tools(state: TurnState, runtime: Runtime[TurnContext]) -> Dict[str, Any]:
+    # Tools may have side effects; skip them if the attempt was abandoned
+    check_cancelled()
+    results = runtime.context.agent.tools.run(state["steps"][-1].tool_calls)
+    return {"steps": state["steps"] + results, "rounds": state["rounds"] + 1}
+
+
+def commit(state: TurnState, runtime: Runtime[TurnContext]) -> Dict[str, Any]:
+    # Don't commit if the caller already gave up on this attempt
+    check_cancelled()
+    ctx = runtime.context
+    return {"cursor": ctx.agent._commit(ctx.mcp, state["reply"], state["cache_key"])}
+
+
+async def aprepare(state: TurnState, runtime: Runtime[TurnContext]) -> Dict[str, Any]:
+    ctx = runtime.context
+    prompt, cache_key, cached = await ctx.agent._aprepare(ctx.mcp, state["messages"], state.get("turn_cursor"), state.get("language"))
+    if cached is not None and ctx.stream:
+        runtime.stream_writer({"type": "token", "content": cached})
+    return {
+        "prompt": prompt or [],
+        "cache_key": cache_key,
+        "cached": cached is not None,
+        "reply": cached or "",
+        "steps": [],
+        "rounds": 0,
+    }
+
+
+async def acall_model(state: TurnState, runtime: Runtime[TurnContext]) -> Dict[str, Any]:
+    ctx = runtime.context
+    messages = state["prompt"] + state["steps"]
+    if ctx.stream:
+        text, response = await ctx.agent._astream_model(messages, _emitter(runtime))
+    else:
+        text, response = await ctx.agent._acall_model(messages)
+    return _model_update(state, runtime, text, response)
+
+
+def _model_update(state: TurnState, runtime: Runtime[TurnContext], text: str, response: Any) -> Dict[str, Any]:
+    # The reply is the last round's text; earlier rounds only led up to tool calls
+    more_tools = response is not None and runtime.context.agent._more_tools(state["rounds"], response)
+    if more_tools and text and runtime.context.stream:
+        runtime.stream_writer(RESET)
+    return {
+        "steps": state["steps"] + [response] if response is not None else state["steps"],
+        "reply": text,
+        "more_tools": more_tools,
+    }
+
+
+async def arun_tools(state: TurnState, runtime: Runtime[TurnContext]) -> Dict[str, Any]:
+    results = await runtime.context.agent.tools.arun(state["steps"][-1].tool_calls)
+    return {"steps": state["steps"] + results, "rounds": state["rounds"] + 1}
+
+
+async def acommit(state: TurnState, runtime: Runtime[TurnContext]) -> Dict[str, Any]:
+    check_cancelled()
+    ctx = runtime.context
+    return {"cursor": await ctx.agent._acommit(ctx.mcp, state["reply"], state["cache_key"])}
+
+
+def after_prepare(state: TurnState) -> str:
+    return COMMIT if state["cached"] else MODEL
+
+
+def after_model(state: TurnState) -> str:
+    return TOOLS if state["more_tools"] else COMMIT
+
+
+def build_graph(asynchronous: bool = False) -> Any:
+    """Compile the turn graph with sync or async nodes.
+
+    Args:
+        asynchronous: Build the variant for ``ainvoke``/``astream``.
+    """
+    builder = StateGraph(TurnState, context_schema=TurnContext)
+    builder.add_node(PREPARE, aprepare if asynchronous else prepare)
+    builder.add_node(MODEL, acall_model if asynchronous else call_model)
+    builder.add_node(TOOLS, arun_tools if asynchronous else run_tools)
+    builder.add_node(COMMIT, acommit if asynchronous else commit)
+    builder.add_edge(START, PREPARE)
+    builder.add_conditional_edges(PREPARE, after_prepare, [MODEL, COMMIT])
+    builder.add_conditional_edges(MODEL, after_model, [TOOLS, COMMIT])
+    builder.add_edge(TOOLS, MODEL)
+    builder.add_edge(COMMIT, END)
+    return builder.compile()
+
+
+_graphs: Dict[bool, Any] = {}
+_graphs_lock = threading.Lock()
+
+
+def get_graph(asynchronous: bool = False) -> Any:
+    """Return this process's compiled turn graph, building it on first use."""
+    graph = _graphs.get(asynchronous)
+    if graph is None:
+        with _graphs_lock:
+            graph = _graphs.get(asynchronous)
+            if graph is None:
+                graph = _graphs[asynchronous] = build_graph(asynchronous)
+    return graph
+
+
+def _reset_after_fork() -> None:
+    _graphs.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
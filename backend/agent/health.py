@@ -0,0 +1,161 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DATABASE = "database"
+MODEL = "model"
+QUEUE = "queue"
+
+
+def check_database() -> Tuple[bool, Dict[str, Any]]:
+    """Run ``SELECT 1`` on a connection that is closed again right after."""
+    from django.db import connection
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return True, {}
+    finally:
+        # Never pin a pooled connection to the prober thread
+        connection.close()
+
+
+def check_model() -> Tuple[bool, Dict[str, Any]]:
+    """Make sure the default chat model client is built; no request is sent."""
+    from agent.pool import get_model
+
+    model = get_model()
+    return True, {"client": type(model).__name__}
+
+
+def check_queue() -> Tuple[bool, Dict[str, Any]]:
+    """Report admission and write-behind queue depth; full means not ready."""
+    from agent.admission import get_admission
+    from agent.store import get_store
+
+    admission = get_admission()
+    depth = admission.snapshot()
+    depth["store_backlog"] = get_store().backlog()
+    saturated = depth["active"] >= admission.max_concurrency and depth["waiting"] >= admission.queue_size
+    return not saturated, depth
+
+
+DEFAULT_CHECKS: Dict[str, Callable[[], Tuple[bool, Dict[str, Any]]]] = {
+    DATABASE: check_database,
+    MODEL: check_model,
+    QUEUE: check_queue,
+}
+
+
+class HealthMonitor:
+    """Background prober that caches dependency status for the health endpoints.
+
+    Every ``interval`` seconds a daemon thread runs each check and stores
+    its result, so probes answer from memory. A result older than ``ttl``
+    (a hung check, or a dead prober) counts as failing, and until the first
+    probe finishes the report says the worker is still starting.
+    """
+
+    def __init__(
+        self,
+        checks: Optional[Dict[str, Callable[[], Tuple[bool, Dict[str, Any]]]]] = None,
+        interval: float = 10.0,
+        ttl: float = 30.0,
+    ):
+        self.checks = dict(checks if checks is not None else DEFAULT_CHECKS)
+        self.interval = interval
+        self.ttl = ttl
+        self._results: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._probed = threading.Event()
+        self._prober: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start the prober thread if it is not running."""
+        with self._lock:
+            if self._prober is None:
+                self._prober = threading.Thread(target=self._run, name="health-prober", daemon=True)
+                self._prober.start()
+
+    def probe(self) -> None:
+        """Run every check once and store the results."""
+        for name, check in self.checks.items():
+            start = time.monotonic()
+            try:
+                ok, detail = check()
+            except Exception as e:
+                ok, detail = False, {"error": str(e)}
+            result = {
+                "ok": ok,
+                "checked_at": time.time(),
+                "latency_ms": round((time.monotonic() - start) * 1000, 1),
+                **detail,
+            }
+            with self._lock:
+                previous = self._results.get(name)
+                self._results[name] = result
+            if previous is None or previous["ok"] != ok:
+                if ok:
+                    logger.info(f"Health check {name} passed")
+                else:
+                    logger.warning(f"Health check {name} failed: {detail}")
+        self._probed.set()
+
+    def status(self, names: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """Return the cached report; never runs or waits for a check on the caller's thread.
+
+        Args:
+            names: Checks to report on; defaults to all of them.
+
+        Returns:
+            ``ready`` (every reported check passed), ``starting`` (no probe
+            has finished yet) and the ``checks`` themselves.
+        """
+        if self._prober is None:
+            self.start()
+        names = list(names) if names is not None else list(self.checks)
+        starting = not self._probed.is_set()
+        now = time.time()
+        with self._lock:
+            results = {name: dict(self._results[name]) for name in names if name in self._results}
+        for name in names:
+            result = results.setdefault(name, {"ok": False, "error": "not checked yet"})
+            if "checked_at" in result and now - result["checked_at"] > self.ttl:
+                result["ok"] = False
+                result["error"] = f"stale: last checked {round(now - result['checked_at'])}s ago"
+        ready = not starting and all(result["ok"] for result in results.values())
+        return {"ready": ready, "starting": starting, "checks": results}
+
+    def _run(self) -> None:
+        while True:
+            self.probe()
+            time.sleep(self.interval)
+
+
+_monitor: Optional[HealthMonitor] = None
+_monitor_lock = threading.Lock()
+
+
+def get_health_monitor() -> HealthMonitor:
+    """Return the health monitor for this process, creating it on first use."""
+    global _monitor
+    if _monitor is None:
+        with _monitor_lock:
+            if _monitor is None:
+                _monitor = HealthMonitor(
+                    interval=float(os.getenv("AGENT_HEALTH_INTERVAL", "10")),
+                    ttl=float(os.getenv("AGENT_HEALTH_TTL", "30")),
+                )
+    return _monitor
+
+
+def _reset_after_fork() -> None:
+    global _monitor
+    _monitor = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
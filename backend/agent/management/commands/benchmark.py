@@ -0,0 +1,168 @@
+import json
+import statistics
+import time
+from typing import Callable, Dict, List, Tuple
+from django.core.management.base import BaseCommand
+from agent import snapshot as codec
+from agent.character import AGENT_CHARACTER_PROMPT
+from agent.mcp import ContextWindow, ConversationState, Memory, ModelContextProtocol
+
+WORDS = ("walk", "ball", "treat", "python", "model", "dog", "park", "token", "cache", "sheep", "human", "dutch")
+
+
+def _message(i: int) -> Dict[str, str]:
+    role = "user" if i % 2 == 0 else "assistant"
+    text = " ".join(WORDS[(i * 7 + j) % len(WORDS)] for j in range(8 + i % 24))
+    return {"role": role, "content": text + ("?" if i % 3 == 0 else ".")}
+
+
+def _memory(facts: int) -> Memory:
+    memory = Memory()
+    for i in range(facts):
+        memory.add_fact(f"fact_{i}_{WORDS[i % len(WORDS)]}", f"{WORDS[(i * 5) % len(WORDS)]} {WORDS[(i * 3) % len(WORDS)]} {i}", relevance=0.5 + (i % 5) / 10)
+    return memory
+
+
+def _protocol(window_size: int, facts: int) -> ModelContextProtocol:
+    mcp = ModelContextProtocol(system_prompt=AGENT_CHARACTER_PROMPT, thread_id="bench")
+    mcp.context_window.max_size = window_size
+    mcp.memory = _memory(facts)
+    for i in range(window_size * 2):
+        mcp.ingest_message(_message(i))
+    return mcp
+
+
+class Command(BaseCommand):
+    help = "Microbenchmarks for the MCP hot paths (context window, transitions, memory, snapshots)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--number", type=int, default=2000, help="Operations per measurement")
+        parser.add_argument("--repeat", type=int, default=5, help="Measurements per benchmark; the best and median are reported")
+        parser.add_argument("--window-size", type=int, default=10, help="Context window max_size")
+        parser.add_argument("--facts", type=int, default=500, help="Facts in memory")
+        parser.add_argument("--json", action="store_true", help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        number, repeat = options["number"], options["repeat"]
+        window_size, facts = options["window_size"], options["facts"]
+        results = [
+            self._measure(name, setup, number, repeat)
+            for name, setup in self._benchmarks(window_size, facts)
+        ]
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'benchmark':<42} {'best us/op':>12} {'median us/op':>14}")
+        for result in results:
+            self.stdout.write(f"{result['name']:<42} {result['best_us']:>12.2f} {result['median_us']:>14.2f}")
+
+    def _benchmarks(self, window_size: int, facts: int) -> List[Tuple[str, Callable[[int], Callable[[], None]]]]:
+        """Return (name, setup) pairs; ``setup(number)`` returns a callable that runs ``number`` operations."""
+        messages = [_message(i) for i in range(64)]
+
+        def add_message(number):
+            window = ContextWindow(max_size=number + 1)
+            def run():
+                for i in range(number):
+                    window.add_message(messages[i % 64])
+            return run
+
+        def add_message_full(number):
+            window = ContextWindow(max_size=window_size)
+            for i in range(window_size):
+                window.add_message(messages[i % 64])
+            def run():
+                for i in range(number):
+                    window.add_message(messages[i % 64])
+            return run
+
+        def prune_context(number):
+            # One prune evicting ``number`` messages
+            window = ContextWindow(max_size=window_size + number, max_evicted=number)
+            for i in range(window_size + number):
+                window.add_message(messages[i % 64])
+            window.max_size = window_size
+            return window._prune_context
+
+        def evaluate_transition(message):
+            def setup(number):
+                mcp = ModelContextProtocol(system_prompt=AGENT_CHARACTER_PROMPT)
+                mcp.current_state = ConversationState.ACTIVE
+                def run():
+                    for _ in range(number):
+                        mcp._evaluate_transition(message)
+                return run
+            return setup
+
+        def relevant_facts(number):
+            memory = _memory(facts)
+            queries = [messages[i]["content"] for i in range(64)]
+            memory.get_relevant_facts(queries[0])  # Build the term index outside the timing
+            def run():
+                for i in range(number):
+                    memory.get_relevant_facts(queries[i % 64])
+            return run
+
+        def to_dict(number):
+            mcp = _protocol(window_size, facts)
+            def run():
+                for _ in range(number):
+                    mcp.to_dict()
+            return run
+
+        def from_dict(number):
+            # Parsed in the loop, like the decode in from_snapshot
+            snapshot = json.dumps(_protocol(window_size, facts).to_dict())
+            def run():
+                for _ in range(number):
+                    ModelContextProtocol.from_dict(json.loads(snapshot))
+            return run
+
+        def snapshot(number):
+            mcp = _protocol(window_size, facts)
+            def run():
+                for _ in range(number):
+                    codec.encode(mcp.snapshot())
+            return run
+
+        def from_snapshot(number):
+            raw = codec.encode(_protocol(window_size, facts).snapshot())
+            def run():
+                for _ in range(number):
+                    ModelContextProtocol.from_snapshot(codec.decode(raw))
+            return run
+
+        def delta(number):
+            mcp = _protocol(window_size, facts)
+            base = mcp.snapshot()
+            mcp.ingest_message(messages[0])
+            mcp.ingest_message(messages[1])
+            current = mcp.snapshot()
+            def run():
+                for _ in range(number):
+                    codec.encode(codec.diff(base, current))
+            return run
+
+        return [
+            ("ContextWindow.add_message", add_message),
+            ("ContextWindow.add_message (full window)", add_message_full),
+            ("ContextWindow._prune_context (per evict)", prune_context),
+            ("MCP._evaluate_transition (no match)", evaluate_transition(messages[1])),
+            ("MCP._evaluate_transition (rule fires)", evaluate_transition(messages[0])),
+            (f"Memory.get_relevant_facts ({facts} facts)", relevant_facts),
+            ("MCP.to_dict", to_dict),
+            ("json.loads + MCP.from_dict", from_dict),
+            ("MCP.snapshot + encode", snapshot),
+            ("decode + MCP.from_snapshot", from_snapshot),
+            ("snapshot delta (one turn) + encode", delta),
+        ]
+
+    def _measure(self, name: str, setup: Callable[[int], Callable[[], None]], number: int, repeat: int) -> Dict[str, float]:
+        timings = []
+        for _ in range(repeat):
+            run = setup(number)
+            start = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - start) / number * 1e6)
+        return {"name": name, "best_us": min(timings), "median_us": statistics.median(timings)}
@@ -0,0 +1,81 @@
+import json
+import os
+import subprocess
+import sys
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Boots the server the way the gunicorn master does: the selected application,
+# the URLconf and (with --preload) the chat model integration
+BOOT_SCRIPT = """
+import time
+start = time.perf_counter()
+import app
+from django.urls import get_resolver
+get_resolver().url_patterns
+if {preload}:
+    from agent.pool import preload
+    preload()
+print(time.perf_counter() - start)
+"""
+
+
+def parse_importtime(output: str) -> List[Tuple[str, int, int]]:
+    """Parse ``python -X importtime`` output into ``(module, self_us, cumulative_us)`` rows."""
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|", 2)
+        if own.strip().isdigit():
+            rows.append((name.strip(), int(own), int(cumulative)))
+    return rows
+
+
+class Command(BaseCommand):
+    help = "Report where server boot time goes, using python -X importtime in a fresh interpreter"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=15, help="Packages to list")
+        parser.add_argument("--preload", action="store_true", help="Include the model integration preloaded by the gunicorn master")
+        parser.add_argument("--budget", type=float, help="Fail if boot takes longer than this many seconds")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        script = BOOT_SCRIPT.format(preload=bool(options["preload"]))
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", script],
+            cwd=settings.BASE_DIR,
+            env=os.environ.copy(),
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise CommandError(f"Boot failed:\n{result.stderr[-2000:]}")
+
+        rows = parse_importtime(result.stderr)
+        packages: Counter = Counter()
+        for name, own, _ in rows:
+            packages[name.split(".", 1)[0]] += own
+        report: Dict[str, Any] = {
+            "boot_s": round(float(result.stdout.strip().splitlines()[-1]), 3),
+            "imports_s": round(sum(own for _, own, _ in rows) / 1e6, 3),
+            "modules": len(rows),
+            "packages": [
+                {"package": package, "self_ms": round(own / 1000, 1)}
+                for package, own in packages.most_common(options["top"])
+            ],
+        }
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write(f"Boot: {report['boot_s']}s ({report['imports_s']}s importing {report['modules']} modules)")
+            self.stdout.write(f"{'package':<32} {'self ms':>10}")
+            for entry in report["packages"]:
+                self.stdout.write(f"{entry['package']:<32} {entry['self_ms']:>10.1f}")
+
+        if options["budget"] is not None and report["boot_s"] > options["budget"]:
+            raise CommandError(f"Boot took {report['boot_s']}s, over the {options['budget']}s budget")
@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from django.core.management.base import BaseCommand
+
+PROMPTS = (
+    "Hi Yoko! How are you today?",
+    "Can you explain what a transformer model is?",
+    "What should I feed a border collie?",
+    "Tell me a fun fact about herding dogs.",
+    "How do I speed up a Django view?",
+    "Thanks, goodbye!",
+)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+class Command(BaseCommand):
+    help = "Load test /api/chat/ with a deterministic fake LLM and report throughput and latency percentiles"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", help="Base URL of a running server (e.g. http://localhost:8000); default runs in-process")
+        parser.add_argument("--requests", type=int, default=200, help="Total chat requests")
+        parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients")
+        parser.add_argument("--turns", type=int, default=4, help="Turns per conversation before a client starts a new thread")
+        parser.add_argument("--latency", type=float, default=0.2, help="Fake LLM time to first token, seconds (in-process only)")
+        parser.add_argument("--token-rate", type=float, default=0, help="Fake LLM tokens per second, 0 for instant (in-process only)")
+        parser.add_argument("--persist", action="store_true", help="Write the load-* conversations to the database (in-process only)")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        if not options["url"]:
+            # In-process runs always use the fake model; admission limits would
+            # only measure the shedding of a single synthetic client
+            os.environ["AGENT_FAKE_LLM"] = "true"
+            os.environ["AGENT_FAKE_LLM_LATENCY"] = str(options["latency"])
+            os.environ["AGENT_FAKE_LLM_TOKEN_RATE"] = str(options["token_rate"])
+            # Keep synthetic threads out of whatever database DATABASE_URL points at
+            os.environ["AGENT_STORE_PERSIST"] = "true" if options["persist"] else "false"
+            os.environ.setdefault("AGENT_RATE_LIMIT_RPM", "0")
+            os.environ.setdefault("AGENT_MAX_PER_CLIENT", "0")
+            os.environ.setdefault("AGENT_MAX_CONCURRENCY", str(options["concurrency"]))
+
+        run_id = uuid.uuid4().hex[:8]
+        concurrency = max(1, options["concurrency"])
+        shares = [options["requests"] // concurrency + (1 if i < options["requests"] % concurrency else 0) for i in range(concurrency)]
+        latencies: List[float] = []
+        statuses: Counter = Counter()
+        lock = threading.Lock()
+
+        def client(worker: int) -> None:
+            post = self._poster(options["url"])
+            thread_id, cursor = None, None
+            for n in range(shares[worker]):
+                if n % options["turns"] == 0:
+                    thread_id, cursor = f"load-{run_id}-{worker}-{n}", None
+                body = {"messages": [{"role": "user", "content": PROMPTS[n % len(PROMPTS)]}], "thread_id": thread_id}
+                if cursor is not None:
+                    body["turn_cursor"] = cursor
+                start = time.perf_counter()
+                try:
+                    status, data = post(body)
+                except Exception:
+                    status, data = "error", None
+                elapsed = time.perf_counter() - start
+                if status == 200 and data:
+                    cursor = data.get("turn_cursor")
+                with lock:
+                    statuses[status] += 1
+                    if status == 200:
+                        latencies.append(elapsed)
+
+        # One untimed request so imports and client setup stay out of the numbers
+        self._poster(options["url"])({"messages": [{"role": "user", "content": PROMPTS[0]}], "thread_id": f"load-{run_id}-warmup"})
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(client, range(concurrency)))
+        duration = time.perf_counter() - started
+
+        latencies.sort()
+        report = {
+            "target": options["url"] or "in-process",
+            "requests": sum(statuses.values()),
+            "concurrency": concurrency,
+            "statuses": {str(status): count for status, count in statuses.items()},
+            "duration_s": round(duration, 3),
+            "throughput_rps": round(len(latencies) / duration, 2) if duration else 0.0,
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50) * 1000, 1),
+                "p90": round(percentile(latencies, 90) * 1000, 1),
+                "p99": round(percentile(latencies, 99) * 1000, 1),
+                "max": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+            },
+        }
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(f"Target:       {report['target']}")
+        self.stdout.write(f"Requests:     {report['requests']} with {concurrency} concurrent clients in {report['duration_s']}s")
+        self.stdout.write(f"Statuses:     {report['statuses']}")
+        self.stdout.write(f"Throughput:   {report['throughput_rps']} req/s")
+        latency = report["latency_ms"]
+        self.stdout.write(f"Latency (ms): p50 {latency['p50']}  p90 {latency['p90']}  p99 {latency['p99']}  max {latency['max']}")
+
+    def _poster(self, url: Optional[str]):
+        """Return ``post(body) -> (status, json)`` for a live server or the in-process test client."""
+        if url:
+            import requests
+
+            session = requests.Session()
+            endpoint = url.rstrip("/") + "/api/chat/"
+
+            def post(body: Dict[str, Any]) -> Tuple[Any, Any]:
+                response = session.post(endpoint, json=body, timeout=120)
+                return response.status_code, response.json() if response.ok else None
+            return post
+
+        from django.test import Client
+
+        test_client = Client(HTTP_HOST="localhost")
+
+        def post(body: Dict[str, Any]) -> Tuple[Any, Any]:
+            response = test_client.post("/api/chat/", body, content_type="application/json", secure=True)
+            return response.status_code, json.loads(response.content) if response.status_code == 200 else None
+        return post
@@ -1,11 +1,19 @@
-from typing import List, Dict, Any, Optional, Set
-from pydantic import BaseModel, Field
+from typing import List, Dict, Any, Callable, Optional, Set, Tuple, Union
+from pydantic import BaseModel, Field, PrivateAttr, field_validator
 from datetime import datetime
 import json
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from langchain_core.runnables import RunnableConfig
 import re
+import bisect
+import heapq
+import itertools
+import logging
+import math
+import threading
 from enum import Enum
+from agent.message import Message, Role
+from agent.tokens import context_token_budget, count_tokens
+
+logger = logging.getLogger(__name__)
 
 class ConversationState(str, Enum):
     """Defines possible conversation states."""
@@ -22,94 +30,428 @@ class StateTransitionRule(BaseModel):
     condition: str  # Python expression to evaluate
     action: Optional[str] = None  # Optional action to take during transition
 
+    def key(self) -> Tuple[str, str, str, Optional[str]]:
+        """Return a hashable identity for the rule."""
+        return (self.from_state.value, self.to_state.value, self.condition, self.action)
+
+# Default state transition rules, shared by every conversation
+DEFAULT_TRANSITION_RULES = (
+    StateTransitionRule(
+        from_state=ConversationState.INITIAL,
+        to_state=ConversationState.ACTIVE,
+        condition="len(self.context_window.messages) > 0",
+        action="self.memory.add_fact('conversation_started', True)"
+    ),
+    StateTransitionRule(
+        from_state=ConversationState.ACTIVE,
+        to_state=ConversationState.WAITING,
+        condition="'?' in message['content']",
+        action="self.memory.add_fact('last_question', message['content'])"
+    ),
+    StateTransitionRule(
+        from_state=ConversationState.WAITING,
+        to_state=ConversationState.ACTIVE,
+        condition="message['role'] == 'assistant'",
+        action="self.memory.add_fact('last_answer', message['content'])"
+    ),
+    StateTransitionRule(
+        from_state=ConversationState.ACTIVE,
+        to_state=ConversationState.COMPLETED,
+        condition="'goodbye' in message['content'].lower()",
+        action="self.memory.add_fact('conversation_ended', True)"
+    ),
+)
+
+# Compact snapshot format written by ModelContextProtocol.snapshot()
+SNAPSHOT_VERSION = 2
+DEFAULT_RULES_REF = "default"
+
+class TransitionEngine:
+    """Transition rules compiled once into callables and indexed by ``from_state``.
+
+    Conditions and actions are compiled into plain functions of
+    ``(self, message)``, so evaluating a message costs one dict lookup plus
+    the calls for the rules leaving the current state.
+    """
+
+    def __init__(self, rules: List[StateTransitionRule]):
+        self.table: Dict[ConversationState, List[Tuple[ConversationState, Callable, Optional[Callable]]]] = {}
+        for rule in rules:
+            name = f"{rule.from_state.value}_to_{rule.to_state.value}"
+            condition = self._compile(f"def {name}(self, message):\n    return ({rule.condition})\n", name)
+            action = None
+            if rule.action:
+                action = self._compile(f"def {name}(self, message):\n    {rule.action}\n", name)
+            self.table.setdefault(rule.from_state, []).append((rule.to_state, condition, action))
+
+    @staticmethod
+    def _compile(source: str, name: str) -> Callable:
+        namespace: Dict[str, Any] = {}
+        exec(compile(source, f"<transition {name}>", "exec"), namespace)
+        return namespace[name]
+
+    def evaluate(self, mcp: 'ModelContextProtocol', message: Dict[str, str]) -> Optional[ConversationState]:
+        """Return the state to move to for a message, running the rule's action, or None."""
+        for to_state, condition, action in self.table.get(mcp.current_state, ()):
+            try:
+                if condition(mcp, message):
+                    if action is not None:
+                        action(mcp, message)
+                    return to_state
+            except Exception as e:
+                logger.warning(f"Error evaluating transition rule {mcp.current_state.value} -> {to_state.value}: {e}")
+        return None
+
+_engines: Dict[Tuple, TransitionEngine] = {}
+_engines_lock = threading.Lock()
+
+def get_transition_engine(rules: List[StateTransitionRule]) -> TransitionEngine:
+    """Return the shared compiled engine for a set of rules."""
+    key = tuple(rule.key() for rule in rules)
+    engine = _engines.get(key)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.setdefault(key, TransitionEngine(rules))
+    return engine
+
 class ContextWindow(BaseModel):
-    """Represents a sliding window of conversation context."""
-    messages: List[Dict[str, str]] = Field(default_factory=list)
+    """Represents a sliding window of conversation context.
+    
+    Messages stay in chronological order with ``importance_scores`` aligned by
+    index; they are ``Message`` records that cache their token count and
+    LangChain form for as long as they stay in the window. A min-heap of
+    ``(score, sequence)`` pairs finds the least important message in
+    O(log n) when the window overflows.
+    """
+    messages: List[Message] = Field(default_factory=list)
     max_size: int = Field(default=10)
     summary: Optional[str] = None
-    importance_scores: Dict[int, float] = Field(default_factory=dict)  # Message index -> importance score
+    importance_scores: List[float] = Field(default_factory=list)  # Aligned with messages
+    evicted: List[Message] = Field(default_factory=list)  # Pruned messages not yet folded into the summary
+    max_evicted: int = Field(default=100)
+    _heap: List[Tuple[float, int]] = PrivateAttr(default_factory=list)
+    _seqs: List[int] = PrivateAttr(default_factory=list)  # Sequence number of each message, ascending
+    _next_seq: int = PrivateAttr(default=0)
+    _evicted_seqs: List[int] = PrivateAttr(default_factory=list)  # Sequence number of each evicted message
     
-    def add_message(self, message: Dict[str, str]) -> None:
+    @field_validator("importance_scores", mode="before")
+    @classmethod
+    def _legacy_scores(cls, value: Any) -> Any:
+        # Older snapshots stored {index: score}
+        if isinstance(value, dict):
+            return [score for _, score in sorted(value.items(), key=lambda item: int(item[0]))]
+        return value
+    
+    def model_post_init(self, __context: Any) -> None:
+        if len(self.importance_scores) != len(self.messages):
+            self.importance_scores = [self._calculate_importance(msg) for msg in self.messages]
+        # Evicted messages from older snapshots get negative sequence numbers
+        self._index(list(range(len(self.messages))), len(self.messages), list(range(-len(self.evicted), 0)))
+    
+    def _index(self, seqs: List[int], next_seq: int, evicted_seqs: List[int]) -> None:
+        self._seqs = seqs
+        self._heap = list(zip(self.importance_scores, seqs))
+        heapq.heapify(self._heap)
+        self._next_seq = next_seq
+        self._evicted_seqs = evicted_seqs
+    
+    def add_message(self, message: Union[Message, Dict[str, str]]) -> None:
         """Add a new message to the context window."""
-        self.messages.append(message)
+        message = Message.coerce(message)
         # Calculate importance score for new message
-        self.importance_scores[len(self.messages) - 1] = self._calculate_importance(message)
+        score = self._calculate_importance(message)
+        seq = self._next_seq
+        self._next_seq += 1
+        
+        self.messages.append(message)
+        self.importance_scores.append(score)
+        self._seqs.append(seq)
+        heapq.heappush(self._heap, (score, seq))
         
         if len(self.messages) > self.max_size:
             self._prune_context()
     
-    def _calculate_importance(self, message: Dict[str, str]) -> float:
+    def _calculate_importance(self, message: Message) -> float:
         """Calculate importance score for a message."""
         score = 1.0  # Base score
         
         # Increase score for user messages
-        if message["role"] == "user":
+        if message.role is Role.USER:
             score *= 1.5
         
         # Increase score for messages with questions
-        if "?" in message["content"]:
+        if "?" in message.content:
             score *= 1.2
         
         # Increase score for longer messages
-        score *= min(1.0 + (len(message["content"]) / 1000), 2.0)
+        score *= min(1.0 + (len(message.content) / 1000), 2.0)
         
         return score
     
     def _prune_context(self) -> None:
-        """Prune the context based on importance scores."""
-        # Sort messages by importance score
-        sorted_indices = sorted(
-            self.importance_scores.items(),
-            key=lambda x: x[1],
-            reverse=True
-        )
+        """Evict the least important messages until the window fits.
         
-        # Keep the most important messages
-        keep_indices = set(idx for idx, _ in sorted_indices[:self.max_size])
+        Ties go to the oldest message, and the newest message is never evicted.
+        Survivors keep their order and their scores.
+        """
+        newest = self._seqs[-1]
+        skipped = []
+        while len(self.messages) > self.max_size and self._heap:
+            entry = heapq.heappop(self._heap)
+            if entry[1] == newest:
+                skipped.append(entry)
+                continue
+            index = bisect.bisect_left(self._seqs, entry[1])
+            if index == len(self._seqs) or self._seqs[index] != entry[1]:
+                continue  # Stale heap entry
+            self.evicted.append(self.messages[index])
+            self._evicted_seqs.append(entry[1])
+            del self.messages[index]
+            del self.importance_scores[index]
+            del self._seqs[index]
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
         
-        # Update messages and scores
-        self.messages = [msg for i, msg in enumerate(self.messages) if i in keep_indices]
-        self.importance_scores = {i: score for i, (idx, score) in enumerate(sorted_indices[:self.max_size])}
+        # Bound the backlog if summarization falls behind
+        if len(self.evicted) > self.max_evicted:
+            del self.evicted[:len(self.evicted) - self.max_evicted]
+            del self._evicted_seqs[:len(self._evicted_seqs) - self.max_evicted]
+    
+    def evicted_entries(self) -> List[Tuple[int, Message]]:
+        """Return the evicted backlog as ``(sequence, message)`` pairs, oldest first."""
+        return list(zip(self._evicted_seqs, self.evicted))
+
+    @property
+    def next_seq(self) -> int:
+        """Sequence number the next added message will get."""
+        return self._next_seq
+
+    def messages_since(self, seq: int) -> List[Message]:
+        """Return the window and backlog messages numbered ``seq`` or later, oldest first."""
+        entries = [(s, message) for s, message in zip(self._seqs, self.messages) if s >= seq]
+        entries.extend((s, message) for s, message in zip(self._evicted_seqs, self.evicted) if s >= seq)
+        entries.sort(key=lambda entry: entry[0])
+        return [message for _, message in entries]
+
+    def apply_summary(self, summary: str, seqs: List[int]) -> None:
+        """Replace the summary after the evicted messages with sequence numbers ``seqs`` were folded into it.
         
-        # Update summary
-        self.update_summary()
+        Messages evicted since the summary started stay in the backlog, and
+        ones the backlog bound dropped meanwhile are simply no longer there.
+        """
+        self.summary = summary
+        done = set(seqs)
+        kept = [(seq, message) for seq, message in zip(self._evicted_seqs, self.evicted) if seq not in done]
+        self._evicted_seqs = [seq for seq, _ in kept]
+        self.evicted = [message for _, message in kept]
     
-    def update_summary(self) -> None:
-        """Update the summary of older messages."""
-        if len(self.messages) > self.max_size:
-            # Create a summary of the most important messages
-            important_messages = [
-                msg for i, msg in enumerate(self.messages)
-                if self.importance_scores.get(i, 0) > 1.0
-            ]
-            self.summary = f"Previous conversation context: {len(important_messages)} important messages summarized"
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the window as a compact snapshot that references each message by sequence number."""
+        return {
+            "max_size": self.max_size,
+            "max_evicted": self.max_evicted,
+            "summary": self.summary,
+            "next_seq": self._next_seq,
+            "messages": [[seq, score, message.to_dict()] for seq, score, message in zip(self._seqs, self.importance_scores, self.messages)],
+            "evicted": [[seq, message.to_dict()] for seq, message in zip(self._evicted_seqs, self.evicted)],
+        }
+    
+    @classmethod
+    def from_snapshot(cls, data: Dict[str, Any]) -> 'ContextWindow':
+        """Restore a window from ``snapshot()`` output without validating it."""
+        coerce = Message.coerce
+        window = cls.model_construct(
+            messages=[coerce(message) for _, _, message in data["messages"]],
+            importance_scores=[score for _, score, _ in data["messages"]],
+            max_size=data["max_size"],
+            summary=data["summary"],
+            evicted=[coerce(message) for _, message in data["evicted"]],
+            max_evicted=data["max_evicted"],
+        )
+        window._index([seq for seq, _, _ in data["messages"]], data["next_seq"], [seq for seq, _ in data["evicted"]])
+        return window
+
+def _terms(text: str) -> Set[str]:
+    """Split text into lowercase index terms of three or more characters, without stop words."""
+    return set(_TERM_PATTERN.findall(text.lower())).difference(STOP_WORDS)
+
+_TERM_PATTERN = re.compile(r"[^\W_]{3,}")
+
+# Common English and Dutch words that would put most facts in every query's candidates
+STOP_WORDS = frozenset("""
+    the and for you are but not with this that have was what when where who why how can your from
+    they them their there here then than our out all any its his her she him has had been were will
+    would could should about into just also very more most some such only other over does did yes
+    het een van dat die niet zijn wat voor met maar ook als bij door naar nog wel dan kan heb hebt
+    heeft waren wordt worden deze dit hoe wie waar jij jou jouw mijn wij ons onze zij hun
+""".split())
+# Terms in more than this share of the facts (and more than MIN_COMMON_DF of them) are not used to match
+MAX_DF_RATIO = 0.1
+MIN_COMMON_DF = 2
 
 class Memory(BaseModel):
-    """Represents long-term memory storage."""
+    """Represents long-term memory storage.
+    
+    Facts are kept in update order and indexed by the terms of their key and
+    value, so a query only scores the facts it shares terms with plus the
+    most recently updated ones. Stop words are never indexed, and terms
+    that occur in too many facts to tell them apart are skipped when
+    matching, so common words do not turn the lookup into a full scan. The
+    index is built on the first lookup, so restoring a thread that is only
+    written to costs nothing for it.
+    
+    ``accessed_at`` is kept in access order too, and both orders come with
+    a running count of writes and reads, so a snapshot delta only has to
+    look at the last few entries of each. Change facts through ``add_fact``
+    and ``get_fact`` to keep the counts right.
+    """
     facts: Dict[str, Any] = Field(default_factory=dict)
     preferences: Dict[str, Any] = Field(default_factory=dict)
     last_accessed: datetime = Field(default_factory=datetime.now)
     relevance_scores: Dict[str, float] = Field(default_factory=dict)  # Fact key -> relevance score
+    accessed_at: Dict[str, float] = Field(default_factory=dict)  # Fact key -> last access (epoch seconds), in access order
+    recency_half_life: float = Field(default=3600.0)  # Seconds for a fact's recency weight to halve
+    _index: Optional[Dict[str, Set[str]]] = PrivateAttr(default=None)  # Term -> fact keys; None until first used
+    _fact_terms: Dict[str, Set[str]] = PrivateAttr(default_factory=dict)  # Fact key -> terms
+    _writes: int = PrivateAttr(default=0)  # Facts written so far
+    _reads: int = PrivateAttr(default=0)  # Access times recorded so far
+    
+    def _indexes(self) -> Tuple[Dict[str, Set[str]], Dict[str, Set[str]]]:
+        # Private attribute access goes through pydantic's __getattr__ (~2.5µs); read the storage directly
+        private = self.__pydantic_private__
+        index, fact_terms = private["_index"], private["_fact_terms"]
+        if index is None:
+            index = private["_index"] = {}
+            for key, value in self.facts.items():
+                terms = fact_terms[key] = _terms(f"{key.replace('_', ' ')} {value}")
+                for term in terms:
+                    keys = index.get(term)
+                    if keys is None:
+                        index[term] = {key}
+                    else:
+                        keys.add(key)
+        return index, fact_terms
+    
+    def _index_fact(self, key: str, value: Any) -> None:
+        private = self.__pydantic_private__
+        index, fact_terms = private["_index"], private["_fact_terms"]
+        if index is None:
+            return  # Indexed with the rest on first use
+        for term in fact_terms.pop(key, ()):
+            keys = index.get(term)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[term]
+        terms = _terms(f"{key.replace('_', ' ')} {value}")
+        fact_terms[key] = terms
+        for term in terms:
+            index.setdefault(term, set()).add(key)
+    
+    def _touch(self, key: str, timestamp: float) -> None:
+        # Re-insert so accessed_at stays ordered by last access
+        self.accessed_at.pop(key, None)
+        self.accessed_at[key] = timestamp
+        self.__pydantic_private__["_reads"] += 1
     
     def add_fact(self, key: str, value: Any, relevance: float = 1.0) -> None:
         """Add a fact to memory with relevance score."""
+        # Re-insert so facts stay ordered by last update
+        self.facts.pop(key, None)
         self.facts[key] = value
         self.relevance_scores[key] = relevance
+        self.__pydantic_private__["_writes"] += 1
         self.last_accessed = datetime.now()
+        self._touch(key, self.last_accessed.timestamp())
+        self._index_fact(key, value)
     
     def get_fact(self, key: str, default: Any = None) -> Any:
         """Retrieve a fact from memory."""
         self.last_accessed = datetime.now()
+        if key in self.facts:
+            self._touch(key, self.last_accessed.timestamp())
         return self.facts.get(key, default)
     
-    def get_relevant_facts(self, query: str, threshold: float = 0.5) -> List[Dict[str, Any]]:
-        """Get facts relevant to a query."""
+    def get_relevant_facts(self, query: str, threshold: float = 0.5, top_k: int = 5) -> List[Dict[str, Any]]:
+        """Get the facts most relevant to a query.
+        
+        Facts sharing terms with the query, plus the ``top_k`` most recently
+        updated facts, are scored by term overlap, stored relevance and an
+        exponential recency decay on their last access.
+        
+        Args:
+            query: Text to match facts against, usually the latest message.
+            threshold: Minimum stored relevance for a fact to be considered.
+            top_k: Maximum number of facts to return.
+            
+        Returns:
+            Up to ``top_k`` facts, best first.
+        """
+        index, fact_terms = self._indexes()
+        facts, relevance_scores, accessed_at = self.facts, self.relevance_scores, self.accessed_at
+        max_df = max(MIN_COMMON_DF, len(facts) * MAX_DF_RATIO)
+        matches: Dict[str, int] = {}
+        for term in _terms(query):
+            keys = index.get(term)
+            if keys is None or len(keys) > max_df:
+                continue
+            for key in keys:
+                matches[key] = matches.get(key, 0) + 1
+        for key in itertools.islice(reversed(facts), top_k):
+            matches.setdefault(key, 0)
+        
+        now = datetime.now()
+        now_ts = now.timestamp()
+        half_life = self.recency_half_life
+        scored = []
+        for key, overlap in matches.items():
+            relevance = relevance_scores.get(key, 0)
+            if relevance < threshold:
+                continue
+            age = max(now_ts - accessed_at.get(key, now_ts), 0.0)
+            decay = 0.5 ** (age / half_life)
+            match = overlap / math.sqrt(len(fact_terms.get(key, ())) or 1)
+            scored.append((relevance * decay * (1.0 + match), key))
+        
+        # Candidates are few once common terms are skipped; a sort beats nlargest's setup
+        scored.sort(reverse=True)
         relevant_facts = []
-        for key, value in self.facts.items():
-            score = self.relevance_scores.get(key, 0)
-            if score >= threshold:
-                relevant_facts.append({"key": key, "value": value, "relevance": score})
-        return sorted(relevant_facts, key=lambda x: x["relevance"], reverse=True)
+        for score, key in scored[:top_k]:
+            accessed_at.pop(key, None)
+            accessed_at[key] = now_ts
+            relevant_facts.append({"key": key, "value": facts[key], "relevance": score})
+        if relevant_facts:
+            self.__pydantic_private__["_reads"] += len(relevant_facts)
+            self.last_accessed = now
+        return relevant_facts
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Return memory as a compact snapshot with ``last_accessed`` in epoch seconds."""
+        return {
+            "facts": dict(self.facts),
+            "preferences": dict(self.preferences),
+            "last_accessed": self.last_accessed.timestamp(),
+            "relevance": dict(self.relevance_scores),
+            "accessed": dict(self.accessed_at),
+            "half_life": self.recency_half_life,
+            "writes": self.__pydantic_private__["_writes"],
+            "reads": self.__pydantic_private__["_reads"],
+        }
+    
+    @classmethod
+    def from_snapshot(cls, data: Dict[str, Any]) -> 'Memory':
+        """Restore memory from ``snapshot()`` output without validating it; the term index is built on first use."""
+        memory = cls.model_construct(
+            facts=dict(data["facts"]),
+            preferences=dict(data["preferences"]),
+            last_accessed=datetime.fromtimestamp(data["last_accessed"]),
+            relevance_scores=dict(data["relevance"]),
+            accessed_at=dict(data["accessed"]),
+            recency_half_life=data["half_life"],
+        )
+        memory.__pydantic_private__["_writes"] = data["writes"]
+        memory.__pydantic_private__["_reads"] = data["reads"]
+        return memory
 
 class ModelContextProtocol(BaseModel):
     """Implements the Model Context Protocol for managing conversation context."""
@@ -118,59 +460,22 @@ class ModelContextProtocol(BaseModel):
     current_state: ConversationState = Field(default=ConversationState.INITIAL)
     system_prompt: str = Field(default="")
     thread_id: str = Field(default="default")
-    transition_rules: List[StateTransitionRule] = Field(default_factory=list)
-    
-    def __init__(self, **data):
-        super().__init__(**data)
-        # Initialize default transition rules
-        self._initialize_transition_rules()
-    
-    def _initialize_transition_rules(self):
-        """Initialize default state transition rules."""
-        self.transition_rules = [
-            StateTransitionRule(
-                from_state=ConversationState.INITIAL,
-                to_state=ConversationState.ACTIVE,
-                condition="len(self.context_window.messages) > 0",
-                action="self.memory.add_fact('conversation_started', True)"
-            ),
-            StateTransitionRule(
-                from_state=ConversationState.ACTIVE,
-                to_state=ConversationState.WAITING,
-                condition="'?' in message['content']",
-                action="self.memory.add_fact('last_question', message['content'])"
-            ),
-            StateTransitionRule(
-                from_state=ConversationState.WAITING,
-                to_state=ConversationState.ACTIVE,
-                condition="message['role'] == 'assistant'",
-                action="self.memory.add_fact('last_answer', message['content'])"
-            ),
-            StateTransitionRule(
-                from_state=ConversationState.ACTIVE,
-                to_state=ConversationState.COMPLETED,
-                condition="'goodbye' in message['content'].lower()",
-                action="self.memory.add_fact('conversation_ended', True)"
-            )
-        ]
-    
-    def _evaluate_transition(self, message: Dict[str, str]) -> Optional[ConversationState]:
+    turn_cursor: int = Field(default=0)  # Number of conversation messages ingested so far
+    transition_rules: List[StateTransitionRule] = Field(default_factory=lambda: list(DEFAULT_TRANSITION_RULES))
+    _engine: Optional[TransitionEngine] = PrivateAttr(default=None)
+    _engine_rules: Optional[List[StateTransitionRule]] = PrivateAttr(default=None)
+    
+    def _evaluate_transition(self, message: Message) -> Optional[ConversationState]:
         """Evaluate if a state transition should occur."""
-        for rule in self.transition_rules:
-            if rule.from_state == self.current_state:
-                try:
-                    # Evaluate the condition
-                    if eval(rule.condition, {"self": self, "message": message}):
-                        # Execute the action if specified
-                        if rule.action:
-                            exec(rule.action, {"self": self, "message": message})
-                        return rule.to_state
-                except Exception as e:
-                    print(f"Error evaluating transition rule: {e}")
-        return None
+        # Resolved once per rules list; assign a new list to change the rules
+        if self._engine_rules is not self.transition_rules:
+            self._engine = get_transition_engine(self.transition_rules)
+            self._engine_rules = self.transition_rules
+        return self._engine.evaluate(self, message)
     
-    def process_message(self, message: Dict[str, str]) -> List[Dict[str, str]]:
-        """Process a new message and return the full context."""
+    def ingest_message(self, message: Union[Message, Dict[str, str]]) -> None:
+        """Apply a new message to the state and context window without building context."""
+        message = Message.coerce(message)
         # Check for state transition
         new_state = self._evaluate_transition(message)
         if new_state:
@@ -178,36 +483,84 @@ class ModelContextProtocol(BaseModel):
         
         # Add message to context window
         self.context_window.add_message(message)
+        self.turn_cursor += 1
+    
+    def build_context(self, query: str, token_budget: Optional[int] = None) -> List[Message]:
+        """Build the full context for the model within a token budget.
+        
+        The system prompt, state line and latest message are always included.
+        The remaining budget goes to the summary, then relevant facts, then
+        earlier turns from newest to oldest.
         
-        # Prepare context for the model
-        context = []
+        The context is ordered from most to least stable so providers can cache
+        its prefix: system prompt, summary, earlier turns, then the per-turn
+        state and facts (as system messages) right before the latest message.
+        
+        Args:
+            query: Content of the latest message, used to select relevant facts.
+            token_budget: Maximum input tokens; defaults to ``AGENT_CONTEXT_TOKEN_BUDGET``.
+            
+        Returns:
+            The context as a list of messages; window messages are the
+            window's own records.
+        """
+        budget = token_budget if token_budget is not None else context_token_budget()
+        window = self.context_window
+        messages = window.messages
+        prefix = []
+        turn_context = []
+        used = 0
         
         # Add system prompt if exists
         if self.system_prompt:
-            context.append({"role": "system", "content": self.system_prompt})
+            prefix.append(Message(Role.SYSTEM, self.system_prompt))
+            used += count_tokens(self.system_prompt)
         
         # Add current state information
-        context.append({
-            "role": "system",
-            "content": f"Current conversation state: {self.current_state.value}"
-        })
+        state_content = f"Current conversation state: {self.current_state.value}"
+        turn_context.append(Message(Role.SYSTEM, state_content))
+        used += count_tokens(state_content)
         
-        # Add summary of older messages if exists
-        if self.context_window.summary:
-            context.append({"role": "system", "content": self.context_window.summary})
+        # The latest message always goes in
+        start = len(messages)
+        if start:
+            start -= 1
+            used += messages[start].tokens
         
-        # Add relevant facts from memory
-        relevant_facts = self.memory.get_relevant_facts(message["content"])
-        if relevant_facts:
-            facts_context = "Relevant context from memory:\n" + "\n".join(
-                f"- {fact['key']}: {fact['value']}" for fact in relevant_facts
-            )
-            context.append({"role": "system", "content": facts_context})
+        # Add summary of older messages if it fits
+        if window.summary:
+            summary_content = f"Summary of the earlier conversation:\n{window.summary}"
+            summary_tokens = count_tokens(summary_content)
+            if used + summary_tokens <= budget:
+                prefix.append(Message(Role.SYSTEM, summary_content))
+                used += summary_tokens
         
-        # Add current context window
-        context.extend(self.context_window.messages)
+        # Add relevant facts from memory while they fit
+        fact_lines = []
+        for fact in self.memory.get_relevant_facts(query):
+            line = f"- {fact['key']}: {fact['value']}"
+            line_tokens = count_tokens(line)
+            if not fact_lines:
+                line_tokens += count_tokens("Relevant context from memory:")
+            if used + line_tokens > budget:
+                break
+            fact_lines.append(line)
+            used += line_tokens
+        if fact_lines:
+            turn_context.append(Message(Role.SYSTEM, "Relevant context from memory:\n" + "\n".join(fact_lines)))
         
-        return context
+        # Add earlier turns, newest first, while they fit
+        end = start
+        while start > 0 and used + messages[start - 1].tokens <= budget:
+            start -= 1
+            used += messages[start].tokens
+        
+        return prefix + messages[start:end] + turn_context + messages[end:]
+    
+    def process_message(self, message: Union[Message, Dict[str, str]]) -> List[Message]:
+        """Process a new message and return the full context."""
+        self.ingest_message(message)
+        return self.build_context(message["content"])
     
     def update_state(self, new_state: ConversationState) -> None:
         """Update the current state of the conversation."""
@@ -217,22 +570,68 @@ class ModelContextProtocol(BaseModel):
         """Convert the MCP state to a dictionary."""
         return {
             "context_window": {
-                "messages": self.context_window.messages,
+                "messages": [message.to_dict() for message in self.context_window.messages],
                 "summary": self.context_window.summary,
+                "evicted": [message.to_dict() for message in self.context_window.evicted],
                 "importance_scores": self.context_window.importance_scores
             },
             "memory": {
                 "facts": self.memory.facts,
                 "preferences": self.memory.preferences,
                 "last_accessed": self.memory.last_accessed.isoformat(),
-                "relevance_scores": self.memory.relevance_scores
+                "relevance_scores": self.memory.relevance_scores,
+                "accessed_at": self.memory.accessed_at
             },
             "current_state": self.current_state.value,
             "system_prompt": self.system_prompt,
             "thread_id": self.thread_id,
+            "turn_cursor": self.turn_cursor,
             "transition_rules": [rule.dict() for rule in self.transition_rules]
         }
     
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the state as a compact, versioned snapshot.
+        
+        Unlike ``to_dict`` this leaves out the system prompt (the caller
+        supplies it on load), stores the default transition rules by
+        reference and shares message dicts with the live state, so callers
+        must not mutate it.
+        """
+        rules = self.transition_rules
+        if len(rules) == len(DEFAULT_TRANSITION_RULES) and all(
+            rule is default or rule.key() == default.key() for rule, default in zip(rules, DEFAULT_TRANSITION_RULES)
+        ):
+            rules = DEFAULT_RULES_REF
+        else:
+            rules = [rule.model_dump(mode="json") for rule in rules]
+        return {
+            "v": SNAPSHOT_VERSION,
+            "thread_id": self.thread_id,
+            "state": self.current_state.value,
+            "cursor": self.turn_cursor,
+            "rules": rules,
+            "window": self.context_window.snapshot(),
+            "memory": self.memory.snapshot(),
+        }
+    
+    @classmethod
+    def from_snapshot(cls, data: Dict[str, Any], system_prompt: str = "") -> 'ModelContextProtocol':
+        """Restore an MCP from ``snapshot()`` output.
+        
+        Snapshots are written by this class, so validation is skipped, and
+        the memory's term index is left to be built by the first fact lookup.
+        """
+        rules = data["rules"]
+        return cls.model_construct(
+            context_window=ContextWindow.from_snapshot(data["window"]),
+            memory=Memory.from_snapshot(data["memory"]),
+            current_state=ConversationState(data["state"]),
+            system_prompt=system_prompt,
+            thread_id=data["thread_id"],
+            turn_cursor=data["cursor"],
+            transition_rules=list(DEFAULT_TRANSITION_RULES) if rules == DEFAULT_RULES_REF else [StateTransitionRule(**rule) for rule in rules],
+        )
+    
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'ModelContextProtocol':
         """Create an MCP instance from a dictionary."""
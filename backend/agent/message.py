@@ -0,0 +1,106 @@
+from enum import Enum
+from typing import TYPE_CHECKING, Any, Dict, Optional, Union
+from pydantic_core import core_schema
+from agent.tokens import count_tokens
+
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+
+
+class Role(str, Enum):
+    """Author of a conversation message."""
+    SYSTEM = "system"
+    USER = "user"
+    ASSISTANT = "assistant"
+
+
+class Message:
+    """One immutable conversation message.
+
+    The token count, the plain LangChain message and the ``{"role", "content"}``
+    dict used in snapshots are computed on first use and kept, so a message
+    that stays in the context window is converted once rather than every
+    turn. ``message["role"]`` and ``message["content"]`` work as on the dicts
+    messages used to be, for transition rules and other readers.
+    """
+    __slots__ = ("role", "content", "_tokens", "_langchain", "_data")
+
+    def __init__(self, role: Role, content: str):
+        self.role = role
+        self.content = content
+        self._tokens: Optional[int] = None
+        self._langchain: Optional["BaseMessage"] = None
+        self._data: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def coerce(cls, value: Union["Message", Dict[str, Any]]) -> "Message":
+        """Return ``value`` as a Message; only a dict's ``role`` and ``content`` are kept.
+
+        Raises:
+            ValueError: If ``value`` has no valid role or no string content.
+        """
+        if isinstance(value, Message):
+            return value
+        try:
+            role, content = Role(value["role"]), value["content"]
+        except (KeyError, TypeError):
+            raise ValueError("a message needs a role (system, user or assistant) and content") from None
+        if not isinstance(content, str):
+            raise ValueError("message content must be a string")
+        return cls(role, content)
+
+    @property
+    def tokens(self) -> int:
+        """Estimated token count, including per-message overhead."""
+        if self._tokens is None:
+            self._tokens = count_tokens(self.content)
+        return self._tokens
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Return the message as a ``{"role", "content"}`` dict; callers must not mutate it."""
+        if self._data is None:
+            self._data = {"role": self.role.value, "content": self.content}
+        return self._data
+
+    def to_langchain(self) -> "BaseMessage":
+        """Return the message as a LangChain message with plain text content; callers must not mutate it."""
+        if self._langchain is None:
+            from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+            cls = HumanMessage if self.role is Role.USER else AIMessage if self.role is Role.ASSISTANT else SystemMessage
+            self._langchain = cls(content=self.content)
+        return self._langchain
+
+    def __getitem__(self, key: str) -> str:
+        if key == "role":
+            return self.role.value
+        if key == "content":
+            return self.content
+        raise KeyError(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, Message):
+            return self.role is other.role and self.content == other.content
+        if isinstance(other, dict):
+            return other.get("role") == self.role.value and other.get("content") == self.content
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash((self.role, self.content))
+
+    def __repr__(self) -> str:
+        return f"Message(role={self.role.value!r}, content={self.content!r})"
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source: Any, handler: Any) -> core_schema.CoreSchema:
+        # Accept dicts on validation (legacy state) and dump as dicts
+        return core_schema.no_info_plain_validator_function(
+            cls.coerce,
+            serialization=core_schema.plain_serializer_function_ser_schema(lambda message: message.to_dict()),
+        )
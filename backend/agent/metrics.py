@@ -0,0 +1,105 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+
+logger = logging.getLogger(__name__)
+
+# Pipeline stages timed by span()/observe()
+CONTEXT = "context"  # Ingesting new turns and building the MCP context
+CONVERT = "convert"  # Converting the context to LangChain messages
+MODEL = "model"  # The model call (full stream for streaming requests)
+RETRY_WAIT = "retry_wait"  # Backoff sleeps between attempts
+ADMISSION_WAIT = "admission_wait"  # Time queued in admission control
+STORE_FLUSH = "store_flush"  # Write-behind flush of conversation state
+TOOLS = "tools"  # One round of tool calls requested by the model
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+STAGE_SECONDS = Histogram(
+    "agent_stage_seconds",
+    "Time spent in each stage of the chat pipeline",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+MODEL_TOKENS = Counter(
+    "agent_model_tokens",
+    "Tokens reported by the model, by kind",
+    ["kind"],
+)
+PROMPT_CACHE_CALLS = Counter(
+    "agent_prompt_cache_calls",
+    "Model calls by whether they read from the provider prompt cache",
+    ["result"],
+)
+RESPONSE_CACHE_LOOKUPS = Counter(
+    "agent_response_cache_lookups",
+    "Response cache lookups by result",
+    ["result"],
+)
+ADMISSION_DECISIONS = Counter(
+    "agent_admission_decisions",
+    "Admission control decisions",
+    ["decision"],
+)
+TOOL_CALLS = Counter(
+    "agent_tool_calls",
+    "Tool calls by tool and result (ok, cached, error, timeout)",
+    ["tool", "result"],
+)
+
+# Bound label children, so hot-path observations skip the label lookup
+_stages: Dict[str, Any] = {}
+
+
+def observe(stage: str, seconds: float) -> None:
+    """Record ``seconds`` spent in ``stage``."""
+    child = _stages.get(stage)
+    if child is None:
+        child = _stages[stage] = STAGE_SECONDS.labels(stage)
+    child.observe(seconds)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time the body of a ``with`` block as ``stage``, including when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def record_usage(usage: Optional[Dict[str, Any]]) -> None:
+    """Record the ``usage_metadata`` of one model response: token counts and prompt cache use."""
+    if not usage:
+        return
+    details = usage.get("input_token_details") or {}
+    cache_read = details.get("cache_read") or 0
+    cache_creation = details.get("cache_creation") or 0
+    MODEL_TOKENS.labels("input").inc(usage.get("input_tokens") or 0)
+    MODEL_TOKENS.labels("output").inc(usage.get("output_tokens") or 0)
+    MODEL_TOKENS.labels("cache_read").inc(cache_read)
+    MODEL_TOKENS.labels("cache_creation").inc(cache_creation)
+    PROMPT_CACHE_CALLS.labels("hit" if cache_read else "miss").inc()
+    logger.debug(f"Prompt cache: read={cache_read} created={cache_creation} input={usage.get('input_tokens')}")
+
+
+def render() -> tuple:
+    """Render every metric in the Prometheus text format.
+
+    With ``PROMETHEUS_MULTIPROC_DIR`` set (as the gunicorn config does) the
+    values of all workers are aggregated; otherwise this process's are used.
+
+    Returns:
+        The payload and its content type.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -1,3 +1,24 @@
 from django.db import models
 
-# Create your models here.
+
+class Conversation(models.Model):
+    """Persisted Model Context Protocol state for one conversation thread."""
+    thread_id = models.CharField(max_length=255, unique=True)
+    snapshot = models.BinaryField()  # Encoded ``ModelContextProtocol.snapshot()``
+    version = models.PositiveIntegerField(default=1)  # Bumped by every write; writers compare-and-set it
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.thread_id
+
+
+class ConversationDelta(models.Model):
+    """Changes to a conversation since its last full snapshot, applied in ``id`` order."""
+    thread_id = models.CharField(max_length=255, db_index=True)
+    payload = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.thread_id} #{self.pk}"
+
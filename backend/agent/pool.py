@@ -0,0 +1,153 @@
+import importlib
+import itertools
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "anthropic:claude-3-7-sonnet-latest"
+DEFAULT_TEMPERATURE = 0.7  # Increased for more creative responses
+
+
+class ConfigurationError(RuntimeError):
+    """Raised when the server lacks configuration it needs, such as an API key."""
+
+
+class ModelPool:
+    """Thread-safe registry of long-lived chat model clients.
+
+    Clients are keyed by model name and temperature. Each key holds ``size``
+    instances that are handed out round-robin, so their HTTP connection pools
+    (and keep-alive connections) survive between requests.
+    """
+
+    def __init__(self, size: int = 1):
+        self.size = max(1, size)
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple[str, float], List[Any]] = {}
+        self._cursors: Dict[Tuple[str, float], Any] = {}
+
+    def get(self, model: str = DEFAULT_MODEL, temperature: float = DEFAULT_TEMPERATURE) -> Any:
+        """Return a chat model client for the given configuration.
+
+        Args:
+            model: Model identifier understood by ``init_chat_model``.
+            temperature: Sampling temperature.
+
+        Returns:
+            A shared chat model instance.
+        """
+        key = (model, temperature)
+        clients = self._clients.get(key)
+        if clients is None:
+            with self._lock:
+                clients = self._clients.get(key)
+                if clients is None:
+                    clients = [self._build(model, temperature) for _ in range(self.size)]
+                    self._cursors[key] = itertools.count()
+                    self._clients[key] = clients
+                    logger.info(f"Model pool created {len(clients)} client(s) for {model}")
+        return clients[next(self._cursors[key]) % len(clients)]
+
+    def warm_up(self, model: str = DEFAULT_MODEL, temperature: float = DEFAULT_TEMPERATURE) -> None:
+        """Build the clients for a configuration and their HTTP clients ahead of traffic."""
+        self.get(model, temperature)
+        for client in self._clients[(model, temperature)]:
+            for attr in ("_client", "_async_client"):
+                try:
+                    getattr(client, attr)
+                except Exception as e:
+                    logger.warning(f"Failed to warm up {attr} for {model}: {str(e)}")
+
+    def reset(self) -> None:
+        """Drop every client, e.g. after a fork so children never share sockets."""
+        with self._lock:
+            self._clients = {}
+            self._cursors = {}
+
+    def _build(self, model: str, temperature: float) -> Any:
+        if os.getenv("AGENT_FAKE_LLM", "false").lower() == "true":
+            # Deterministic local model for benchmarks and load tests
+            from agent.fake import FakeChatModel
+
+            return FakeChatModel.from_env()
+
+        from langchain.chat_models import init_chat_model
+
+        api_key = os.getenv("ANTHROPIC_API_KEY")
+        if not api_key:
+            raise ConfigurationError("ANTHROPIC_API_KEY not found in environment variables")
+        # Retries, backoff and timeouts are owned by agent.retry; the client timeout
+        # matches one attempt so abandoned calls stop on their own.
+        return init_chat_model(
+            model,
+            temperature=temperature,
+            anthropic_api_key=api_key,
+            timeout=float(os.getenv("AGENT_RETRY_ATTEMPT_TIMEOUT", "30")),
+            max_retries=0,
+        )
+
+
+_pool: Optional[ModelPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ModelPool:
+    """Return the model pool for this process, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                load_dotenv()
+                _pool = ModelPool(size=int(os.getenv("AGENT_MODEL_POOL_SIZE", "1")))
+    return _pool
+
+
+def get_model(model: str = DEFAULT_MODEL, temperature: float = DEFAULT_TEMPERATURE) -> Any:
+    """Shortcut for ``get_pool().get(...)``."""
+    return get_pool().get(model, temperature)
+
+
+def warm_up() -> None:
+    """Warm up the default model clients if ``AGENT_MODEL_WARM_UP`` is enabled.
+
+    Called from the gunicorn ``post_fork`` hook so every worker builds its own
+    clients once, before it accepts requests.
+    """
+    if os.getenv("AGENT_MODEL_WARM_UP", "true").lower() != "true":
+        return
+    try:
+        get_pool().warm_up()
+    except Exception as e:
+        logger.error(f"Model pool warm-up failed: {str(e)}")
+
+
+def preload() -> None:
+    """Import the chat model integration without building any client.
+
+    Called from the gunicorn ``when_ready`` hook so the integration (about
+    two seconds for ``langchain_anthropic``) is imported once in the master
+    and shared by every forked worker, instead of once per worker in
+    ``warm_up``.
+    """
+    try:
+        if os.getenv("AGENT_FAKE_LLM", "false").lower() == "true":
+            import agent.fake  # noqa: F401
+            return
+        from langchain.chat_models import init_chat_model  # noqa: F401
+
+        provider = DEFAULT_MODEL.split(":", 1)[0]
+        importlib.import_module(f"langchain_{provider}")
+    except Exception as e:
+        logger.warning(f"Model integration preload failed: {str(e)}")
+
+
+def _reset_after_fork() -> None:
+    if _pool is not None:
+        _pool.reset()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
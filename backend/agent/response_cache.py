@@ -0,0 +1,138 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from agent.character import AGENT_CHARACTER_PROMPT
+
+logger = logging.getLogger(__name__)
+
+# Changes whenever the character prompt does, so cached replies never outlive it
+PROMPT_VERSION = hashlib.sha256(AGENT_CHARACTER_PROMPT.encode("utf-8")).hexdigest()[:12]
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s.!?,;:]+$")
+
+
+def normalize(text: str) -> str:
+    """Normalize a message for cache keys: case, whitespace and trailing punctuation."""
+    return _TRAILING_PUNCTUATION.sub("", _WHITESPACE.sub(" ", text.strip().lower()))
+
+
+def make_key(context: List[Dict[str, str]], message: str, language: Optional[str] = None, prompt_version: str = PROMPT_VERSION) -> str:
+    """Hash the system prompt version, trimmed context, user message and language into a cache key."""
+    payload = json.dumps(
+        [prompt_version, [(msg["role"], normalize(msg["content"])) for msg in context], normalize(message), (language or "").lower()],
+        ensure_ascii=False,
+    )
+    return "agent:response:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LocalBackend:
+    """In-process LRU with per-entry TTL."""
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class DjangoCacheBackend:
+    """Django cache framework backend (``CACHES`` alias, e.g. Redis or local memory)."""
+
+    def __init__(self, alias: str = "default"):
+        self.alias = alias
+
+    def get(self, key: str) -> Optional[str]:
+        from django.core.cache import caches
+
+        return caches[self.alias].get(key)
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        from django.core.cache import caches
+
+        caches[self.alias].set(key, value, timeout=ttl)
+
+
+class ResponseCache:
+    """Opt-in cache of complete replies for repeated opening prompts.
+
+    Only turns with at most ``max_context`` earlier messages are cached; the
+    key covers those messages, so longer conversations always reach the model.
+    """
+
+    def __init__(self, backend, ttl: float = 3600.0, max_context: int = 2):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_context = max_context
+
+    def key_for(self, history: List[Dict[str, str]], language: Optional[str] = None) -> Optional[str]:
+        """Return the cache key for a turn, or None if the turn is not cacheable.
+
+        Args:
+            history: Conversation messages, ending with the new user message.
+            language: Optional language hint from the client.
+        """
+        if not history or history[-1]["role"] != "user" or len(history) - 1 > self.max_context:
+            return None
+        return make_key(history[:-1], history[-1]["content"], language)
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            return self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"Response cache lookup failed: {str(e)}")
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            logger.warning(f"Response cache write failed: {str(e)}")
+
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Return the response cache selected by ``AGENT_RESPONSE_CACHE``, or None when off.
+
+    ``AGENT_RESPONSE_CACHE`` is ``off`` (default), ``local`` or ``django``;
+    ``AGENT_RESPONSE_CACHE_ALIAS`` picks the Django cache for ``django``.
+    """
+    global _cache
+    mode = os.getenv("AGENT_RESPONSE_CACHE", "off").lower()
+    if mode == "off":
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if mode == "django":
+                    backend = DjangoCacheBackend(os.getenv("AGENT_RESPONSE_CACHE_ALIAS", "default"))
+                else:
+                    backend = LocalBackend(max_size=int(os.getenv("AGENT_RESPONSE_CACHE_SIZE", "1024")))
+                _cache = ResponseCache(backend, ttl=float(os.getenv("AGENT_RESPONSE_CACHE_TTL", "3600")))
+    return _cache
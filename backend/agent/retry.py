@@ -0,0 +1,361 @@
+import asyncio
+import contextvars
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional
+from pydantic import BaseModel, Field
+from agent.metrics import RETRY_WAIT, span
+
+logger = logging.getLogger(__name__)
+
+# Error classes returned by classify_error
+OVERLOADED = "overloaded"
+RATE_LIMITED = "rate_limited"
+TIMEOUT = "timeout"
+CONNECTION = "connection"
+
+
+class RetryPolicy(BaseModel):
+    """Retry, backoff and deadline settings for LLM calls."""
+    max_attempts: int = Field(default=3)
+    attempt_timeout: float = Field(default=30.0)  # Seconds per attempt
+    deadline: float = Field(default=60.0)  # Seconds for all attempts and waits together
+    base_delay: float = Field(default=1.0)
+    max_delay: float = Field(default=8.0)
+    idle_timeout: float = Field(default=30.0)  # Seconds between events once a stream started
+
+    @classmethod
+    def from_env(cls) -> 'RetryPolicy':
+        """Build a policy from the ``AGENT_RETRY_*`` environment variables."""
+        return cls(
+            max_attempts=int(os.getenv("AGENT_RETRY_MAX_ATTEMPTS", "3")),
+            attempt_timeout=float(os.getenv("AGENT_RETRY_ATTEMPT_TIMEOUT", "30")),
+            deadline=float(os.getenv("AGENT_RETRY_DEADLINE", "60")),
+            base_delay=float(os.getenv("AGENT_RETRY_BASE_DELAY", "1.0")),
+            max_delay=float(os.getenv("AGENT_RETRY_MAX_DELAY", "8.0")),
+            idle_timeout=float(os.getenv("AGENT_RETRY_IDLE_TIMEOUT", "30")),
+        )
+
+    def backoff(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        """Return the jittered delay before retry number ``attempt + 1``.
+
+        A ``retry-after`` header on the error wins over the computed delay.
+        """
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(ceiling / 2, ceiling)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when the overall retry deadline runs out."""
+
+
+def classify_error(error: BaseException) -> Optional[str]:
+    """Classify an exception from an LLM call.
+
+    Returns:
+        One of ``OVERLOADED``, ``RATE_LIMITED``, ``TIMEOUT`` or ``CONNECTION``
+        for retryable errors, otherwise None.
+    """
+    import anthropic
+
+    if isinstance(error, anthropic.RateLimitError):
+        return RATE_LIMITED
+    if isinstance(error, anthropic.APIStatusError) and error.status_code == 529:
+        return OVERLOADED
+    if isinstance(error, (anthropic.APITimeoutError, TimeoutError)):
+        return TIMEOUT
+    if isinstance(error, anthropic.APIConnectionError):
+        return CONNECTION
+    return None
+
+
+def retry_after_seconds(error: Optional[BaseException]) -> Optional[float]:
+    """Return the ``retry-after`` header of an API error in seconds, if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Return the bounded executor shared by every sync LLM call in this process."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=int(os.getenv("AGENT_EXECUTOR_WORKERS", "32")),
+                    thread_name_prefix="agent-call",
+                )
+    return _executor
+
+
+_cancelled: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar("agent_attempt_cancelled", default=None)
+
+
+def check_cancelled() -> None:
+    """Raise ``CancelledError`` if the current attempt was abandoned by ``call_with_retry``.
+
+    Call this before committing side effects so a timed-out attempt that
+    finishes late does not write state behind the retry's back.
+    """
+    event = _cancelled.get()
+    if event is not None and event.is_set():
+        raise CancelledError("Attempt was abandoned after timing out")
+
+
+@contextmanager
+def cancel_on(event: threading.Event) -> Iterator[None]:
+    """Make ``event`` the cancel event for calls made inside the block.
+
+    Once it is set, ``call_with_retry`` stops between attempts and cuts a
+    running backoff short, and ``check_cancelled`` raises.
+    """
+    token = _cancelled.set(event)
+    try:
+        yield
+    finally:
+        _cancelled.reset(token)
+
+
+def call_with_retry(fn: Callable[..., Any], *args: Any, policy: Optional[RetryPolicy] = None, **kwargs: Any) -> Any:
+    """Run ``fn`` on the shared executor with per-attempt timeouts and retries.
+
+    Args:
+        fn: Blocking callable to run.
+        policy: Retry policy; defaults to ``RetryPolicy.from_env()``.
+
+    Returns:
+        The result of ``fn``.
+
+    Raises:
+        DeadlineExceeded: If the overall deadline ran out.
+        CancelledError: If the caller's cancel event (see ``cancel_on``) was set.
+        Exception: The last error if it is not retryable or attempts ran out.
+    """
+    policy = policy or RetryPolicy.from_env()
+    deadline = time.monotonic() + policy.deadline
+    caller = _cancelled.get()
+
+    for attempt in range(policy.max_attempts):
+        check_cancelled()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded("Retry deadline exceeded")
+
+        cancelled = threading.Event()
+        context = contextvars.copy_context()
+        context.run(_cancelled.set, cancelled)
+        future = get_executor().submit(context.run, fn, *args, **kwargs)
+        try:
+            return future.result(timeout=min(policy.attempt_timeout, remaining))
+        except TimeoutError as e:
+            # Drop the attempt if still queued; a running one must not commit
+            cancelled.set()
+            future.cancel()
+            error = e
+        except Exception as e:
+            error = e
+
+        delay = _next_delay(policy, attempt, error, deadline - time.monotonic())
+        with span(RETRY_WAIT):
+            _wait(caller, delay, error)
+
+
+def stream_with_retry(fn: Callable[..., Iterator[Any]], *args: Any, policy: Optional[RetryPolicy] = None, **kwargs: Any) -> Iterator[Any]:
+    """Iterate the generator ``fn`` on the shared executor under the retry policy.
+
+    Until the first event arrives an attempt is timed out and retried like
+    a ``call_with_retry`` attempt, within the same deadline. Once an event
+    has been yielded the stream is never restarted; instead each following
+    event must arrive within ``policy.idle_timeout``.
+
+    Raises:
+        DeadlineExceeded: If the overall deadline ran out before the first event.
+        TimeoutError: If the stream stalled after its first event.
+        CancelledError: If the caller's cancel event (see ``cancel_on``) was set.
+        Exception: The last error if it is not retryable or attempts ran out.
+    """
+    policy = policy or RetryPolicy.from_env()
+    deadline = time.monotonic() + policy.deadline
+    caller = _cancelled.get()
+
+    for attempt in range(policy.max_attempts):
+        check_cancelled()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded("Retry deadline exceeded")
+
+        cancelled = threading.Event()
+        events: "queue.Queue[tuple]" = queue.Queue()
+        context = contextvars.copy_context()
+        context.run(_cancelled.set, cancelled)
+        get_executor().submit(context.run, _produce, fn, args, kwargs, events, cancelled)
+        try:
+            first = _next_event(events, min(policy.attempt_timeout, remaining))
+        except Exception as e:
+            cancelled.set()
+            error = e
+        else:
+            try:
+                event = first
+                while event is not _END:
+                    yield event
+                    event = _next_event(events, policy.idle_timeout)
+                return
+            finally:
+                # Stop the producer at its next event if the consumer went away
+                cancelled.set()
+
+        delay = _next_delay(policy, attempt, error, deadline - time.monotonic())
+        with span(RETRY_WAIT):
+            _wait(caller, delay, error)
+
+
+async def acall_with_retry(fn: Callable[..., Awaitable[Any]], *args: Any, policy: Optional[RetryPolicy] = None, **kwargs: Any) -> Any:
+    """Async variant of ``call_with_retry``.
+
+    Timed-out attempts are cancelled outright and backoff waits yield to the
+    event loop, so a retrying request does not hold a worker.
+    """
+    policy = policy or RetryPolicy.from_env()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + policy.deadline
+
+    for attempt in range(policy.max_attempts):
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise DeadlineExceeded("Retry deadline exceeded")
+
+        try:
+            return await asyncio.wait_for(fn(*args, **kwargs), timeout=min(policy.attempt_timeout, remaining))
+        except Exception as e:
+            error = e
+
+        delay = _next_delay(policy, attempt, error, deadline - loop.time())
+        with span(RETRY_WAIT):
+            await asyncio.sleep(delay)
+
+
+async def astream_with_retry(fn: Callable[..., AsyncIterator[Any]], *args: Any, policy: Optional[RetryPolicy] = None, **kwargs: Any) -> AsyncIterator[Any]:
+    """Async variant of ``stream_with_retry``; a timed-out generator is closed outright."""
+    policy = policy or RetryPolicy.from_env()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + policy.deadline
+
+    for attempt in range(policy.max_attempts):
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise DeadlineExceeded("Retry deadline exceeded")
+
+        events = fn(*args, **kwargs)
+        try:
+            try:
+                event = await asyncio.wait_for(anext(events), timeout=min(policy.attempt_timeout, remaining))
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                error = e
+            else:
+                while True:
+                    yield event
+                    try:
+                        event = await asyncio.wait_for(anext(events), timeout=policy.idle_timeout)
+                    except StopAsyncIteration:
+                        return
+                    except TimeoutError:
+                        raise TimeoutError(f"Stream stalled for {policy.idle_timeout}s") from None
+        finally:
+            await events.aclose()
+
+        delay = _next_delay(policy, attempt, error, deadline - loop.time())
+        with span(RETRY_WAIT):
+            await asyncio.sleep(delay)
+
+
+def _next_delay(policy: RetryPolicy, attempt: int, error: Exception, time_left: float) -> float:
+    """Return the backoff before the next attempt, or raise if ``error`` ends the call."""
+    kind = classify_error(error)
+    if kind is None or attempt == policy.max_attempts - 1:
+        raise error
+    delay = policy.backoff(attempt, error)
+    if delay >= time_left:
+        raise DeadlineExceeded("Retry deadline exceeded") from error
+    logger.warning(f"LLM call failed ({kind}), retrying in {delay:.2f}s (attempt {attempt + 1}/{policy.max_attempts})")
+    _hold_admission(kind, delay)
+    return delay
+
+
+def _wait(caller: Optional[threading.Event], delay: float, error: Exception) -> None:
+    """Sleep through a backoff, waking early if the caller's cancel event is set."""
+    if caller is None:
+        time.sleep(delay)
+    elif caller.wait(delay):
+        raise CancelledError("Call was abandoned during backoff") from error
+
+
+# Markers for what _produce hands to the consuming thread
+_EVENT = "event"
+_ERROR = "error"
+_END = object()
+
+
+def _produce(fn: Callable[..., Iterator[Any]], args: tuple, kwargs: dict, events: queue.Queue, cancelled: threading.Event) -> None:
+    try:
+        generator = fn(*args, **kwargs)
+        try:
+            for event in generator:
+                if cancelled.is_set():
+                    return
+                events.put((_EVENT, event))
+        finally:
+            close = getattr(generator, "close", None)
+            if close is not None:
+                close()
+    except BaseException as e:
+        events.put((_ERROR, e))
+        return
+    events.put((_EVENT, _END))
+
+
+def _next_event(events: queue.Queue, timeout: float) -> Any:
+    try:
+        kind, value = events.get(timeout=timeout)
+    except queue.Empty:
+        raise TimeoutError(f"Stream stalled for {timeout}s") from None
+    if kind == _ERROR:
+        raise value
+    return value
+
+
+def _hold_admission(kind: str, delay: float) -> None:
+    """Stop admitting new calls while the API is overloaded or rate limiting us."""
+    if kind in (OVERLOADED, RATE_LIMITED):
+        from agent.admission import get_admission
+
+        get_admission().pause(delay)
+
+
+def _reset_after_fork() -> None:
+    global _executor
+    _executor = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
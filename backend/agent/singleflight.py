@@ -0,0 +1,364 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractAsyncContextManager, AbstractContextManager, AsyncExitStack, ExitStack, aclosing
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+from agent.retry import astream_with_retry, stream_with_retry
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(thread_id: str, messages: List[Dict[str, str]], turn_cursor: Optional[int] = None, language: Optional[str] = None) -> str:
+    """Return the key under which identical chat requests are coalesced."""
+    payload = json.dumps([thread_id, messages, turn_cursor, language], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _Broadcast:
+    """Buffered event stream that any number of subscribers replay from the start."""
+
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.abandoned = False
+        self._cond = threading.Condition()
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        with self._cond:
+            self.events.append(event)
+            self._cond.notify_all()
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        with self._cond:
+            self.finished = True
+            self.error = error
+            self._cond.notify_all()
+
+    def subscribe(self) -> Iterator[Dict[str, Any]]:
+        seen = 0
+        while True:
+            with self._cond:
+                while seen == len(self.events) and not self.finished:
+                    self._cond.wait()
+                batch = self.events[seen:]
+                finished = self.finished and seen + len(batch) == len(self.events)
+            seen += len(batch)
+            for event in batch:
+                yield dict(event)
+            if finished:
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class _AsyncBroadcast:
+    """Event-loop counterpart of ``_Broadcast``."""
+
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self._start: Optional[Callable[[], Any]] = None
+
+    def start_with(self, start: Callable[[], Any]) -> None:
+        """Have the first subscriber to iterate call ``start``.
+
+        The producer then runs in the context serving the response rather
+        than the view's, whose ``sync_to_async`` executor stops when the
+        view returns.
+        """
+        self._start = start
+        self._notify()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        self.events.append(event)
+        self._notify()
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        self.finished = True
+        self.error = error
+        self._notify()
+
+    async def subscribe(self) -> AsyncIterator[Dict[str, Any]]:
+        seen = 0
+        while True:
+            if self._start is not None:
+                start, self._start = self._start, None
+                start()
+            if seen == len(self.events) and not self.finished:
+                await self._changed.wait()
+                continue
+            batch = self.events[seen:]
+            seen += len(batch)
+            for event in batch:
+                yield dict(event)
+            if self.finished and seen == len(self.events):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class SingleFlight:
+    """Coalesces identical in-flight chat requests onto one generation.
+
+    The first request for a key runs the call; identical requests arriving
+    while it is in flight wait for it and share its result, error or event
+    stream instead of spending tokens on a duplicate. Requests for the same
+    thread with different payloads are already serialized by the thread's
+    store session.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _Broadcast] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._astreams: Dict[str, _AsyncBroadcast] = {}
+        self._pump_pool: Optional[ThreadPoolExecutor] = None
+
+    def do(self, key: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run ``fn`` once for all concurrent callers with the same ``key``.
+
+        Returns:
+            The shared result of ``fn``.
+
+        Raises:
+            Exception: The shared error of ``fn``.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            logger.info(f"Joined in-flight request {key[:12]}")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stream(
+        self,
+        key: str,
+        fn: Callable[..., Iterator[Dict[str, Any]]],
+        *args: Any,
+        admit: Optional[Callable[[], AbstractContextManager]] = None,
+        **kwargs: Any,
+    ) -> Iterator[Dict[str, Any]]:
+        """Share one run of the event generator ``fn`` between concurrent callers.
+
+        The generator is drained on a pool of its own, so the generation
+        (and its commit) completes while any caller is still listening, even
+        if the client that started it disconnects. It runs under
+        ``stream_with_retry``, so the first event is retried within the
+        deadline and a stalled stream fails after the idle timeout. Every
+        caller receives all events from the first one; once the last caller
+        that started iterating goes away the generator is closed at its next
+        event, and one whose iterator is never read does not keep it alive.
+
+        Only the caller that starts the generation enters ``admit()``; the
+        context is held until the generation ends, and an error entering it
+        is raised here, before anything is streamed.
+        """
+        with self._lock:
+            broadcast = self._streams.get(key)
+            leader = broadcast is None
+            if leader:
+                broadcast = self._streams[key] = _Broadcast()
+        if not leader:
+            logger.info(f"Joined in-flight stream {key[:12]}")
+            return self._subscribe(key, broadcast)
+
+        stack = ExitStack()
+        try:
+            if admit is not None:
+                stack.enter_context(admit())
+        except BaseException as e:
+            with self._lock:
+                del self._streams[key]
+            broadcast.close(e)
+            raise
+        self._pumps().submit(self._pump, key, broadcast, stack, fn, args, kwargs)
+        return self._subscribe(key, broadcast)
+
+    def _pumps(self) -> ThreadPoolExecutor:
+        if self._pump_pool is None:
+            with self._lock:
+                if self._pump_pool is None:
+                    self._pump_pool = ThreadPoolExecutor(
+                        max_workers=int(os.getenv("AGENT_STREAM_WORKERS", "16")),
+                        thread_name_prefix="agent-stream",
+                    )
+        return self._pump_pool
+
+    def _subscribe(self, key: str, broadcast: _Broadcast) -> Iterator[Dict[str, Any]]:
+        # Count the subscriber only once it iterates: the finally below never
+        # runs for a generator that is dropped before its first ``next``
+        with self._lock:
+            broadcast.subscribers += 1
+        try:
+            yield from broadcast.subscribe()
+        finally:
+            with self._lock:
+                broadcast.subscribers -= 1
+                if broadcast.subscribers == 0 and not broadcast.finished:
+                    # Nobody is listening; new requests start a fresh generation
+                    broadcast.abandoned = True
+                    if self._streams.get(key) is broadcast:
+                        del self._streams[key]
+
+    def _pump(self, key: str, broadcast: _Broadcast, stack: ExitStack, fn: Callable[..., Iterator[Dict[str, Any]]], args: tuple, kwargs: dict) -> None:
+        error = None
+        try:
+            with stack:
+                events = stream_with_retry(fn, *args, **kwargs)
+                try:
+                    for event in events:
+                        if broadcast.abandoned:
+                            logger.info(f"Stopped stream {key[:12]}: no subscribers left")
+                            break
+                        broadcast.publish(event)
+                finally:
+                    events.close()
+        except BaseException as e:
+            error = e
+        finally:
+            with self._lock:
+                if self._streams.get(key) is broadcast:
+                    del self._streams[key]
+            broadcast.close(error)
+
+    async def ado(self, key: str, fn: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        """Async variant of ``do``.
+
+        The call runs as a task shielded from each caller's cancellation, so
+        a disconnecting client does not abort the generation for the others.
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._finish_task(key, done))
+        else:
+            logger.info(f"Joined in-flight request {key[:12]}")
+        return await asyncio.shield(task)
+
+    def _finish_task(self, key: str, task: asyncio.Task) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Mark the error as retrieved in case every caller went away
+        if not task.cancelled():
+            task.exception()
+
+    async def astream(
+        self,
+        key: str,
+        fn: Callable[..., AsyncIterator[Dict[str, Any]]],
+        *args: Any,
+        admit: Optional[Callable[[], AbstractAsyncContextManager]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Async variant of ``stream``; the generator is drained by a task under ``astream_with_retry``."""
+        broadcast = self._astreams.get(key)
+        if broadcast is not None:
+            logger.info(f"Joined in-flight stream {key[:12]}")
+            return self._asubscribe(key, broadcast)
+
+        broadcast = self._astreams[key] = _AsyncBroadcast()
+        stack = AsyncExitStack()
+        try:
+            if admit is not None:
+                await stack.enter_async_context(admit())
+        except BaseException as e:
+            if self._astreams.get(key) is broadcast:
+                del self._astreams[key]
+            broadcast.close(e)
+            raise
+        broadcast.start_with(lambda: self._astart(key, broadcast, stack, fn, args, kwargs))
+        return self._asubscribe(key, broadcast)
+
+    def _astart(self, key: str, broadcast: _AsyncBroadcast, stack: AsyncExitStack, fn: Callable[..., AsyncIterator[Dict[str, Any]]], args: tuple, kwargs: dict) -> None:
+        broadcast.task = asyncio.ensure_future(self._apump(key, broadcast, stack, fn, args, kwargs))
+
+    async def _asubscribe(self, key: str, broadcast: _AsyncBroadcast) -> AsyncIterator[Dict[str, Any]]:
+        broadcast.subscribers += 1
+        try:
+            async for event in broadcast.subscribe():
+                yield event
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.finished:
+                if self._astreams.get(key) is broadcast:
+                    del self._astreams[key]
+                if broadcast.task is not None:
+                    logger.info(f"Stopped stream {key[:12]}: no subscribers left")
+                    broadcast.task.cancel()
+
+    async def _apump(self, key: str, broadcast: _AsyncBroadcast, stack: AsyncExitStack, fn: Callable[..., AsyncIterator[Dict[str, Any]]], args: tuple, kwargs: dict) -> None:
+        error = None
+        try:
+            async with stack, aclosing(astream_with_retry(fn, *args, **kwargs)) as events:
+                async for event in events:
+                    broadcast.publish(event)
+        except BaseException as e:
+            error = e
+        finally:
+            if self._astreams.get(key) is broadcast:
+                del self._astreams[key]
+            broadcast.close(error)
+
+
+_single_flight: Optional[SingleFlight] = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    """Return the request coalescer for this process, creating it on first use."""
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight()
+    return _single_flight
+
+
+def _reset_after_fork() -> None:
+    global _single_flight
+    _single_flight = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
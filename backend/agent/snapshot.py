@@ -0,0 +1,143 @@
+"""
+Encoding and deltas for ``ModelContextProtocol.snapshot()`` output.
+
+A delta records one write's changes against the previous snapshot: new
+messages in full, the window and evicted backlog as sequence numbers, and
+only the facts and access times that changed. Memory keeps both in update
+order with running counts, so finding them costs nothing per unchanged
+fact. Applying each delta in order to the last full snapshot rebuilds the
+current one.
+"""
+import itertools
+from typing import Any, Dict, List, Optional
+import orjson
+from agent.mcp import SNAPSHOT_VERSION
+
+
+def encode(data: Dict[str, Any]) -> bytes:
+    """Serialize a snapshot or delta."""
+    return orjson.dumps(data)
+
+
+def decode(raw: bytes) -> Dict[str, Any]:
+    """Deserialize ``encode`` output."""
+    return orjson.loads(raw)
+
+
+def _recent(entries: Dict[str, Any], count: int) -> List[str]:
+    """Return the last ``count`` keys of an ordered dict, oldest first."""
+    keys = list(itertools.islice(reversed(entries), count))
+    keys.reverse()
+    return keys
+
+
+def diff(base: Dict[str, Any], current: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Return a delta that turns snapshot ``base`` into ``current``.
+
+    Returns None when a delta would not be smaller than a full snapshot:
+    different rules, thread or window settings, or a rewound cursor.
+    """
+    base_window, window = base["window"], current["window"]
+    if (
+        base.get("v") != SNAPSHOT_VERSION
+        or base["thread_id"] != current["thread_id"]
+        or base["rules"] != current["rules"]
+        or base["cursor"] > current["cursor"]
+        or base_window["max_size"] != window["max_size"]
+        or base_window["max_evicted"] != window["max_evicted"]
+    ):
+        return None
+    base_memory, memory = base["memory"], current["memory"]
+    if base_memory["half_life"] != memory["half_life"]:
+        return None
+    # Facts and access times are kept in update order with running counts, so only the tails changed
+    writes = memory["writes"] - base_memory["writes"]
+    reads = memory["reads"] - base_memory["reads"]
+    if writes < 0 or reads < 0:
+        return None
+    base_facts, facts = base_memory["facts"], memory["facts"]
+    changed = _recent(facts, writes)
+    if len(changed) > len(facts) // 2 + 1:
+        return None
+    if len(facts) != len(base_facts) + sum(key not in base_facts for key in changed):
+        return None  # A fact was removed without going through Memory
+
+    known = {entry[0] for entry in base_window["messages"]}
+    known.update(entry[0] for entry in base_window["evicted"])
+    append = [[seq, message] for seq, _, message in window["messages"] if seq not in known]
+    append.extend([seq, message] for seq, message in window["evicted"] if seq not in known)
+    accessed = memory["accessed"]
+    delta = {
+        "v": SNAPSHOT_VERSION,
+        "base": base["cursor"],
+        "cursor": current["cursor"],
+        "state": current["state"],
+        "next_seq": window["next_seq"],
+        "append": append,
+        "window": [[seq, score] for seq, score, _ in window["messages"]],
+        "evicted": [seq for seq, _ in window["evicted"]],
+        "facts": [[key, facts[key], memory["relevance"].get(key)] for key in changed],
+        "accessed": [[key, accessed[key]] for key in _recent(accessed, reads)],
+        "last_accessed": memory["last_accessed"],
+        "writes": memory["writes"],
+        "reads": memory["reads"],
+    }
+    if window["summary"] != base_window["summary"]:
+        delta["summary"] = window["summary"]
+    if memory["preferences"] != base_memory["preferences"]:
+        delta["preferences"] = memory["preferences"]
+    return delta
+
+
+def apply(base: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the snapshot produced by applying ``delta`` to ``base``; ``base`` is left unchanged.
+
+    Raises:
+        ValueError: If the delta was written against a different snapshot.
+    """
+    if delta["base"] != base["cursor"]:
+        raise ValueError(f"delta for cursor {delta['base']} does not apply to cursor {base['cursor']}")
+    base_window, base_memory = base["window"], base["memory"]
+    pool = {seq: message for seq, _, message in base_window["messages"]}
+    pool.update((seq, message) for seq, message in base_window["evicted"])
+    pool.update((seq, message) for seq, message in delta["append"])
+    try:
+        messages = [[seq, score, pool[seq]] for seq, score in delta["window"]]
+        evicted = [[seq, pool[seq]] for seq in delta["evicted"]]
+    except KeyError as e:
+        raise ValueError(f"delta references unknown message {e}") from None
+
+    facts = dict(base_memory["facts"])
+    relevance = dict(base_memory["relevance"])
+    for key, value, score in delta["facts"]:
+        facts.pop(key, None)
+        facts[key] = value
+        if score is not None:
+            relevance[key] = score
+    accessed = dict(base_memory["accessed"])
+    for key, timestamp in delta["accessed"]:
+        # Re-insert so the result keeps the access order the next delta relies on
+        accessed.pop(key, None)
+        accessed[key] = timestamp
+    return {
+        **base,
+        "state": delta["state"],
+        "cursor": delta["cursor"],
+        "window": {
+            **base_window,
+            "summary": delta.get("summary", base_window["summary"]),
+            "next_seq": delta["next_seq"],
+            "messages": messages,
+            "evicted": evicted,
+        },
+        "memory": {
+            **base_memory,
+            "facts": facts,
+            "preferences": delta.get("preferences", base_memory["preferences"]),
+            "last_accessed": delta["last_accessed"],
+            "relevance": relevance,
+            "accessed": accessed,
+            "writes": delta["writes"],
+            "reads": delta["reads"],
+        },
+    }
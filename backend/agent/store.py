@@ -0,0 +1,480 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple
+from asgiref.sync import sync_to_async
+from agent import snapshot as codec
+from agent.character import AGENT_CHARACTER_PROMPT
+from agent.mcp import ModelContextProtocol
+from agent.message import Message
+from agent.metrics import STORE_FLUSH, span
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseBackend:
+    """Persists MCP snapshots in the ``agent.Conversation`` table.
+
+    Each thread has one full snapshot plus the deltas written since, so a
+    turn only writes its new messages and changed facts. The backend keeps
+    the last snapshot it read or wrote for up to ``capacity`` threads to diff
+    against; other threads, and every ``compact_every``-th write, get a full
+    snapshot that replaces the deltas.
+
+    Every write bumps the row's ``version`` with a compare-and-set against
+    the version the writer's state was loaded at, so a worker holding an
+    outdated copy of a thread cannot overwrite turns another worker wrote.
+    """
+
+    def __init__(self, compact_every: int = 20, capacity: int = 256):
+        self.compact_every = compact_every
+        self.capacity = max(1, capacity)
+        self._baselines: "OrderedDict[str, Tuple[Dict[str, Any], int, int]]" = OrderedDict()  # Thread -> (snapshot, deltas, version)
+        self._lock = threading.Lock()
+
+    def _remember(self, thread_id: str, snapshot: Dict[str, Any], deltas: int, version: int) -> None:
+        with self._lock:
+            self._baselines[thread_id] = (snapshot, deltas, version)
+            self._baselines.move_to_end(thread_id)
+            while len(self._baselines) > self.capacity:
+                self._baselines.popitem(last=False)
+
+    def _forget(self, thread_id: str) -> None:
+        with self._lock:
+            self._baselines.pop(thread_id, None)
+
+    def version(self, thread_id: str) -> int:
+        """Return the stored version of a thread, or 0 if it has no row."""
+        from agent.models import Conversation
+
+        return Conversation.objects.filter(thread_id=thread_id).values_list("version", flat=True).first() or 0
+
+    def load(self, thread_id: str) -> Tuple[Optional[Dict[str, Any]], int]:
+        """Return the stored snapshot for a thread with its deltas applied, and its version.
+
+        Threads without a row return ``(None, 0)``.
+        """
+        from agent.models import Conversation, ConversationDelta
+
+        row = Conversation.objects.filter(thread_id=thread_id).values_list("snapshot", "version").first()
+        if row is None:
+            return None, 0
+        raw, version = row
+        data = codec.decode(raw)
+        applied = 0
+        payloads = ConversationDelta.objects.filter(thread_id=thread_id).order_by("id").values_list("payload", flat=True)
+        for payload in payloads:
+            try:
+                data = codec.apply(data, codec.decode(payload))
+            except ValueError as e:
+                # Another worker wrote from an older baseline; compact on the next write
+                logger.warning(f"Ignoring conflicting deltas for conversation {thread_id}: {str(e)}")
+                applied = self.compact_every
+                break
+            applied += 1
+        self._remember(thread_id, data, applied, version)
+        return data, version
+
+    def save_many(self, snapshots: Dict[str, Tuple[Dict[str, Any], int]]) -> Set[str]:
+        """Write a batch of snapshots, as deltas where possible.
+
+        Args:
+            snapshots: Thread ID -> (snapshot, version the snapshot was built
+                on; 0 for a thread without a row).
+
+        Returns:
+            The threads that were not written because their row has moved
+            past the given version.
+        """
+        from django.db import IntegrityError, close_old_connections, transaction
+        from django.utils import timezone
+        from agent.models import Conversation, ConversationDelta
+
+        close_old_connections()
+        written = {}
+        conflicts = set()
+        with transaction.atomic():
+            for thread_id, (snapshot, version) in snapshots.items():
+                with self._lock:
+                    baseline = self._baselines.get(thread_id)
+                delta = None
+                if baseline is not None and baseline[2] == version and baseline[1] < self.compact_every:
+                    delta = codec.diff(baseline[0], snapshot)
+                if version == 0:
+                    try:
+                        with transaction.atomic():
+                            Conversation.objects.create(thread_id=thread_id, snapshot=codec.encode(snapshot))
+                    except IntegrityError:
+                        conflicts.add(thread_id)
+                        continue
+                    written[thread_id] = (snapshot, 0)
+                    continue
+                rows = Conversation.objects.filter(thread_id=thread_id, version=version)
+                if delta is None:
+                    updated = rows.update(snapshot=codec.encode(snapshot), version=version + 1, updated_at=timezone.now())
+                    if updated:
+                        ConversationDelta.objects.filter(thread_id=thread_id).delete()
+                        written[thread_id] = (snapshot, 0)
+                elif rows.update(version=version + 1, updated_at=timezone.now()):
+                    ConversationDelta.objects.create(thread_id=thread_id, payload=codec.encode(delta))
+                    written[thread_id] = (snapshot, baseline[1] + 1)
+                if thread_id not in written:
+                    conflicts.add(thread_id)
+        for thread_id in conflicts:
+            self._forget(thread_id)
+        # Only advance the baselines once the transaction committed
+        for thread_id, (snapshot, deltas) in written.items():
+            self._remember(thread_id, snapshot, deltas, snapshots[thread_id][1] + 1)
+        return conflicts
+
+
+class _Entry:
+    __slots__ = ("mcp", "version", "seq", "lock", "users", "stale", "fresh", "replayed")
+
+    def __init__(self, mcp: ModelContextProtocol, version: int):
+        self.mcp = mcp
+        self.version = version  # Row version once every scheduled write has landed
+        self.seq = mcp.context_window.next_seq  # First message not yet part of a scheduled write
+        self.lock = threading.Lock()
+        self.users = 0
+        self.stale = False
+        self.fresh = True  # Just loaded, so no need to check the row's version
+        self.replayed: Optional[List[Message]] = None  # Rejected turns re-applied in the current session
+
+
+class ConversationStore:
+    """Bounded per-thread store of ModelContextProtocol objects.
+
+    Live conversations are kept in an LRU of at most ``capacity`` entries.
+    Changes are written behind to ``backend`` by a background flusher, and
+    evicted threads are rehydrated lazily through ``ModelContextProtocol.from_snapshot``.
+
+    Other workers may write the same thread. A session reloads a cached
+    thread whose stored version has moved on before handing it out, and if
+    the backend still rejects a write because another worker wrote first,
+    the rejected turns are re-applied on top of the stored state and
+    written again.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 256,
+        flush_interval: float = 2.0,
+        backend: Optional[Any] = None,
+        system_prompt: str = AGENT_CHARACTER_PROMPT,
+    ):
+        self.capacity = max(1, capacity)
+        self.flush_interval = flush_interval
+        self.backend = backend
+        self.system_prompt = system_prompt
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._inflight: Dict[str, Dict[str, Any]] = {}
+        self._replays: Dict[str, List[Message]] = {}  # Turns of rejected writes, re-applied by the next session
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+    @contextmanager
+    def session(self, thread_id: str) -> Iterator[ModelContextProtocol]:
+        """Check out a thread's MCP for exclusive use.
+
+        Callers for the same thread are serialized. A cached thread is
+        reloaded first if another worker has written it since. On a clean exit
+        the new state is scheduled for persistence; if the body raises, the
+        in-memory state is discarded so the next caller starts from the last
+        good snapshot.
+
+        Args:
+            thread_id: Unique identifier for the conversation thread.
+
+        Yields:
+            The thread's ModelContextProtocol.
+        """
+        while True:
+            entry = self._checkout(thread_id)
+            try:
+                with entry.lock:
+                    if entry.stale:
+                        continue
+                    if self._should_check(thread_id, entry):
+                        self._reload_if_moved(thread_id, entry)
+                    self._apply_replays(thread_id, entry)
+                    try:
+                        yield entry.mcp
+                    except BaseException:
+                        self._discard(thread_id, entry)
+                        raise
+                    self._schedule_write(thread_id, entry)
+                    return
+            finally:
+                with self._lock:
+                    entry.users -= 1
+                    self._evict()
+
+    @asynccontextmanager
+    async def asession(self, thread_id: str) -> AsyncIterator[ModelContextProtocol]:
+        """Async variant of ``session`` that never blocks the event loop.
+
+        Cache misses and version checks run in Django's sync thread and the
+        per-thread lock is polled, so waiting callers can be cancelled safely.
+        """
+        while True:
+            entry = self._checkout_cached(thread_id)
+            if entry is None:
+                entry = await sync_to_async(self._checkout)(thread_id)
+            try:
+                delay = 0.005
+                while not entry.lock.acquire(blocking=False):
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 0.05)
+                try:
+                    if entry.stale:
+                        continue
+                    if self._should_check(thread_id, entry):
+                        await sync_to_async(self._reload_if_moved)(thread_id, entry)
+                    self._apply_replays(thread_id, entry)
+                    try:
+                        yield entry.mcp
+                    except BaseException:
+                        self._discard(thread_id, entry)
+                        raise
+                    self._schedule_write(thread_id, entry)
+                    return
+                finally:
+                    entry.lock.release()
+            finally:
+                with self._lock:
+                    entry.users -= 1
+                    self._evict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def backlog(self) -> int:
+        """Return the number of conversations waiting to be written."""
+        with self._lock:
+            return len(self._pending) + len(self._inflight)
+
+    def _checkout_cached(self, thread_id: str) -> Optional[_Entry]:
+        with self._lock:
+            entry = self._entries.get(thread_id)
+            if entry is not None:
+                self._entries.move_to_end(thread_id)
+                entry.users += 1
+            return entry
+
+    def _checkout(self, thread_id: str) -> _Entry:
+        entry = self._checkout_cached(thread_id)
+        if entry is not None:
+            return entry
+
+        mcp, version = self._load(thread_id)
+
+        with self._lock:
+            entry = self._entries.get(thread_id)
+            if entry is None:
+                entry = _Entry(mcp, version)
+                self._entries[thread_id] = entry
+            else:
+                self._entries.move_to_end(thread_id)
+            entry.users += 1
+            self._evict()
+            return entry
+
+    def _evict(self) -> None:
+        """Drop least recently used idle entries until the store fits. Caller holds ``_lock``."""
+        if len(self._entries) <= self.capacity:
+            return
+        for thread_id in list(self._entries):
+            if len(self._entries) <= self.capacity:
+                break
+            if self._entries[thread_id].users == 0:
+                del self._entries[thread_id]
+
+    def _discard(self, thread_id: str, entry: _Entry) -> None:
+        with self._lock:
+            entry.stale = True
+            if self._entries.get(thread_id) is entry:
+                del self._entries[thread_id]
+            if entry.replayed:
+                # The failed turn is dropped, but the re-applied ones still need writing
+                self._replays[thread_id] = entry.replayed + self._replays.get(thread_id, [])
+
+    def _should_check(self, thread_id: str, entry: _Entry) -> bool:
+        """Whether a cached entry's row version needs checking. Caller holds ``entry.lock``."""
+        fresh, entry.fresh = entry.fresh, False
+        if self.backend is None or fresh:
+            return False
+        with self._lock:
+            # With writes of our own still queued a newer row means a conflict, which the flusher resolves
+            return thread_id not in self._pending and thread_id not in self._inflight
+
+    def _reload_if_moved(self, thread_id: str, entry: _Entry) -> None:
+        """Reload a cached thread if another worker has written it. Caller holds ``entry.lock``."""
+        try:
+            version = self.backend.version(thread_id)
+        except Exception as e:
+            logger.warning(f"Failed to check conversation {thread_id}: {str(e)}")
+            return
+        if version == entry.version:
+            return
+        logger.info(f"Conversation {thread_id} is at version {version} after another worker wrote it; reloading it")
+        entry.mcp, entry.version = self._load(thread_id)
+        entry.seq = entry.mcp.context_window.next_seq
+
+    def _apply_replays(self, thread_id: str, entry: _Entry) -> None:
+        """Re-apply turns whose write was rejected. Caller holds ``entry.lock``."""
+        with self._lock:
+            turns = self._replays.pop(thread_id, None)
+        entry.replayed = turns
+        if turns:
+            logger.info(f"Re-applying {len(turns)} message(s) to conversation {thread_id}")
+            for message in turns:
+                entry.mcp.ingest_message(message)
+
+    def _load(self, thread_id: str) -> Tuple[ModelContextProtocol, int]:
+        data, version = None, 0
+        with self._lock:
+            record = self._pending.get(thread_id) or self._inflight.get(thread_id)
+        if record is not None:
+            data, version = record[0], record[1] + 1
+        elif self.backend is not None:
+            try:
+                data, version = self.backend.load(thread_id)
+            except Exception as e:
+                logger.warning(f"Failed to load conversation {thread_id}: {str(e)}")
+        if not data:
+            return ModelContextProtocol(system_prompt=self.system_prompt, thread_id=thread_id), version
+        return ModelContextProtocol.from_snapshot(data, system_prompt=self.system_prompt), version
+
+    def _schedule_write(self, thread_id: str, entry: _Entry) -> None:
+        entry.replayed = None
+        if self.backend is None:
+            return
+        # Snapshots copy every container and share only the never-mutated message dicts
+        snapshot = entry.mcp.snapshot()
+        # Kept with the write so they can be re-applied if another worker wrote the thread first
+        turns = entry.mcp.context_window.messages_since(entry.seq)
+        entry.seq = entry.mcp.context_window.next_seq
+        with self._lock:
+            if entry.stale:
+                # Another worker's write won; the next session re-applies this turn
+                self._replays.setdefault(thread_id, []).extend(turns)
+                return
+            pending = self._pending.get(thread_id)
+            if pending is None:
+                # Written on the version the entry was at; the write moves the row one on
+                self._pending[thread_id] = (snapshot, entry.version, turns)
+                entry.version += 1
+            else:
+                self._pending[thread_id] = (snapshot, pending[1], pending[2] + turns)
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher, name="conversation-store-flusher", daemon=True)
+                self._flusher.start()
+
+    def flush(self) -> None:
+        """Write every pending snapshot to the backend now.
+
+        Threads whose write was rejected get their turns re-applied to the
+        stored state; that write goes out with the next flush.
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            self._inflight.update(batch)
+        conflicts = set()
+        try:
+            with span(STORE_FLUSH):
+                conflicts = self.backend.save_many({thread_id: record[:2] for thread_id, record in batch.items()})
+        except Exception as e:
+            logger.error(f"Failed to persist {len(batch)} conversation(s): {str(e)}")
+            with self._lock:
+                # Keep newer snapshots that arrived while we were writing
+                for thread_id, record in batch.items():
+                    pending = self._pending.get(thread_id)
+                    if pending is None:
+                        self._pending[thread_id] = record
+                        continue
+                    # The newer snapshot now goes out as the one write on the old version
+                    self._pending[thread_id] = (pending[0], record[1], record[2] + pending[2])
+                    entry = self._entries.get(thread_id)
+                    if entry is not None:
+                        entry.version -= 1
+        else:
+            for thread_id in conflicts:
+                self._invalidate(thread_id, batch[thread_id][2])
+        finally:
+            with self._lock:
+                for thread_id, record in batch.items():
+                    if self._inflight.get(thread_id) is record:
+                        del self._inflight[thread_id]
+        for thread_id in conflicts:
+            self._reapply(thread_id)
+
+    def _invalidate(self, thread_id: str, turns: List[Message]) -> None:
+        """Drop this worker's copy of a thread another worker wrote first, keeping its turns."""
+        logger.warning(f"Conversation {thread_id} was written by another worker; re-applying {len(turns)} message(s)")
+        with self._lock:
+            # Later snapshots build on the rejected one and would be rejected too; keep only their turns
+            pending = self._pending.pop(thread_id, None)
+            self._inflight.pop(thread_id, None)
+            replays = turns + (pending[2] if pending is not None else [])
+            self._replays[thread_id] = replays + self._replays.get(thread_id, [])
+            entry = self._entries.pop(thread_id, None)
+            if entry is not None:
+                entry.stale = True
+
+    def _reapply(self, thread_id: str) -> None:
+        """Re-apply a thread's rejected turns now instead of waiting for its next request."""
+        try:
+            with self.session(thread_id):
+                pass
+        except Exception as e:
+            logger.error(f"Failed to re-apply turns to conversation {thread_id}: {str(e)}")
+
+    def _run_flusher(self) -> None:
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+_store: Optional[ConversationStore] = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> ConversationStore:
+    """Return the conversation store for this process, creating it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                persist = os.getenv("AGENT_STORE_PERSIST", "true").lower() == "true"
+                capacity = int(os.getenv("AGENT_STORE_CAPACITY", "256"))
+                backend = None
+                if persist:
+                    backend = DatabaseBackend(
+                        compact_every=int(os.getenv("AGENT_STORE_COMPACT_EVERY", "20")),
+                        capacity=capacity,
+                    )
+                _store = ConversationStore(
+                    capacity=capacity,
+                    flush_interval=float(os.getenv("AGENT_STORE_FLUSH_INTERVAL", "2.0")),
+                    backend=backend,
+                )
+                atexit.register(_store.flush)
+    return _store
+
+
+def _reset_after_fork() -> None:
+    global _store
+    _store = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
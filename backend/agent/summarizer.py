@@ -0,0 +1,114 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from agent.mcp import ContextWindow
+from agent.message import Message
+from agent.pool import get_model
+from agent.store import ConversationStore, get_store
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = '''You maintain a running summary of a conversation between a user and Yoko, an AI assistant.
+Update the summary with the new messages below. Keep names, facts, preferences, open questions and decisions.
+Write at most {max_words} words, in the language of the conversation. Reply with the summary only.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}'''
+
+
+class Summarizer:
+    """Folds evicted context-window messages into a rolling per-thread summary.
+
+    Summaries are produced by a cheap model on a small background pool, so
+    the request that evicted the messages never waits for them. The result
+    is written back through the conversation store and persisted with the
+    rest of the thread's state.
+    """
+
+    def __init__(
+        self,
+        store: ConversationStore,
+        model: str = "anthropic:claude-3-5-haiku-latest",
+        min_batch: int = 4,
+        max_words: int = 200,
+        max_workers: int = 2,
+    ):
+        self.store = store
+        self.model = model
+        self.min_batch = min_batch
+        self.max_words = max_words
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarizer")
+        self._running: set = set()
+        self._lock = threading.Lock()
+
+    def maybe_schedule(self, thread_id: str, window: ContextWindow) -> bool:
+        """Queue a summary update if enough messages were evicted.
+
+        Call this while holding the thread's store session.
+
+        Returns:
+            True if an update was scheduled.
+        """
+        if len(window.evicted) < self.min_batch:
+            return False
+        with self._lock:
+            if thread_id in self._running:
+                return False
+            self._running.add(thread_id)
+        self._executor.submit(self._run, thread_id, window.summary, window.evicted_entries())
+        return True
+
+    def summarize(self, summary: Optional[str], messages: List[Dict[str, str]]) -> str:
+        """Return ``summary`` updated with ``messages``."""
+        prompt = SUMMARY_PROMPT.format(
+            max_words=self.max_words,
+            summary=summary or "(none yet)",
+            messages="\n".join(f"{msg['role']}: {msg['content']}" for msg in messages),
+        )
+        response = get_model(self.model, temperature=0.0).invoke(prompt)
+        return response.content if isinstance(response.content, str) else str(response.content)
+
+    def _run(self, thread_id: str, summary: Optional[str], entries: List[Tuple[int, Message]]) -> None:
+        try:
+            messages = [message for _, message in entries]
+            new_summary = self.summarize(summary, messages)
+            with self.store.session(thread_id) as mcp:
+                # The backlog may have been trimmed or grown meanwhile; remove exactly what was summarized
+                mcp.context_window.apply_summary(new_summary, [seq for seq, _ in entries])
+            logger.info(f"Summarized {len(messages)} evicted message(s) for thread {thread_id}")
+        except Exception as e:
+            logger.warning(f"Failed to summarize thread {thread_id}: {str(e)}")
+        finally:
+            with self._lock:
+                self._running.discard(thread_id)
+
+
+_summarizer: Optional[Summarizer] = None
+_summarizer_lock = threading.Lock()
+
+
+def get_summarizer() -> Summarizer:
+    """Return the summarizer for this process, creating it on first use."""
+    global _summarizer
+    if _summarizer is None:
+        with _summarizer_lock:
+            if _summarizer is None:
+                _summarizer = Summarizer(
+                    get_store(),
+                    model=os.getenv("AGENT_SUMMARY_MODEL", "anthropic:claude-3-5-haiku-latest"),
+                    min_batch=int(os.getenv("AGENT_SUMMARY_MIN_BATCH", "4")),
+                )
+    return _summarizer
+
+
+def _reset_after_fork() -> None:
+    global _summarizer
+    _summarizer = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,3 +1,948 @@
-from django.test import TestCase
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+from concurrent.futures import CancelledError
+from contextlib import nullcontext
+from typing import Any, List
+from unittest import mock
+import anthropic
+import httpx
+from django.test import SimpleTestCase, TransactionTestCase
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import Field
+from agent import singleflight
+from agent import snapshot as codec
+from agent.admission import AdmissionController, Overloaded
+from agent.agent import Agent
+from agent.batch import LocalBatchBackend
+from agent.health import HealthMonitor
+from agent.mcp import ContextWindow, Memory, ModelContextProtocol
+from agent.message import Message, Role
+from agent.response_cache import LocalBackend, ResponseCache
+from agent.retry import CONNECTION, OVERLOADED, RATE_LIMITED, TIMEOUT, RetryPolicy, acall_with_retry, astream_with_retry, call_with_retry, cancel_on, classify_error, retry_after_seconds, stream_with_retry
+from agent.singleflight import SingleFlight
+from agent.store import ConversationStore, DatabaseBackend
+from agent.summarizer import Summarizer
+from agent.tokens import count_tokens
+from agent.tool_executor import ToolExecutor
+from agent.tools import get_tools
+from config.log import RedactingFilter, SamplingFilter
 
-# Create your tests here.
+NO_WAIT = RetryPolicy(max_attempts=3, attempt_timeout=5, deadline=10, base_delay=0, max_delay=0)
+
+
+def _conversation(turns: int, thread_id: str = "t") -> ModelContextProtocol:
+    mcp = ModelContextProtocol(thread_id=thread_id)
+    mcp.context_window.max_size = 4
+    for i in range(turns):
+        mcp.ingest_message({"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}" + ("?" if i % 3 == 0 else ".")})
+    return mcp
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Chat model that replies with ``replies`` in order and records every prompt."""
+    replies: List[AIMessage] = Field(default_factory=list)
+    prompts: List[Any] = Field(default_factory=list)
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-chat"
+
+    def bind_tools(self, tools: Any, **kwargs: Any) -> "ScriptedChatModel":
+        return self
+
+    def _next(self, messages: List[Any]) -> AIMessage:
+        self.prompts.append(list(messages))
+        return self.replies.pop(0)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=self._next(messages))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        reply = self._next(messages)
+        for word in reply.content.split(" "):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+        chunks = [{"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i} for i, call in enumerate(reply.tool_calls)]
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=chunks))
+
+
+def _reply(content: str, *tool_calls: dict) -> AIMessage:
+    return AIMessage(content=content, tool_calls=list(tool_calls))
+
+
+def _api_request() -> httpx.Request:
+    return httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+
+
+def _api_response(status: int, headers=None) -> httpx.Response:
+    return httpx.Response(status, headers=headers, request=_api_request())
+
+
+class SnapshotTests(SimpleTestCase):
+    def test_delta_round_trip(self):
+        mcp = _conversation(6)
+        for toy in ("ball", "rope", "frisbee", "bone", "squeaker", "stick"):
+            mcp.memory.add_fact(toy, f"{toy} in the garden")
+        mcp.memory.add_fact("dog", "Max")
+        base = codec.decode(codec.encode(mcp.snapshot()))
+        mcp.ingest_message({"role": "user", "content": "Where is the ball?"})
+        mcp.ingest_message({"role": "assistant", "content": "Under the couch."})
+        mcp.memory.add_fact("ball", "under the couch", relevance=0.9)
+        mcp.memory.add_fact("dog", "Max the sheepdog")
+        current = codec.decode(codec.encode(mcp.snapshot()))
+
+        delta = codec.diff(base, current)
+        self.assertIsNotNone(delta)
+        self.assertEqual(codec.apply(base, codec.decode(codec.encode(delta))), current)
+
+    def test_chained_deltas_track_reads_and_rewrites(self):
+        mcp = _conversation(4)
+        for toy in ("ball", "rope", "frisbee", "bone", "squeaker", "stick"):
+            mcp.memory.add_fact(toy, f"{toy} in the garden")
+        stored = codec.decode(codec.encode(mcp.snapshot()))
+        for query, fact in (("Where is the rope?", ("ball", "ball in the garden")), ("Any bone left?", ("stick", "gone"))):
+            base = mcp.snapshot()
+            mcp.ingest_message({"role": "user", "content": query})
+            mcp.memory.add_fact(*fact)  # Same value still moves the fact to the end
+            mcp.build_context(query)
+            delta = codec.diff(base, mcp.snapshot())
+            self.assertLessEqual(len(delta["facts"]), 3)
+            stored = codec.apply(stored, codec.decode(codec.encode(delta)))
+            self.assertEqual(list(stored["memory"]["accessed"]), list(mcp.memory.accessed_at))
+        self.assertEqual(stored, codec.decode(codec.encode(mcp.snapshot())))
+
+    def test_restored_protocol_snapshots_identically(self):
+        snapshot = codec.decode(codec.encode(_conversation(9).snapshot()))
+        restored = ModelContextProtocol.from_snapshot(snapshot)
+        self.assertEqual(restored.snapshot(), snapshot)
+        self.assertEqual(restored.turn_cursor, 9)
+
+    def test_restored_memory_indexes_facts_on_first_lookup(self):
+        mcp = _conversation(2)
+        mcp.memory.add_fact("dog", "Max the sheepdog")
+        mcp.memory.add_fact("toy", "red ball")
+        restored = ModelContextProtocol.from_snapshot(codec.decode(codec.encode(mcp.snapshot())))
+        self.assertIsNone(restored.memory._index)
+        restored.memory.add_fact("walk", "park at noon")
+        keys = [fact["key"] for fact in restored.memory.get_relevant_facts("Is the sheepdog tired?", top_k=1)]
+        self.assertEqual(keys, ["dog"])
+        self.assertIn("walk", restored.memory._index["park"])
+
+    def test_apply_rejects_delta_for_other_base(self):
+        mcp = _conversation(2)
+        base = mcp.snapshot()
+        mcp.ingest_message({"role": "user", "content": "again"})
+        delta = codec.diff(base, mcp.snapshot())
+        mcp.ingest_message({"role": "assistant", "content": "sure"})
+        with self.assertRaises(ValueError):
+            codec.apply(mcp.snapshot(), delta)
+
+    def test_diff_falls_back_to_full_snapshot(self):
+        base = _conversation(2).snapshot()
+        self.assertIsNone(codec.diff(base, _conversation(2, thread_id="other").snapshot()))
+        rewound = _conversation(4)
+        self.assertIsNone(codec.diff(rewound.snapshot(), base))
+
+
+class ContextWindowTests(SimpleTestCase):
+    def _window(self, max_size: int, contents, max_evicted: int = 100) -> ContextWindow:
+        window = ContextWindow(max_size=max_size, max_evicted=max_evicted)
+        for i, content in enumerate(contents):
+            window.add_message({"role": "user" if i % 2 == 0 else "assistant", "content": content})
+        return window
+
+    def test_prunes_least_important_message(self):
+        window = self._window(3, ["Where is the ball?", "ok", "hi", "sure"])
+        self.assertEqual([m.content for m in window.messages], ["Where is the ball?", "hi", "sure"])
+        self.assertEqual([m.content for m in window.evicted], ["ok"])
+        self.assertEqual(len(window.importance_scores), len(window.messages))
+
+    def test_newest_message_is_never_evicted(self):
+        window = self._window(1, ["Where is the ball?", "ok"])
+        self.assertEqual([m.content for m in window.messages], ["ok"])
+        self.assertEqual([m.content for m in window.evicted], ["Where is the ball?"])
+
+    def test_summary_drops_only_summarized_evictions(self):
+        window = self._window(1, ["one", "two", "three"])
+        entries = window.evicted_entries()
+        self.assertEqual([m.content for _, m in entries], ["one", "two"])
+        window.add_message({"role": "assistant", "content": "four"})
+
+        window.apply_summary("one and two", [seq for seq, _ in entries])
+        self.assertEqual(window.summary, "one and two")
+        self.assertEqual([m.content for m in window.evicted], ["three"])
+
+    def test_evicted_backlog_is_bounded(self):
+        window = self._window(1, ["one", "two", "three", "four", "five"], max_evicted=2)
+        self.assertEqual([m.content for m in window.evicted], ["three", "four"])
+        self.assertEqual([seq for seq, _ in window.evicted_entries()], [2, 3])
+
+
+class ConversationStoreTests(TransactionTestCase):
+    """Two stores on one database stand in for two workers."""
+
+    def _store(self) -> ConversationStore:
+        return ConversationStore(flush_interval=3600, backend=DatabaseBackend())
+
+    def _turn(self, store: ConversationStore, *contents: str) -> None:
+        with store.session("t") as mcp:
+            for i, content in enumerate(contents):
+                mcp.ingest_message({"role": "user" if i % 2 == 0 else "assistant", "content": content})
+
+    def _stored(self) -> list:
+        with self._store().session("t") as mcp:
+            return [m.content for m in mcp.context_window.messages]
+
+    def test_write_behind_persists_turns(self):
+        store = self._store()
+        self._turn(store, "one", "re one")
+        self.assertEqual(store.backlog(), 1)
+        store.flush()
+        self.assertEqual(store.backlog(), 0)
+        self.assertEqual(self._stored(), ["one", "re one"])
+
+    def test_session_reloads_thread_written_by_another_worker(self):
+        a, b = self._store(), self._store()
+        self._turn(a, "one", "re one")
+        a.flush()
+        self._turn(b, "two", "re two")
+        b.flush()
+
+        with a.session("t") as mcp:
+            self.assertEqual([m.content for m in mcp.context_window.messages], ["one", "re one", "two", "re two"])
+            mcp.ingest_message({"role": "user", "content": "three"})
+        a.flush()
+        self.assertEqual(self._stored(), ["one", "re one", "two", "re two", "three"])
+
+    def test_async_session_reloads_thread_written_by_another_worker(self):
+        a, b = self._store(), self._store()
+        self._turn(a, "one")
+        a.flush()
+        self._turn(b, "two")
+        b.flush()
+
+        async def contents():
+            async with a.asession("t") as mcp:
+                return [m.content for m in mcp.context_window.messages]
+
+        self.assertEqual(asyncio.run(contents()), ["one", "two"])
+
+    def test_rejected_write_is_reapplied(self):
+        a, b = self._store(), self._store()
+        self._turn(a, "one", "re one")
+        a.flush()
+        with a.session("t") as mine, b.session("t") as theirs:
+            mine.ingest_message({"role": "user", "content": "two"})
+            theirs.ingest_message({"role": "user", "content": "three"})
+        a.flush()
+        b.flush()  # Rejected: re-applies "three" on top of "two"
+        self.assertEqual(self._stored(), ["one", "re one", "two"])
+        b.flush()
+        self.assertEqual(self._stored(), ["one", "re one", "two", "three"])
+        self.assertEqual(b.backlog(), 0)
+
+    def test_failed_session_is_discarded(self):
+        store = self._store()
+        self._turn(store, "one")
+        with self.assertRaises(RuntimeError):
+            with store.session("t") as mcp:
+                mcp.ingest_message({"role": "assistant", "content": "half a reply"})
+                raise RuntimeError("model failed")
+        store.flush()
+        self.assertEqual(self._stored(), ["one"])
+
+
+class AgentTestCase(SimpleTestCase):
+    """Runs a real Agent on scripted models with an in-memory store."""
+
+    def _agent(self, *models: ScriptedChatModel, tools: Any = None) -> Agent:
+        self.store = ConversationStore(backend=None)
+        clients = itertools.cycle(models)
+        for target, value in (
+            ("agent.agent.get_model", mock.Mock(side_effect=lambda: next(clients))),
+            ("agent.agent.get_store", mock.Mock(return_value=self.store)),
+            ("agent.agent.get_summarizer", mock.Mock()),
+            ("agent.agent.get_response_cache", mock.Mock(return_value=None)),
+            ("agent.agent.tools_enabled", mock.Mock(return_value=tools is not None)),
+            ("agent.agent.get_tool_executor", mock.Mock(return_value=tools)),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return Agent()
+
+
+class AgentTests(AgentTestCase):
+    def test_each_model_call_takes_the_next_pooled_client(self):
+        first = ScriptedChatModel(replies=[_reply("Woof!")])
+        second = ScriptedChatModel(replies=[_reply("Wag!")])
+        agent = self._agent(first, second)  # The constructor takes one client to fail fast
+        self.assertEqual(agent.invoke([{"role": "user", "content": "Hi"}], "t")["content"], "Wag!")
+        self.assertEqual(agent.invoke([{"role": "user", "content": "Again"}], "t", 2)["content"], "Woof!")
+        self.assertEqual((len(first.prompts), len(second.prompts)), (1, 1))
+
+    def test_tool_results_go_back_to_the_model(self):
+        model = ScriptedChatModel(replies=[
+            _reply("Let me check.", {"name": "get_weather", "args": {"city": "Utrecht"}, "id": "call_1"}),
+            _reply("Sunny in Utrecht!"),
+        ])
+        agent = self._agent(model, tools=ToolExecutor(get_tools()))
+        self.assertEqual(agent.invoke([{"role": "user", "content": "Weather?"}], "t")["content"], "Sunny in Utrecht!")
+        tool_message = model.prompts[1][-1]
+        self.assertIsInstance(tool_message, ToolMessage)
+        self.assertEqual((tool_message.tool_call_id, tool_message.content), ("call_1", "It's always sunny in Utrecht!"))
+        with self.store.session("t") as mcp:
+            # Only the final reply is committed, not the text that led up to the tool call
+            self.assertEqual([m.content for m in mcp.context_window.messages], ["Weather?", "Sunny in Utrecht!"])
+
+    def test_tool_rounds_are_capped(self):
+        call = {"name": "get_weather", "args": {"city": "Utrecht"}, "id": "call_1"}
+        model = ScriptedChatModel(replies=[_reply("Checking.", call), _reply("Still checking.", call)])
+        agent = self._agent(model, tools=ToolExecutor(get_tools()))
+        agent.max_tool_rounds = 1
+        self.assertEqual(agent.invoke([{"role": "user", "content": "Weather?"}], "t")["content"], "Still checking.")
+        self.assertEqual(len(model.prompts), 2)
+
+    def _context(self) -> List[Message]:
+        return [
+            Message(Role.SYSTEM, "You are Yoko."),
+            Message(Role.SYSTEM, "Summary of the earlier conversation:\nThey met."),
+            Message(Role.USER, "Hi"),
+            Message(Role.ASSISTANT, "Woof"),
+            Message(Role.SYSTEM, "Current conversation state: initial"),
+            Message(Role.USER, "Ball?"),
+        ]
+
+    def test_prompt_marks_the_stable_prefix_as_cacheable(self):
+        agent = self._agent(ScriptedChatModel())
+        agent.prompt_cache = True
+        context = self._context()
+        system, first, previous, latest = agent._to_langchain(context)
+
+        self.assertIsInstance(system, SystemMessage)
+        self.assertEqual([block["text"] for block in system.content], ["You are Yoko.", "Summary of the earlier conversation:\nThey met."])
+        self.assertEqual(system.content[0]["cache_control"], {"type": "ephemeral"})
+        self.assertNotIn("cache_control", system.content[1])
+        self.assertEqual(first.content, "Hi")
+        # The last earlier turn closes the cached prefix; the message's own record is not changed
+        self.assertEqual(previous.content, [{"type": "text", "text": "Woof", "cache_control": {"type": "ephemeral"}}])
+        self.assertEqual(context[3].to_langchain().content, "Woof")
+        # Per-turn state rides with the latest message, after the breakpoint
+        self.assertIsInstance(latest, HumanMessage)
+        self.assertEqual(latest.content, [{"type": "text", "text": "Current conversation state: initial"}, {"type": "text", "text": "Ball?"}])
+
+    def test_prompt_without_caching_has_no_breakpoints(self):
+        agent = self._agent(ScriptedChatModel())
+        agent.prompt_cache = False
+        system, _, previous, _ = agent._to_langchain(self._context())
+        self.assertEqual(system.content, "You are Yoko.\n\nSummary of the earlier conversation:\nThey met.")
+        self.assertEqual(previous.content, "Woof")
+
+
+class AgentToolStreamTests(AgentTestCase):
+    def _tool_agent(self) -> Agent:
+        model = ScriptedChatModel(replies=[
+            _reply("Let me check.", {"name": "get_weather", "args": {"city": "Utrecht"}, "id": "call_1"}),
+            _reply("Sunny in Utrecht!"),
+        ])
+        return self._agent(model, tools=ToolExecutor(get_tools()))
+
+    def _check_events(self, events: List[dict]) -> None:
+        types = [event["type"] for event in events]
+        self.assertEqual(types.count("reset"), 1)
+        after_reset = events[types.index("reset") + 1:-1]
+        self.assertEqual("".join(event["content"] for event in after_reset), events[-1]["content"])
+        self.assertEqual(events[-1]["content"].strip(), "Sunny in Utrecht!")
+
+    def test_stream_resets_after_a_tool_round(self):
+        self._check_events(list(self._tool_agent().stream([{"role": "user", "content": "Weather?"}], "t")))
+
+    def test_async_stream_resets_after_a_tool_round(self):
+        async def run(agent):
+            return [event async for event in agent.astream([{"role": "user", "content": "Weather?"}], "t")]
+
+        self._check_events(asyncio.run(run(self._tool_agent())))
+
+
+class AdmissionTests(SimpleTestCase):
+    def test_sheds_over_per_thread_limit(self):
+        controller = AdmissionController(rate=0, per_thread=1, queue_timeout=0.05)
+        ticket = controller.acquire("a")
+        with self.assertRaises(Overloaded):
+            controller.acquire("a")
+        controller.acquire("b").release()
+        ticket.release()
+        controller.acquire("a").release()
+        self.assertEqual(controller.snapshot()["active"], 0)
+
+    def test_sheds_over_per_client_limit(self):
+        controller = AdmissionController(rate=0, per_client=1, queue_timeout=0.05)
+        with controller.admit("a", "client"):
+            with self.assertRaises(Overloaded):
+                controller.acquire("b", "client")
+            controller.acquire("b", "other").release()
+
+    def test_sheds_when_at_capacity_after_queue_timeout(self):
+        controller = AdmissionController(rate=0, max_concurrency=1, queue_timeout=0.05)
+        with controller.admit("a"):
+            with self.assertRaises(Overloaded) as shed:
+                controller.acquire("b")
+        self.assertEqual(shed.exception.retry_after, controller.retry_after)
+        self.assertEqual(controller.snapshot(), {"active": 0, "waiting": 0, "tokens": None})
+
+    def test_sheds_when_queue_is_full(self):
+        controller = AdmissionController(rate=0, max_concurrency=1, queue_size=0, queue_timeout=5)
+        with controller.admit("a"):
+            with self.assertRaises(Overloaded):
+                controller.acquire("b")
+
+    def test_sheds_when_rate_limited(self):
+        controller = AdmissionController(rate=1 / 60, burst=1, queue_timeout=0.05)
+        controller.acquire("a").release()
+        with self.assertRaises(Overloaded) as shed:
+            controller.acquire("b")
+        self.assertGreater(shed.exception.retry_after, 0)
+
+    def test_refunds_the_rate_token_of_a_shed_request(self):
+        controller = AdmissionController(rate=1 / 60, burst=1, max_concurrency=1, queue_timeout=0.05)
+        with controller.admit("a"):
+            controller.bucket.refund()  # Leave one token for "b"
+            with self.assertRaises(Overloaded):
+                controller.acquire("b")
+            self.assertGreaterEqual(controller.bucket.tokens, 1)
+
+    def test_async_acquire_waits_for_a_slot(self):
+        controller = AdmissionController(rate=0, max_concurrency=1, queue_timeout=1)
+
+        async def run():
+            first = await controller.aacquire("a")
+            asyncio.get_running_loop().call_later(0.05, first.release)
+            async with controller.aadmit("b"):
+                return controller.snapshot()["active"]
+
+        self.assertEqual(asyncio.run(run()), 1)
+
+
+class HealthMonitorTests(SimpleTestCase):
+    def test_reports_starting_without_waiting_for_the_first_probe(self):
+        release = threading.Event()
+        monitor = HealthMonitor({"slow": lambda: (release.wait(5), {})}, interval=60)
+        self.addCleanup(release.set)
+        report = monitor.status()
+        self.assertEqual(report, {"ready": False, "starting": True, "checks": {"slow": {"ok": False, "error": "not checked yet"}}})
+
+    def test_reports_only_the_requested_checks(self):
+        monitor = HealthMonitor({"database": lambda: (True, {}), "model": mock.Mock(side_effect=ValueError("no key"))})
+        monitor._prober = mock.Mock()  # Probe by hand
+        monitor.probe()
+        self.assertFalse(monitor.status()["ready"])
+        self.assertEqual(monitor.status()["checks"]["model"]["error"], "no key")
+        report = monitor.status(["database"])
+        self.assertTrue(report["ready"])
+        self.assertEqual(list(report["checks"]), ["database"])
+
+    def test_stale_results_fail(self):
+        monitor = HealthMonitor({"database": lambda: (True, {})}, ttl=0)
+        monitor._prober = mock.Mock()
+        monitor.probe()
+        threading.Event().wait(0.01)
+        report = monitor.status()
+        self.assertFalse(report["ready"])
+        self.assertIn("stale", report["checks"]["database"]["error"])
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(singleflight.logger, "info")
+        self.joined = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _wait_for_joins(self, count: int) -> None:
+        for _ in range(200):
+            if self.joined.call_count >= count:
+                return
+            threading.Event().wait(0.01)
+        self.fail(f"only {self.joined.call_count} of {count} callers joined")
+
+    def test_concurrent_calls_share_one_run(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def generate():
+            calls.append(1)
+            release.wait(5)
+            return {"content": "woof"}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do("k", generate))) for _ in range(4)]
+        threads[0].start()
+        while not calls:
+            threading.Event().wait(0.01)
+        for thread in threads[1:]:
+            thread.start()
+        self._wait_for_joins(3)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"content": "woof"}] * 4)
+        self.assertEqual(flight.do("k", lambda: "fresh"), "fresh")
+
+    def test_error_is_shared(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        errors = []
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError("boom")
+
+        def call():
+            try:
+                flight.do("k", fail)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        self._wait_for_joins(2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(all(e is errors[0] for e in errors))
+
+    def test_stream_subscribers_get_every_event(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def events():
+            calls.append(1)
+            release.wait(5)
+            yield {"type": "token", "content": "wo"}
+            yield {"type": "done", "content": "woof"}
+
+        first = flight.stream("k", events)
+        second = flight.stream("k", events)
+        release.set()
+        self.assertEqual(list(first), list(second))
+        self.assertEqual(len(calls), 1)
+
+    def test_stream_stops_when_nobody_listens(self):
+        flight = SingleFlight()
+        closed = threading.Event()
+
+        def events():
+            try:
+                while True:
+                    yield {"type": "token", "content": "woof "}
+                    threading.Event().wait(0.01)
+            finally:
+                closed.set()
+
+        stream = flight.stream("k", events)
+        next(stream)
+        stream.close()
+        self.assertTrue(closed.wait(2))
+
+    def test_unread_subscribers_do_not_keep_the_stream_alive(self):
+        flight = SingleFlight()
+        closed = threading.Event()
+
+        def events():
+            try:
+                while True:
+                    yield {"type": "token", "content": "woof "}
+                    threading.Event().wait(0.01)
+            finally:
+                closed.set()
+
+        stream = flight.stream("k", events)
+        flight.stream("k", events)  # Dropped before its first event
+        next(stream)
+        stream.close()
+        self.assertTrue(closed.wait(2))
+
+    def test_stream_admits_only_the_leader(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        admit = mock.Mock(return_value=nullcontext())
+
+        def events():
+            release.wait(5)
+            yield {"type": "done", "content": "woof"}
+
+        first = flight.stream("k", events, admit=admit)
+        second = flight.stream("k", events, admit=admit)
+        release.set()
+        list(first), list(second)
+        admit.assert_called_once()
+
+    def test_shed_leader_starts_no_stream(self):
+        flight = SingleFlight()
+        events = mock.Mock()
+        with self.assertRaises(Overloaded):
+            flight.stream("k", events, admit=mock.Mock(side_effect=Overloaded("busy", 1)))
+        events.assert_not_called()
+        self.assertEqual(list(flight.stream("k", lambda: iter([{"type": "done"}]))), [{"type": "done"}])
+
+    def test_async_calls_share_one_run(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def generate():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "woof"
+
+        async def run():
+            return await asyncio.gather(*[flight.ado("k", generate) for _ in range(3)])
+
+        self.assertEqual(asyncio.run(run()), ["woof"] * 3)
+        self.assertEqual(len(calls), 1)
+
+
+class RetryTests(SimpleTestCase):
+    def test_classifies_retryable_errors(self):
+        self.assertEqual(classify_error(anthropic.RateLimitError("slow down", response=_api_response(429), body=None)), RATE_LIMITED)
+        self.assertEqual(classify_error(anthropic.InternalServerError("overloaded", response=_api_response(529), body=None)), OVERLOADED)
+        self.assertEqual(classify_error(anthropic.APITimeoutError(request=_api_request())), TIMEOUT)
+        self.assertEqual(classify_error(TimeoutError()), TIMEOUT)
+        self.assertEqual(classify_error(anthropic.APIConnectionError(request=_api_request())), CONNECTION)
+
+    def test_does_not_classify_other_errors(self):
+        self.assertIsNone(classify_error(anthropic.BadRequestError("bad", response=_api_response(400), body=None)))
+        self.assertIsNone(classify_error(anthropic.InternalServerError("oops", response=_api_response(500), body=None)))
+        self.assertIsNone(classify_error(ValueError("bad input")))
+
+    def test_reads_retry_after_header(self):
+        error = anthropic.RateLimitError("slow down", response=_api_response(429, {"retry-after": "3"}), body=None)
+        self.assertEqual(retry_after_seconds(error), 3.0)
+        self.assertEqual(RetryPolicy(max_delay=8).backoff(0, error), 3.0)
+        self.assertIsNone(retry_after_seconds(ValueError()))
+
+    def test_retries_retryable_errors(self):
+        fn = mock.Mock(side_effect=[anthropic.APIConnectionError(request=_api_request()), "woof"])
+        self.assertEqual(call_with_retry(fn, "hi", policy=NO_WAIT), "woof")
+        self.assertEqual(fn.call_count, 2)
+
+    def test_raises_other_errors_at_once(self):
+        fn = mock.Mock(side_effect=ValueError("bad input"))
+        with self.assertRaises(ValueError):
+            call_with_retry(fn, policy=NO_WAIT)
+        fn.assert_called_once()
+
+    def test_gives_up_after_max_attempts(self):
+        fn = mock.Mock(side_effect=anthropic.APIConnectionError(request=_api_request()))
+        with self.assertRaises(anthropic.APIConnectionError):
+            call_with_retry(fn, policy=NO_WAIT)
+        self.assertEqual(fn.call_count, NO_WAIT.max_attempts)
+
+    def test_cancel_event_cuts_backoff_short(self):
+        fn = mock.Mock(side_effect=anthropic.APIConnectionError(request=_api_request()))
+        policy = RetryPolicy(max_attempts=3, attempt_timeout=5, deadline=60, base_delay=20, max_delay=20)
+        cancelled = threading.Event()
+        threading.Timer(0.05, cancelled.set).start()
+        start = time.monotonic()
+        with cancel_on(cancelled), self.assertRaises(CancelledError):
+            call_with_retry(fn, policy=policy)
+        self.assertLess(time.monotonic() - start, 5)
+        fn.assert_called_once()
+
+    def test_cancelled_calls_do_not_start(self):
+        cancelled = threading.Event()
+        cancelled.set()
+        fn = mock.Mock(return_value="woof")
+        with cancel_on(cancelled), self.assertRaises(CancelledError):
+            call_with_retry(fn, policy=NO_WAIT)
+        fn.assert_not_called()
+
+    def test_async_retries_retryable_errors(self):
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise anthropic.APIConnectionError(request=_api_request())
+            return "woof"
+
+        self.assertEqual(asyncio.run(acall_with_retry(flaky, policy=NO_WAIT)), "woof")
+        self.assertEqual(len(attempts), 2)
+
+    def test_stream_retries_until_the_first_event(self):
+        attempts = []
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def events():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise anthropic.APIConnectionError(request=_api_request())
+            if len(attempts) == 2:
+                release.wait(5)  # Times out before its first event
+            yield "wo"
+            yield "of"
+
+        policy = NO_WAIT.model_copy(update={"attempt_timeout": 0.05})
+        self.assertEqual(list(stream_with_retry(events, policy=policy)), ["wo", "of"])
+        self.assertEqual(len(attempts), 3)
+
+    def test_stream_is_not_restarted_after_its_first_event(self):
+        attempts = []
+
+        def events():
+            attempts.append(1)
+            yield "wo"
+            raise anthropic.APIConnectionError(request=_api_request())
+
+        received = []
+        with self.assertRaises(anthropic.APIConnectionError):
+            for event in stream_with_retry(events, policy=NO_WAIT):
+                received.append(event)
+        self.assertEqual(received, ["wo"])
+        self.assertEqual(len(attempts), 1)
+
+    def test_stalled_stream_times_out(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def events():
+            yield "wo"
+            release.wait(5)
+            yield "of"
+
+        stream = stream_with_retry(events, policy=NO_WAIT.model_copy(update={"idle_timeout": 0.05}))
+        self.assertEqual(next(stream), "wo")
+        with self.assertRaises(TimeoutError):
+            next(stream)
+
+    def test_async_stream_retries_and_times_out(self):
+        attempts = []
+
+        async def events():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise anthropic.APIConnectionError(request=_api_request())
+            yield "wo"
+            await asyncio.sleep(5)
+            yield "of"
+
+        async def run():
+            received = []
+            with self.assertRaises(TimeoutError):
+                async for event in astream_with_retry(events, policy=NO_WAIT.model_copy(update={"idle_timeout": 0.05})):
+                    received.append(event)
+            return received
+
+        self.assertEqual(asyncio.run(run()), ["wo"])
+        self.assertEqual(len(attempts), 2)
+
+
+class LocalBatchBackendTests(SimpleTestCase):
+    def test_runs_jobs_at_submit_and_reads_finished_results(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def invoke(messages):
+            if messages[-1]["content"] == "hi":
+                release.wait(5)
+                return AIMessage(content="woof")
+            return AIMessage(content="bark")
+
+        model = mock.Mock()
+        model.invoke.side_effect = invoke
+        requests = [
+            {"custom_id": "job-0", "params": {"system": "Yoko", "messages": [{"role": "user", "content": "hi"}]}},
+            {"custom_id": "job-1", "params": {"system": "Yoko", "messages": [{"role": "user", "content": "oi"}]}},
+        ]
+        backend = LocalBatchBackend()
+        with mock.patch("agent.batch.get_model", return_value=model):
+            batch_id = backend.submit(requests)
+            for _ in range(200):
+                if model.invoke.call_count == 2:
+                    break
+                threading.Event().wait(0.01)
+            self.assertEqual(model.invoke.call_count, 2)
+            self.assertEqual(backend.status(batch_id)["status"], "in_progress")
+            release.set()
+            results = list(backend.results(batch_id))
+            self.assertEqual(backend.status(batch_id)["counts"], {"processing": 0, "succeeded": 2, "errored": 0})
+        self.assertEqual(model.invoke.call_count, 2)
+        self.assertEqual(results, [{"custom_id": "job-0", "status": "ok", "content": "woof"}, {"custom_id": "job-1", "status": "ok", "content": "bark"}])
+
+
+class SummarizerTests(SimpleTestCase):
+    def setUp(self):
+        self.store = ConversationStore(backend=None)
+        self.model = mock.Mock()
+        patcher = mock.patch("agent.summarizer.get_model", return_value=self.model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _evict(self, summarizer: Summarizer, count: int) -> bool:
+        with self.store.session("t") as mcp:
+            for i in range(mcp.context_window.max_size + count):
+                mcp.ingest_message({"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}"})
+            return summarizer.maybe_schedule("t", mcp.context_window)
+
+    def test_folds_evicted_messages_into_the_summary(self):
+        self.model.invoke.return_value = AIMessage(content="They counted messages.")
+        summarizer = Summarizer(self.store, min_batch=2)
+        self.assertTrue(self._evict(summarizer, 2))
+        summarizer._executor.shutdown(wait=True)
+
+        prompt = self.model.invoke.call_args.args[0]
+        self.assertIn("(none yet)", prompt)
+        self.assertIn("New messages:\nassistant: message 1\nassistant: message 3", prompt)
+        with self.store.session("t") as mcp:
+            self.assertEqual(mcp.context_window.summary, "They counted messages.")
+            self.assertEqual(mcp.context_window.evicted, [])
+
+    def test_waits_for_a_full_batch_and_keeps_evictions_on_failure(self):
+        self.model.invoke.side_effect = anthropic.APIConnectionError(request=_api_request())
+        summarizer = Summarizer(self.store, min_batch=3)
+        self.assertFalse(self._evict(summarizer, 2))
+        self.assertTrue(self._evict(summarizer, 0))
+        summarizer._executor.shutdown(wait=True)
+        with self.store.session("t") as mcp:
+            self.assertIsNone(mcp.context_window.summary)
+            self.assertGreaterEqual(len(mcp.context_window.evicted), 3)
+        self.assertEqual(summarizer._running, set())
+
+
+class MemoryTests(SimpleTestCase):
+    def test_ranks_facts_sharing_query_terms_first(self):
+        memory = Memory()
+        memory.add_fact("favourite_toy", "a red ball")
+        memory.add_fact("dog_name", "Yoko")
+        memory.add_fact("home_town", "Utrecht")
+        facts = memory.get_relevant_facts("Where is my ball?", top_k=2)
+        self.assertEqual([fact["key"] for fact in facts], ["favourite_toy", "home_town"])
+        self.assertGreater(facts[0]["relevance"], facts[1]["relevance"])
+
+    def test_skips_facts_below_the_threshold(self):
+        memory = Memory()
+        memory.add_fact("favourite_toy", "a red ball", relevance=0.2)
+        self.assertEqual(memory.get_relevant_facts("ball"), [])
+
+    def test_common_terms_do_not_match_every_fact(self):
+        memory = Memory()
+        for i in range(40):
+            memory.add_fact(f"walk_{i}", f"walked in park number {i}")
+        memory.add_fact("favourite_park", "Wilhelminapark")
+        index, _ = memory._indexes()
+        self.assertEqual(len(index["walked"]), 40)
+        # "walked" is in most facts and is skipped; only the recent facts are candidates
+        facts = memory.get_relevant_facts("walked", top_k=3)
+        self.assertEqual([fact["key"] for fact in facts], ["favourite_park", "walk_39", "walk_38"])
+
+    def test_new_facts_are_indexed_after_the_first_lookup(self):
+        memory = Memory()
+        memory.add_fact("dog_name", "Yoko")
+        memory.get_relevant_facts("dog")
+        for i in range(10):
+            memory.add_fact(f"filler_{i}", "nothing to see")
+        memory.add_fact("vet", "Dr. Bakker on Fridays")
+        self.assertEqual(memory.get_relevant_facts("When is the vet?", top_k=1)[0]["key"], "vet")
+
+
+class BuildContextTests(SimpleTestCase):
+    def _protocol(self) -> ModelContextProtocol:
+        mcp = ModelContextProtocol(system_prompt="You are Yoko, a friendly dog.")
+        for i in range(8):
+            mcp.ingest_message({"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} " + "woof " * 10})
+        mcp.ingest_message({"role": "user", "content": "Where is my ball?"})
+        mcp.context_window.summary = "They played fetch."
+        mcp.memory.add_fact("favourite_toy", "a red ball")
+        return mcp
+
+    def test_orders_the_context_from_most_to_least_stable(self):
+        context = self._protocol().build_context("Where is my ball?", token_budget=10 ** 6)
+        self.assertEqual(context[0].content, "You are Yoko, a friendly dog.")
+        self.assertTrue(context[1].content.endswith("They played fetch."))
+        self.assertEqual([m.content.split(" ", 2)[1] for m in context[2:-3]], [str(i) for i in range(8)])
+        self.assertTrue(context[-3].content.startswith("Current conversation state:"))
+        self.assertIn("favourite_toy: a red ball", context[-2].content)
+        self.assertEqual(context[-1].content, "Where is my ball?")
+
+    def test_keeps_the_newest_turns_within_the_budget(self):
+        mcp = self._protocol()
+        full = mcp.build_context("Where is my ball?", token_budget=10 ** 6)
+        budget = sum(m.tokens for m in full) - 3 * full[2].tokens
+        context = mcp.build_context("Where is my ball?", token_budget=budget)
+        self.assertLessEqual(sum(count_tokens(m.content) for m in context), budget)
+        earlier = [m.content for m in context if m.content.startswith("turn ")]
+        self.assertEqual(earlier, [m.content for m in full if m.content.startswith("turn ")][-len(earlier):])
+        self.assertLess(len(earlier), 8)
+
+    def test_always_sends_the_prompt_state_and_latest_message(self):
+        context = self._protocol().build_context("Where is my ball?", token_budget=0)
+        self.assertEqual([m.role for m in context], [Role.SYSTEM, Role.SYSTEM, Role.USER])
+        self.assertEqual(context[-1].content, "Where is my ball?")
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def test_keys_ignore_case_spacing_and_trailing_punctuation(self):
+        cache = ResponseCache(LocalBackend())
+        key = cache.key_for([{"role": "user", "content": "Hi Yoko!"}])
+        self.assertEqual(cache.key_for([{"role": "user", "content": "  hi   yoko"}]), key)
+        self.assertNotEqual(cache.key_for([{"role": "user", "content": "Hi Yoko!"}], "nl"), key)
+
+    def test_only_opening_user_turns_are_cacheable(self):
+        cache = ResponseCache(LocalBackend(), max_context=2)
+        turns = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Woof"}, {"role": "user", "content": "Sit"}]
+        self.assertIsNotNone(cache.key_for(turns))
+        self.assertIsNone(cache.key_for(turns[:2]))
+        self.assertIsNone(cache.key_for(turns + [{"role": "assistant", "content": "Ok"}, {"role": "user", "content": "Down"}]))
+
+    def test_local_backend_expires_and_evicts_least_recently_used(self):
+        backend = LocalBackend(max_size=2)
+        backend.set("old", "woof", ttl=-1)
+        self.assertIsNone(backend.get("old"))
+        backend.set("a", "1", ttl=60)
+        backend.set("b", "2", ttl=60)
+        backend.get("a")
+        backend.set("c", "3", ttl=60)
+        self.assertEqual((backend.get("a"), backend.get("b"), backend.get("c")), ("1", None, "3"))
+
+    def test_backend_failures_are_cache_misses(self):
+        backend = mock.Mock()
+        backend.get.side_effect = backend.set.side_effect = ConnectionError("cache down")
+        cache = ResponseCache(backend)
+        self.assertIsNone(cache.get("key"))
+        cache.set("key", "woof")
+
+
+class LogFilterTests(SimpleTestCase):
+    def _record(self, msg: str, *args: Any, level: int = logging.INFO) -> logging.LogRecord:
+        return logging.LogRecord("agent", level, __file__, 1, msg, args or None, None)
+
+    def test_redacts_secrets_and_formats_arguments(self):
+        record = self._record("key %s for %s with %s", "sk-ant-abcdef123456", "yoko@example.nl", "Bearer abc.def")
+        self.assertTrue(RedactingFilter().filter(record))
+        self.assertEqual(record.getMessage(), "key [redacted] for [redacted] with [redacted]")
+        self.assertIsNone(record.args)
+
+    def test_truncates_long_messages_without_leaking_a_cut_secret(self):
+        record = self._record("x" * 30 + " sk-ant-abcdef123456 " + "y" * 100)
+        RedactingFilter(max_length=45).filter(record)
+        self.assertNotIn("sk-ant", record.msg)
+        self.assertEqual(record.msg, "x" * 30 + " [redacted] yyy... [106 more chars]")
+
+    def test_sampling_keeps_warnings(self):
+        sampling = SamplingFilter(rate=0.0)
+        self.assertFalse(sampling.filter(self._record("hi")))
+        self.assertTrue(sampling.filter(self._record("uh oh", level=logging.WARNING)))
+        self.assertTrue(SamplingFilter(rate=1.0).filter(self._record("hi")))
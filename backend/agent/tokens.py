@@ -0,0 +1,19 @@
+import os
+
+# Rough Claude tokenizer ratio; good enough for budgeting without a network round-trip
+CHARS_PER_TOKEN = 4
+# Per-message framing (role markers, separators)
+MESSAGE_OVERHEAD = 4
+
+
+def count_tokens(text: str) -> int:
+    """Estimate the number of tokens in a piece of text.
+
+    The estimate is O(1), so it is not memoized; messages keep their own count.
+    """
+    return MESSAGE_OVERHEAD + (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def context_token_budget() -> int:
+    """Return the default input-token budget for one model call."""
+    return int(os.getenv("AGENT_CONTEXT_TOKEN_BUDGET", "8000"))
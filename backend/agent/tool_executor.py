@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+from agent.metrics import TOOL_CALLS, TOOLS, span
+from agent.response_cache import LocalBackend
+
+if TYPE_CHECKING:
+    from langchain_core.messages import ToolMessage
+
+logger = logging.getLogger(__name__)
+
+
+class ToolExecutor:
+    """Runs the tool calls of one model turn concurrently on a bounded pool.
+
+    Every call is bounded by its tool's timeout (``metadata["timeout"]`` or
+    ``timeout``), so a slow tool fails on its own instead of stalling the
+    turn; its worker thread finishes in the background. Successful results
+    are memoized per tool name and arguments for the tool's ``cache_ttl``.
+    Failures and timeouts are reported back to the model as error tool
+    messages.
+    """
+
+    def __init__(
+        self,
+        tools: List[Any],
+        max_workers: int = 8,
+        timeout: float = 10.0,
+        cache_ttl: float = 300.0,
+        cache_size: int = 1024,
+    ):
+        self.tools = {tool.name: tool for tool in tools}
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache = LocalBackend(max_size=cache_size)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="agent-tool")
+        self._bound: Dict[int, Tuple[Any, Any]] = {}  # id(model) -> (model, model with tools bound)
+        self._lock = threading.Lock()
+
+    def bind(self, model: Any) -> Any:
+        """Return ``model`` with the tools bound, built once per pooled client."""
+        entry = self._bound.get(id(model))
+        if entry is None or entry[0] is not model:
+            bound = model.bind_tools(list(self.tools.values()))
+            with self._lock:
+                entry = self._bound[id(model)] = (model, bound)
+        return entry[1]
+
+    def _option(self, name: str, option: str, default: float) -> float:
+        value = (self.tools[name].metadata or {}).get(option)
+        return default if value is None else value
+
+    @staticmethod
+    def _cache_key(name: str, args: Dict[str, Any]) -> str:
+        return f"{name}:{json.dumps(args, sort_keys=True, default=str)}"
+
+    def _lookup(self, call: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+        """Return ``(cache_key, cached_result)`` for a call; the key is None if it is not cacheable."""
+        name = call["name"]
+        if name not in self.tools or self._option(name, "cache_ttl", self.cache_ttl) <= 0:
+            return None, None
+        key = self._cache_key(name, call.get("args") or {})
+        return key, self.cache.get(key)
+
+    def _submit(self, call: Dict[str, Any]) -> Future:
+        return self._pool.submit(self.tools[call["name"]].invoke, call.get("args") or {})
+
+    def _message(self, call: Dict[str, Any], content: str, result: str) -> "ToolMessage":
+        from langchain_core.messages import ToolMessage
+
+        TOOL_CALLS.labels(call["name"], result).inc()
+        status = "success" if result in ("ok", "cached") else "error"
+        return ToolMessage(content=content, tool_call_id=call["id"], name=call["name"], status=status)
+
+    def _finish(self, call: Dict[str, Any], key: Optional[str], outcome: Any, error: Optional[BaseException]) -> "ToolMessage":
+        name = call["name"]
+        if isinstance(error, (asyncio.TimeoutError, FutureTimeoutError)):
+            logger.warning(f"Tool {name} timed out")
+            return self._message(call, f"Error: tool {name} timed out", "timeout")
+        if error is not None:
+            logger.warning(f"Tool {name} failed: {str(error)}")
+            return self._message(call, f"Error: {str(error)}", "error")
+        content = outcome if isinstance(outcome, str) else json.dumps(outcome, default=str)
+        if key is not None:
+            self.cache.set(key, content, self._option(name, "cache_ttl", self.cache_ttl))
+        return self._message(call, content, "ok")
+
+    def _unknown(self, call: Dict[str, Any]) -> Optional["ToolMessage"]:
+        if call["name"] in self.tools:
+            return None
+        return self._message(call, f"Error: unknown tool {call['name']}", "error")
+
+    def run(self, tool_calls: List[Dict[str, Any]]) -> List["ToolMessage"]:
+        """Run tool calls concurrently and return their tool messages in call order."""
+        with span(TOOLS):
+            pending = []
+            messages: List[Optional["ToolMessage"]] = []
+            for call in tool_calls:
+                message = self._unknown(call)
+                key, cached = self._lookup(call) if message is None else (None, None)
+                if cached is not None:
+                    message = self._message(call, cached, "cached")
+                elif message is None:
+                    deadline = time.monotonic() + self._option(call["name"], "timeout", self.timeout)
+                    pending.append((len(messages), call, key, deadline, self._submit(call)))
+                messages.append(message)
+            for index, call, key, deadline, future in pending:
+                try:
+                    outcome, error = future.result(timeout=max(deadline - time.monotonic(), 0)), None
+                except Exception as e:
+                    future.cancel()
+                    outcome, error = None, e
+                messages[index] = self._finish(call, key, outcome, error)
+            return messages
+
+    async def arun(self, tool_calls: List[Dict[str, Any]]) -> List["ToolMessage"]:
+        """Async variant of ``run``; waits never block the event loop."""
+        with span(TOOLS):
+            messages: List[Optional["ToolMessage"]] = []
+            waits = []
+            for call in tool_calls:
+                message = self._unknown(call)
+                key, cached = self._lookup(call) if message is None else (None, None)
+                if cached is not None:
+                    message = self._message(call, cached, "cached")
+                elif message is None:
+                    timeout = self._option(call["name"], "timeout", self.timeout)
+                    waits.append((len(messages), call, key, asyncio.wait_for(asyncio.wrap_future(self._submit(call)), timeout)))
+                messages.append(message)
+            outcomes = await asyncio.gather(*(wait for _, _, _, wait in waits), return_exceptions=True)
+            for (index, call, key, _), outcome in zip(waits, outcomes):
+                error = outcome if isinstance(outcome, BaseException) else None
+                messages[index] = self._finish(call, key, None if error else outcome, error)
+            return messages
+
+
+_executor: Optional[ToolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def tools_enabled() -> bool:
+    """Whether the agent binds tools to the model (``AGENT_TOOLS``)."""
+    return os.getenv("AGENT_TOOLS", "false").lower() == "true"
+
+
+def get_tool_executor() -> ToolExecutor:
+    """Return the tool executor for this process, creating it on first use."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from agent.tools import get_tools
+
+                _executor = ToolExecutor(
+                    get_tools(),
+                    max_workers=int(os.getenv("AGENT_TOOL_WORKERS", "8")),
+                    timeout=float(os.getenv("AGENT_TOOL_TIMEOUT", "10")),
+                    cache_ttl=float(os.getenv("AGENT_TOOL_CACHE_TTL", "300")),
+                    cache_size=int(os.getenv("AGENT_TOOL_CACHE_SIZE", "1024")),
+                )
+    return _executor
+
+
+def _reset_after_fork() -> None:
+    global _executor
+    _executor = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
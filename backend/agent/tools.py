@@ -1,16 +1,57 @@
-from typing import Dict, Any
-from langchain_core.tools import tool
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional
 
-@tool
+# Registered tool functions, in registration order, and their execution options
+TOOL_FUNCTIONS: List[Callable[..., Any]] = []
+TOOL_OPTIONS: Dict[str, Dict[str, Any]] = {}
+
+
+def register_tool(timeout: Optional[float] = None, cache_ttl: Optional[float] = None) -> Callable:
+    """Register a function as an agent tool.
+
+    The function's name, signature and docstring describe the tool to the
+    model, as with LangChain's ``@tool``.
+
+    Args:
+        timeout: Seconds a call may run; defaults to ``AGENT_TOOL_TIMEOUT``.
+        cache_ttl: Seconds results are reused for identical arguments;
+            defaults to ``AGENT_TOOL_CACHE_TTL``, 0 disables caching.
+    """
+    def decorator(function: Callable[..., Any]) -> Callable[..., Any]:
+        TOOL_FUNCTIONS.append(function)
+        TOOL_OPTIONS[function.__name__] = {"timeout": timeout, "cache_ttl": cache_ttl}
+        return function
+    return decorator
+
+
+@register_tool(timeout=5.0, cache_ttl=600.0)
 def get_weather(city: str) -> str:
     """Get weather for a given city.
-    
+
     Args:
         city: The name of the city to get weather for.
-        
+
     Returns:
         A string describing the weather in the city.
     """
     # This is a mock implementation. In a real application, you would
     # call a weather API here.
-    return f"It's always sunny in {city}!" 
\ No newline at end of file
+    return f"It's always sunny in {city}!"
+
+
+@lru_cache(maxsize=1)
+def get_tools() -> List[Any]:
+    """Return the registered tools as LangChain tools.
+
+    ``langchain_core.tools`` is imported on first call rather than at module
+    import, so importing this module stays cheap. Each tool's options are
+    kept in its ``metadata``.
+    """
+    from langchain_core.tools import tool
+
+    tools = []
+    for function in TOOL_FUNCTIONS:
+        wrapped = tool(function)
+        wrapped.metadata = dict(TOOL_OPTIONS[function.__name__])
+        tools.append(wrapped)
+    return tools
@@ -1,3 +1,251 @@
-from django.test import TestCase
+import asyncio
+import json
+from unittest import mock
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase
+from agent.admission import AdmissionController
+from agent.health import HealthMonitor
+from agent.pool import ConfigurationError
+from api.views import AsyncChatBatchView, AsyncChatStreamView, AsyncChatView, ChatBatchView, ChatStreamView, ChatView, _client_id, health_check, readiness
 
-# Create your tests here.
+HELLO = [{"role": "user", "content": "Hi Yoko!"}]
+
+BAD_CHAT_BODIES = [
+    "{not json",
+    [],
+    "hello",
+    {"messages": "Hi"},
+    {"messages": ["Hi"]},
+    {"messages": [{"role": "robot", "content": "Hi"}]},
+    {"messages": [{"role": ["user"], "content": "Hi"}]},
+    {"messages": [{"content": "Hi"}]},
+    {"messages": [{"role": "user", "content": 42}]},
+    {"messages": []},
+    {"messages": HELLO, "thread_id": ""},
+    {"messages": HELLO, "thread_id": 7},
+    {"messages": HELLO, "turn_cursor": -1},
+    {"messages": HELLO, "turn_cursor": True},
+    {"messages": HELLO, "turn_cursor": "2"},
+]
+
+BAD_BATCH_BODIES = [
+    "{not json",
+    [],
+    {"jobs": []},
+    {"jobs": "all of them"},
+    {"jobs": [{"messages": []}]},
+    {"jobs": [{"messages": [{"role": "robot", "content": "Hi"}]}]},
+    {"jobs": [{"messages": HELLO, "turn_cursor": True}]},
+    {"jobs": [{"messages": HELLO, "thread_id": ""}]},
+    {"jobs": [{"messages": HELLO}], "mode": "eventually"},
+    {"jobs": [{"messages": HELLO}], "parallelism": 0},
+]
+
+
+def _body(data) -> str:
+    return data if isinstance(data, str) else json.dumps(data)
+
+
+def _call(view, data):
+    """Call a sync view and return its status, headers and body."""
+    response = view.as_view()(RequestFactory().post("/", data=_body(data), content_type="application/json"))
+    if response.streaming:
+        return response.status_code, response, b"".join(response.streaming_content)
+    if hasattr(response, "render"):
+        response.render()
+    return response.status_code, response, response.content
+
+
+def _acall(view, data):
+    """Call an async view and read its body on the same event loop."""
+    async def run():
+        response = await view.as_view()(AsyncRequestFactory().post("/", data=_body(data), content_type="application/json"))
+        if response.streaming:
+            return response.status_code, response, b"".join([chunk async for chunk in response.streaming_content])
+        return response.status_code, response, response.content
+
+    return asyncio.run(run())
+
+
+class ChatViewTestCase(SimpleTestCase):
+    def setUp(self):
+        self.admission = AdmissionController(rate=0, per_thread=1, queue_timeout=0.05)
+        for target in ("api.views.get_admission", "agent.batch.get_admission"):
+            patcher = mock.patch(target, return_value=self.admission)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("api.views.get_agent")
+        self.agent = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.agent.invoke.return_value = {"content": "Woof!", "turn_cursor": 2}
+        self.agent.ainvoke = mock.AsyncMock(return_value={"content": "Woof!", "turn_cursor": 2})
+        self.agent.stream.side_effect = lambda *args: iter([{"type": "token", "content": "Woof!"}, {"type": "done", "content": "Woof!", "turn_cursor": 2}])
+
+        async def astream(*args):
+            yield {"type": "token", "content": "Woof!"}
+            yield {"type": "done", "content": "Woof!", "turn_cursor": 2}
+
+        self.agent.astream.side_effect = astream
+
+    def assertNotRun(self):
+        self.agent.invoke.assert_not_called()
+        self.agent.ainvoke.assert_not_called()
+        self.agent.stream.assert_not_called()
+        self.agent.astream.assert_not_called()
+
+
+class ChatRequestValidationTests(ChatViewTestCase):
+    def test_chat_views_reject_malformed_bodies(self):
+        for call, view in ((_call, ChatView), (_call, ChatStreamView), (_acall, AsyncChatView), (_acall, AsyncChatStreamView)):
+            for data in BAD_CHAT_BODIES:
+                with self.subTest(view=view.__name__, body=data):
+                    status, _, content = call(view, data)
+                    self.assertEqual(status, 400)
+                    self.assertIn("error", json.loads(content))
+        self.assertNotRun()
+
+    def test_batch_views_reject_malformed_bodies(self):
+        for call, view in ((_call, ChatBatchView), (_acall, AsyncChatBatchView)):
+            for data in BAD_BATCH_BODIES:
+                with self.subTest(view=view.__name__, body=data):
+                    status, _, content = call(view, data)
+                    self.assertEqual(status, 400)
+                    self.assertIn("error", json.loads(content))
+        self.assertNotRun()
+
+
+class ChatAdmissionTests(ChatViewTestCase):
+    def test_chat_views_answer_429_when_shed(self):
+        with self.admission.admit("busy"):
+            for call, view in ((_call, ChatView), (_call, ChatStreamView), (_acall, AsyncChatView), (_acall, AsyncChatStreamView)):
+                with self.subTest(view=view.__name__):
+                    status, response, content = call(view, {"messages": HELLO, "thread_id": "busy"})
+                    self.assertEqual(status, 429)
+                    self.assertEqual(response["Retry-After"], "2")
+                    self.assertEqual(json.loads(content)["error"], "Server busy")
+        self.assertNotRun()
+        self.assertEqual(self.admission.snapshot()["active"], 0)
+
+    def test_batch_views_answer_429_when_first_job_is_shed(self):
+        body = {"jobs": [{"thread_id": "busy", "messages": HELLO}, {"thread_id": "free", "messages": HELLO}]}
+        with self.admission.admit("busy"):
+            for call, view in ((_call, ChatBatchView), (_acall, AsyncChatBatchView)):
+                with self.subTest(view=view.__name__):
+                    status, response, _ = call(view, body)
+                    self.assertEqual(status, 429)
+                    self.assertIn("Retry-After", response)
+        self.assertNotRun()
+
+    def test_admitted_requests_release_their_ticket(self):
+        for call, view in ((_call, ChatView), (_call, ChatStreamView), (_acall, AsyncChatView), (_acall, AsyncChatStreamView)):
+            with self.subTest(view=view.__name__):
+                status, _, content = call(view, {"messages": HELLO, "thread_id": "t1"})
+                self.assertEqual(status, 200)
+                self.assertIn(b"Woof!", content)
+                self.assertEqual(self.admission.snapshot()["active"], 0)
+
+
+class ChatResponseTests(ChatViewTestCase):
+    def test_chat_returns_reply_and_cursor(self):
+        for call, view in ((_call, ChatView), (_acall, AsyncChatView)):
+            with self.subTest(view=view.__name__):
+                status, response, content = call(view, {"messages": HELLO, "thread_id": "t1", "turn_cursor": 0})
+                self.assertEqual(status, 200)
+                self.assertEqual(json.loads(content), {"content": "Woof!", "turn_cursor": 2})
+                self.assertEqual(response["Access-Control-Allow-Origin"], "*")
+        self.agent.invoke.assert_called_once_with(HELLO, "t1", 0, None)
+        self.agent.ainvoke.assert_called_once_with(HELLO, "t1", 0, None)
+
+    def test_stream_emits_server_sent_events(self):
+        for call, view in ((_call, ChatStreamView), (_acall, AsyncChatStreamView)):
+            with self.subTest(view=view.__name__):
+                status, response, content = call(view, {"messages": HELLO, "thread_id": "t2"})
+                self.assertEqual(status, 200)
+                self.assertEqual(response["Content-Type"], "text/event-stream")
+                self.assertEqual(
+                    content.decode(),
+                    'event: token\ndata: {"content": "Woof!"}\n\n'
+                    'event: done\ndata: {"content": "Woof!", "turn_cursor": 2}\n\n',
+                )
+
+    def test_batch_streams_one_record_per_job(self):
+        body = {"jobs": [{"thread_id": "a", "messages": HELLO}, {"thread_id": "b", "messages": HELLO}, {"thread_id": "a", "messages": HELLO, "turn_cursor": 2}]}
+        for call, view in ((_call, ChatBatchView), (_acall, AsyncChatBatchView)):
+            with self.subTest(view=view.__name__):
+                status, _, content = call(view, body)
+                self.assertEqual(status, 200)
+                records = sorted((json.loads(line) for line in content.splitlines()), key=lambda record: record["index"])
+                self.assertEqual([(r["index"], r["thread_id"], r["status"]) for r in records], [(0, "a", "ok"), (1, "b", "ok"), (2, "a", "ok")])
+        self.assertEqual(self.admission.snapshot()["active"], 0)
+
+
+class ChatErrorTests(ChatViewTestCase):
+    def test_missing_configuration_is_a_server_error(self):
+        self.agent.invoke.side_effect = ConfigurationError("ANTHROPIC_API_KEY not found in environment variables")
+        self.agent.ainvoke.side_effect = self.agent.invoke.side_effect
+        for call, view in ((_call, ChatView), (_acall, AsyncChatView)):
+            with self.subTest(view=view.__name__):
+                status, _, content = call(view, {"messages": HELLO})
+                self.assertEqual(status, 500)
+                self.assertNotIn("ANTHROPIC_API_KEY", content.decode())
+
+    def test_value_errors_from_the_agent_are_not_bad_requests(self):
+        self.agent.invoke.side_effect = ValueError("delta references unknown message 3")
+        self.agent.ainvoke.side_effect = self.agent.invoke.side_effect
+        for call, view in ((_call, ChatView), (_acall, AsyncChatView)):
+            with self.subTest(view=view.__name__):
+                status, _, _ = call(view, {"messages": HELLO})
+                self.assertEqual(status, 500)
+
+    def test_stream_and_batch_views_report_configuration_errors(self):
+        with mock.patch("api.views.get_agent", side_effect=ConfigurationError("no key")):
+            for call, view, body in (
+                (_call, ChatStreamView, {"messages": HELLO}),
+                (_acall, AsyncChatStreamView, {"messages": HELLO}),
+                (_call, ChatBatchView, {"jobs": [{"messages": HELLO}]}),
+                (_acall, AsyncChatBatchView, {"jobs": [{"messages": HELLO}]}),
+            ):
+                with self.subTest(view=view.__name__):
+                    status, _, _ = call(view, body)
+                    self.assertEqual(status, 500)
+        self.assertEqual(self.admission.snapshot()["active"], 0)
+
+
+class HealthViewTests(SimpleTestCase):
+    def _monitor(self, **checks) -> HealthMonitor:
+        monitor = HealthMonitor(checks)
+        monitor._prober = mock.Mock()  # Probe by hand
+        patcher = mock.patch("api.views.get_health_monitor", return_value=monitor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return monitor
+
+    def test_health_ignores_the_model_client(self):
+        monitor = self._monitor(database=lambda: (True, {}), model=mock.Mock(side_effect=ConfigurationError("no key")), queue=lambda: (True, {}))
+        monitor.probe()
+        self.assertEqual(health_check(RequestFactory().get("/")).status_code, 200)
+        response = readiness(RequestFactory().get("/"))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.content)["status"], "unavailable")
+
+    def test_probes_answer_starting_before_the_first_probe(self):
+        self._monitor(database=lambda: (True, {}), model=lambda: (True, {}), queue=lambda: (True, {}))
+        for view in (health_check, readiness):
+            with self.subTest(view=view.__name__):
+                response = view(RequestFactory().get("/"))
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(json.loads(response.content)["status"], "starting")
+
+
+class ClientIdTests(SimpleTestCase):
+    def _client_id(self, forwarded: str) -> str:
+        return _client_id(RequestFactory().get("/", HTTP_X_FORWARDED_FOR=forwarded, REMOTE_ADDR="10.0.0.1"))
+
+    def test_takes_the_address_added_by_the_trusted_proxy(self):
+        self.assertEqual(self._client_id("6.6.6.6, 1.2.3.4"), "1.2.3.4")
+        with mock.patch.dict("os.environ", {"AGENT_TRUSTED_PROXY_HOPS": "2"}):
+            self.assertEqual(self._client_id("6.6.6.6, 1.2.3.4, 10.0.0.2"), "1.2.3.4")
+
+    def test_uses_the_peer_without_trusted_proxies(self):
+        with mock.patch.dict("os.environ", {"AGENT_TRUSTED_PROXY_HOPS": "0"}):
+            self.assertEqual(self._client_id("6.6.6.6"), "10.0.0.1")
+        self.assertEqual(self._client_id(""), "10.0.0.1")
@@ -1,8 +1,21 @@
 from django.urls import path
-from .views import ChatView
+from django.conf import settings
+from .views import ChatView, ChatStreamView, ChatBatchView, AsyncChatView, AsyncChatStreamView, AsyncChatBatchView, batch_results, health_check, liveness, readiness
 from django.urls import re_path
 from django.views.decorators.http import require_http_methods
 
+# Serve the async views under ASGI so chat requests never park a worker thread
+if settings.SERVER_INTERFACE == 'asgi':
+    chat_view, chat_stream_view, chat_batch_view = AsyncChatView, AsyncChatStreamView, AsyncChatBatchView
+else:
+    chat_view, chat_stream_view, chat_batch_view = ChatView, ChatStreamView, ChatBatchView
+
 urlpatterns = [
-    re_path(r'^chat/$', require_http_methods(["POST"])(ChatView.as_view()), name='chat'),
+    re_path(r'^chat/$', require_http_methods(["POST"])(chat_view.as_view()), name='chat'),
+    re_path(r'^chat/stream/$', require_http_methods(["POST"])(chat_stream_view.as_view()), name='chat-stream'),
+    re_path(r'^chat/batch/$', require_http_methods(["POST"])(chat_batch_view.as_view()), name='chat-batch'),
+    re_path(r'^chat/batch/(?P<batch_id>[\w-]+)/$', batch_results, name='chat-batch-results'),
+    path('health/', health_check, name='health'),
+    path('health/live/', liveness, name='health-live'),
+    path('health/ready/', readiness, name='health-ready'),
 ] 
\ No newline at end of file
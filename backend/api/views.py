@@ -2,55 +2,216 @@ from django.shortcuts import render
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from typing import List, Dict
+from rest_framework.exceptions import ParseError
+from typing import List, Dict, Optional, Tuple
+import json
 import logging
-from agent.agent import Agent
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from agent.agent import get_agent
+from agent.admission import Overloaded, get_admission, retry_after_header
+from agent.metrics import render as render_metrics
+from agent.health import DATABASE, get_health_monitor
+from agent.message import Role
+from agent.pool import ConfigurationError
+from agent.batch import BatchAdmission, arun_batch, batch_parallelism, get_batch_backend, parse_jobs, run_batch, submit_offline
+from agent.retry import OVERLOADED, RATE_LIMITED, acall_with_retry, call_with_retry, classify_error, retry_after_seconds
+from agent.singleflight import get_single_flight, request_key
 from django.views.decorators.http import require_http_methods
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
-import time
 import os
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
 
 logger = logging.getLogger(__name__)
 
-@require_http_methods(["GET"])
+_ROLES = frozenset(role.value for role in Role)
+
+def _request_object(data) -> Dict:
+    """Return a request body, which must be a JSON object."""
+    if not isinstance(data, dict):
+        raise ValueError("Request body must be a JSON object")
+    return data
+
+def _parse_chat_request(data) -> Tuple[List[Dict[str, str]], str, Optional[int]]:
+    """Extract messages, thread ID and turn cursor from a chat request body.
+    
+    Raises:
+        ValueError: If the body or one of its fields is malformed.
+    """
+    data = _request_object(data)
+    messages = data.get("messages", [])
+    if not isinstance(messages, list) or not all(
+        isinstance(m, dict) and isinstance(m.get("role"), str) and m["role"] in _ROLES and isinstance(m.get("content"), str) for m in messages
+    ):
+        raise ValueError("messages must be a list of objects with a role (system, user or assistant) and string content")
+    thread_id = data.get("thread_id", "default")
+    if not isinstance(thread_id, str) or not thread_id:
+        raise ValueError("thread_id must be a non-empty string")
+    turn_cursor = data.get("turn_cursor")
+    # bool is an int subclass; reject true/false explicitly
+    if turn_cursor is not None and (isinstance(turn_cursor, bool) or not isinstance(turn_cursor, int) or turn_cursor < 0):
+        raise ValueError("turn_cursor must be a non-negative integer")
+    return messages, thread_id, turn_cursor
+
+def _request_language(request) -> Optional[str]:
+    """Return the primary subtag of the first ``Accept-Language`` entry, if any."""
+    header = request.META.get("HTTP_ACCEPT_LANGUAGE", "")
+    tag = header.split(",", 1)[0].split(";", 1)[0].strip()
+    if not tag or tag == "*":
+        return None
+    return tag.split("-", 1)[0].lower()
+
+def _client_id(request) -> str:
+    """Identify the caller for per-client limits.
+
+    Each of the ``AGENT_TRUSTED_PROXY_HOPS`` proxies in front of the app
+    appends the address it got the request from to ``X-Forwarded-For``, so
+    the entry that many places from the right is the first one the client
+    cannot forge. Without trusted proxies the peer address is used.
+    """
+    hops = int(os.getenv("AGENT_TRUSTED_PROXY_HOPS", "1"))
+    forwarded = [address.strip() for address in request.META.get("HTTP_X_FORWARDED_FOR", "").split(",") if address.strip()]
+    if hops > 0 and forwarded:
+        return forwarded[-min(hops, len(forwarded))]
+    return request.META.get("REMOTE_ADDR", "")
+
+def _admitted(thread_id: str, client_id: str, fn, *args):
+    """Run ``fn`` under an admission ticket.
+
+    Passed to single-flight as the call itself, so only the request that
+    starts a generation is admitted; identical requests wait on its result.
+    """
+    with get_admission().admit(thread_id, client_id):
+        return fn(*args)
+
+async def _aadmitted(thread_id: str, client_id: str, fn, *args):
+    """Async variant of ``_admitted``."""
+    async with get_admission().aadmit(thread_id, client_id):
+        return await fn(*args)
+
+def _sse(event: str, data: Dict) -> str:
+    """Format one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _ndjson(record: Dict) -> str:
+    """Format one newline-delimited JSON record."""
+    return json.dumps(record) + "\n"
+
+def _batch_mode(data) -> str:
+    """Return the batch mode of a request body: ``online`` (default) or ``offline``."""
+    mode = _request_object(data).get("mode", "online")
+    if mode not in ("online", "offline"):
+        raise ValueError("mode must be 'online' or 'offline'")
+    return mode
+
+def _with_cors(response):
+    """Add the CORS headers chat responses are served with."""
+    response["Access-Control-Allow-Origin"] = "*"
+    response["Access-Control-Allow-Methods"] = "POST, OPTIONS"
+    response["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+    response["Access-Control-Max-Age"] = "86400"
+    return response
+
+def _bad_request(e: Exception, response_class):
+    """Answer a body that failed request validation with a 400."""
+    logger.error(f"Validation error: {str(e)}")
+    return response_class({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+def _error_response(e: Exception, response_class):
+    """Map an exception from handling a validated chat request to an error response."""
+    if isinstance(e, Overloaded):
+        logger.warning(f"Request shed by admission control: {str(e)}")
+        response = response_class(
+            {
+                "error": "Server busy",
+                "detail": str(e)
+            },
+            status=status.HTTP_429_TOO_MANY_REQUESTS
+        )
+        response["Retry-After"] = retry_after_header(e.retry_after)
+        return response
+    if isinstance(e, ConfigurationError):
+        logger.error(f"Server is misconfigured: {str(e)}")
+        return response_class(
+            {
+                "error": "Internal server error",
+                "detail": "The server is not configured to handle chat requests."
+            },
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+    if isinstance(e, TimeoutError):
+        logger.error("Request timed out after all retries")
+        return response_class(
+            {
+                "error": "Request timed out",
+                "detail": "The request took too long to process. Please try again."
+            },
+            status=status.HTTP_504_GATEWAY_TIMEOUT
+        )
+    logger.error(f"Error processing chat request: {str(e)}")
+    if classify_error(e) in (OVERLOADED, RATE_LIMITED):
+        response = response_class(
+            {
+                "error": "Rate limit exceeded",
+                "detail": "The service is currently experiencing high demand. Please try again in a few moments."
+            },
+            status=status.HTTP_429_TOO_MANY_REQUESTS
+        )
+        response["Retry-After"] = str(int(retry_after_seconds(e) or 5))
+        return response
+    return response_class(
+        {
+            "error": "Internal server error",
+            "detail": str(e)
+        },
+        status=status.HTTP_500_INTERNAL_SERVER_ERROR
+    )
+
+@require_http_methods(["GET", "HEAD"])
 def health_check(request):
-    """Health check endpoint."""
-    try:
-        # Test database connection
-        from django.db import connection
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT 1")
-        
-        # Log successful health check
-        logger.info("Health check passed")
-        return JsonResponse({
-            "status": "ok",
-            "database": "connected",
-            "environment": os.getenv('ENVIRONMENT', 'production')
-        })
-    except Exception as e:
-        # Log the error
-        logger.error(f"Health check failed: {str(e)}")
+    """Health check endpoint, answered from the cached database check.
+
+    The model client is left to the readiness probe, so a missing API key
+    does not mark the service itself as down.
+    """
+    report = get_health_monitor().status([DATABASE])
+    database = report["checks"][DATABASE]
+    if not report["ready"]:
         return JsonResponse({
-            "status": "error",
-            "message": str(e)
-        }, status=500)
+            "status": "starting" if report["starting"] else "error",
+            "database": "connected" if database["ok"] else "error",
+            "checks": report["checks"],
+        }, status=503)
+    return JsonResponse({
+        "status": "ok",
+        "database": "connected",
+        "environment": os.getenv('ENVIRONMENT', 'production')
+    })
+
+@require_http_methods(["GET", "HEAD"])
+def liveness(request):
+    """Liveness probe: the worker is serving requests. Checks no dependencies."""
+    return JsonResponse({"status": "ok"})
+
+@require_http_methods(["GET", "HEAD"])
+def readiness(request):
+    """Readiness probe: cached database, model client and queue status; 503 when not ready."""
+    report = get_health_monitor().status()
+    state = "ok" if report["ready"] else "starting" if report["starting"] else "unavailable"
+    return JsonResponse(
+        {"status": state, "checks": report["checks"]},
+        status=200 if report["ready"] else 503,
+    )
+
+@require_http_methods(["GET"])
+def metrics(request):
+    """Prometheus metrics for the chat pipeline, aggregated across workers."""
+    payload, content_type = render_metrics()
+    return HttpResponse(payload, content_type=content_type)
 
 @method_decorator(csrf_exempt, name='dispatch')
 class ChatView(APIView):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        try:
-            self.agent = Agent()
-            logger.info("Agent initialized successfully")
-        except Exception as e:
-            logger.error(f"Failed to initialize agent: {str(e)}")
-            raise
-    
     def post(self, request):
         """Handle chat messages with the agent.
         
@@ -59,89 +220,263 @@ class ChatView(APIView):
             "messages": [
                 {"role": "user", "content": "What's the weather in San Francisco?"}
             ],
-            "thread_id": "optional-thread-id"
+            "thread_id": "optional-thread-id",
+            "turn_cursor": 0
         }
+        
+        ``turn_cursor`` is optional: send the cursor returned by the previous
+        response together with only the new messages, or omit it and send the
+        full history. Turns the thread has already ingested are skipped.
         """
+        # DRF raises ParseError for a body that is not valid JSON
         try:
-            messages = request.data.get("messages", [])
-            thread_id = request.data.get("thread_id", "default")
-            
-            logger.info(f"Received chat request - Thread ID: {thread_id}")
-            
-            if not messages:
-                logger.warning("No messages provided in request")
-                return Response(
-                    {"error": "No messages provided"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            
-            logger.debug(f"Processing messages: {messages}")
-            
-            # Run the agent.invoke in a thread pool with timeout
-            max_retries = 3
-            retry_delay = 2  # seconds
+            messages, thread_id, turn_cursor = _parse_chat_request(request.data)
+        except (ValueError, ParseError) as e:
+            return _bad_request(e, Response)
+        
+        logger.info(f"Received chat request - Thread ID: {thread_id}")
+        
+        if not messages:
+            logger.warning("No messages provided in request")
+            return Response(
+                {"error": "No messages provided"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            logger.debug(f"Processing {len(messages)} message(s)")
             
-            for attempt in range(max_retries):
-                try:
-                    with ThreadPoolExecutor() as executor:
-                        future = executor.submit(self.agent.invoke, messages, thread_id)
-                        # Set a timeout for the operation
-                        response = future.result(timeout=30)  # 30 second timeout
-                    
-                    logger.info("Successfully generated response")
-                    
-                    # Create response with CORS headers
-                    response_obj = Response(response)
-                    response_obj["Access-Control-Allow-Origin"] = "*"
-                    response_obj["Access-Control-Allow-Methods"] = "POST, OPTIONS"
-                    response_obj["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-                    response_obj["Access-Control-Max-Age"] = "86400"
-                    
-                    return response_obj
-                    
-                except TimeoutError:
-                    logger.warning(f"Request timed out (attempt {attempt + 1}/{max_retries})")
-                    if attempt < max_retries - 1:
-                        time.sleep(retry_delay)
-                        continue
-                    raise
-                except Exception as e:
-                    if "529" in str(e):  # Rate limit error
-                        logger.warning(f"Rate limit hit (attempt {attempt + 1}/{max_retries})")
-                        if attempt < max_retries - 1:
-                            time.sleep(retry_delay * (attempt + 1))  # Exponential backoff
-                            continue
-                    raise
+            # Run the agent on the shared executor with timeouts, backoff and a deadline;
+            # identical requests already in flight share that run's result
+            language = _request_language(request)
+            response = get_single_flight().do(
+                request_key(thread_id, messages, turn_cursor, language),
+                _admitted, thread_id, _client_id(request),
+                call_with_retry, get_agent().invoke, messages, thread_id, turn_cursor, language
+            )
+            logger.info("Successfully generated response")
+            return _with_cors(Response(response))
             
-        except ValueError as e:
-            logger.error(f"Validation error: {str(e)}")
+        except Exception as e:
+            return _error_response(e, Response)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ChatStreamView(APIView):
+    def post(self, request):
+        """Stream the agent's reply as Server-Sent Events.
+        
+        Takes the same request body as ``ChatView`` and emits ``token`` events
+        as text arrives, then one ``done`` event with the full reply and the
+        new ``turn_cursor``. A ``reset`` event tells the client to discard the
+        tokens received so far: they came from a round that ended in tool
+        calls, and the reply starts over. Failures after the stream started
+        are reported as an ``error`` event.
+        """
+        try:
+            messages, thread_id, turn_cursor = _parse_chat_request(request.data)
+        except (ValueError, ParseError) as e:
+            return _bad_request(e, Response)
+        
+        if not messages:
+            logger.warning("No messages provided in request")
             return Response(
-                {"error": str(e)},
+                {"error": "No messages provided"},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        except TimeoutError:
-            logger.error("Request timed out after all retries")
-            return Response(
-                {
-                    "error": "Request timed out",
-                    "detail": "The request took too long to process. Please try again."
-                },
-                status=status.HTTP_504_GATEWAY_TIMEOUT
+        
+        logger.info(f"Received streaming chat request - Thread ID: {thread_id}")
+        language = _request_language(request)
+        client_id = _client_id(request)
+        try:
+            stream = get_single_flight().stream(
+                request_key(thread_id, messages, turn_cursor, language),
+                get_agent().stream, messages, thread_id, turn_cursor, language,
+                admit=lambda: get_admission().admit(thread_id, client_id),
             )
         except Exception as e:
-            logger.error(f"Error processing chat request: {str(e)}")
-            if "529" in str(e):
-                return Response(
-                    {
-                        "error": "Rate limit exceeded",
-                        "detail": "The service is currently experiencing high demand. Please try again in a few moments."
-                    },
-                    status=status.HTTP_429_TOO_MANY_REQUESTS
-                )
-            return Response(
-                {
-                    "error": "Internal server error",
-                    "detail": str(e)
-                },
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            return _error_response(e, Response)
+        
+        def events():
+            try:
+                for event in stream:
+                    yield _sse(event.pop("type"), event)
+            except Exception as e:
+                logger.error(f"Error streaming chat response: {str(e)}")
+                yield _sse("error", {"error": "Internal server error", "detail": str(e)})
+        
+        response = StreamingHttpResponse(events(), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatView(View):
+    """Async counterpart of ``ChatView`` for ASGI deployments.
+
+    The LLM round-trip awaits ``Agent.ainvoke`` instead of parking a worker
+    thread, so one process can hold many in-flight requests.
+    """
+    
+    async def post(self, request):
+        """Handle chat messages with the agent. Same request format as ``ChatView``."""
+        try:
+            messages, thread_id, turn_cursor = _parse_chat_request(json.loads(request.body or b"{}"))
+        except ValueError as e:
+            return _bad_request(e, JsonResponse)
+        
+        logger.info(f"Received chat request - Thread ID: {thread_id}")
+        
+        if not messages:
+            logger.warning("No messages provided in request")
+            return JsonResponse({"error": "No messages provided"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            language = _request_language(request)
+            response = await get_single_flight().ado(
+                request_key(thread_id, messages, turn_cursor, language),
+                _aadmitted, thread_id, _client_id(request),
+                acall_with_retry, get_agent().ainvoke, messages, thread_id, turn_cursor, language
+            )
+            logger.info("Successfully generated response")
+            return _with_cors(JsonResponse(response))
+        
+        except Exception as e:
+            return _error_response(e, JsonResponse)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatStreamView(View):
+    """Async counterpart of ``ChatStreamView`` built on ``Agent.astream``."""
+    
+    async def post(self, request):
+        """Stream the agent's reply as Server-Sent Events."""
+        try:
+            messages, thread_id, turn_cursor = _parse_chat_request(json.loads(request.body or b"{}"))
+        except ValueError as e:
+            return _bad_request(e, JsonResponse)
+        
+        if not messages:
+            logger.warning("No messages provided in request")
+            return JsonResponse({"error": "No messages provided"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        logger.info(f"Received streaming chat request - Thread ID: {thread_id}")
+        language = _request_language(request)
+        client_id = _client_id(request)
+        try:
+            stream = await get_single_flight().astream(
+                request_key(thread_id, messages, turn_cursor, language),
+                get_agent().astream, messages, thread_id, turn_cursor, language,
+                admit=lambda: get_admission().aadmit(thread_id, client_id),
             )
+        except Exception as e:
+            return _error_response(e, JsonResponse)
+        
+        async def events():
+            try:
+                async for event in stream:
+                    yield _sse(event.pop("type"), event)
+            except Exception as e:
+                logger.error(f"Error streaming chat response: {str(e)}")
+                yield _sse("error", {"error": "Internal server error", "detail": str(e)})
+        
+        response = StreamingHttpResponse(events(), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ChatBatchView(APIView):
+    def post(self, request):
+        """Run many chat jobs in one request.
+        
+        Expected request format:
+        {
+            "jobs": [
+                {"thread_id": "eval-1", "messages": [{"role": "user", "content": "Hi"}]},
+                {"thread_id": "eval-2", "messages": [...], "turn_cursor": 4}
+            ],
+            "parallelism": 8,
+            "mode": "online"
+        }
+        
+        In ``online`` mode jobs run concurrently (jobs for the same thread in
+        order) and each result is streamed back as one NDJSON line when it
+        finishes. In ``offline`` mode the jobs are submitted as a Message
+        Batch and the response holds its ``batch_id``; results are read from
+        ``/api/chat/batch/<batch_id>/``. Offline jobs do not update thread state.
+        
+        Online jobs are admitted one by one like chat requests. The request
+        gets a 429 if its first job cannot be admitted; a later job that is
+        shed is reported with ``"status": "shed"`` and its ``retry_after``.
+        """
+        try:
+            mode = _batch_mode(request.data)
+            jobs = parse_jobs(request.data, int(os.getenv("AGENT_BATCH_MAX_JOBS", "1000")))
+            parallelism = batch_parallelism(request.data) if mode == "online" else None
+        except (ValueError, ParseError) as e:
+            return _bad_request(e, Response)
+        
+        try:
+            agent = get_agent()
+            if mode == "offline":
+                batch_id = submit_offline(agent, jobs)
+                return _with_cors(Response({"batch_id": batch_id, "status": "submitted"}, status=status.HTTP_202_ACCEPTED))
+            admission = BatchAdmission.acquire(jobs, _client_id(request))
+        except Exception as e:
+            return _error_response(e, Response)
+        
+        logger.info(f"Received batch chat request with {len(jobs)} job(s), parallelism {parallelism}")
+        records = (_ndjson(record) for record in run_batch(agent, jobs, parallelism, admission))
+        return _with_cors(StreamingHttpResponse(records, content_type="application/x-ndjson"))
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatBatchView(View):
+    """Async counterpart of ``ChatBatchView`` built on ``Agent.ainvoke``."""
+    
+    async def post(self, request):
+        """Run many chat jobs in one request. Same request format as ``ChatBatchView``."""
+        try:
+            data = json.loads(request.body or b"{}")
+            mode = _batch_mode(data)
+            jobs = parse_jobs(data, int(os.getenv("AGENT_BATCH_MAX_JOBS", "1000")))
+            parallelism = batch_parallelism(data) if mode == "online" else None
+        except ValueError as e:
+            return _bad_request(e, JsonResponse)
+        
+        try:
+            agent = get_agent()
+            if mode == "offline":
+                batch_id = await sync_to_async(submit_offline)(agent, jobs)
+                return _with_cors(JsonResponse({"batch_id": batch_id, "status": "submitted"}, status=status.HTTP_202_ACCEPTED))
+            admission = await BatchAdmission.aacquire(jobs, _client_id(request))
+        except Exception as e:
+            return _error_response(e, JsonResponse)
+        
+        logger.info(f"Received batch chat request with {len(jobs)} job(s), parallelism {parallelism}")
+        
+        async def records():
+            async for record in arun_batch(agent, jobs, parallelism, admission):
+                yield _ndjson(record)
+        
+        return _with_cors(StreamingHttpResponse(records(), content_type="application/x-ndjson"))
+
+
+@require_http_methods(["GET"])
+def batch_results(request, batch_id):
+    """Return the status of an offline batch, or its results as NDJSON once it has ended."""
+    try:
+        backend = get_batch_backend()
+        batch = backend.status(batch_id)
+        if batch["status"] != "ended":
+            return JsonResponse(batch)
+        body = "".join(_ndjson(record) for record in backend.results(batch_id))
+        return HttpResponse(body, content_type="application/x-ndjson")
+    except KeyError:
+        return JsonResponse({"error": "Batch not found"}, status=status.HTTP_404_NOT_FOUND)
+    except Exception as e:
+        logger.error(f"Failed to read batch {batch_id}: {str(e)}")
+        return JsonResponse({"error": "Internal server error", "detail": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -23,13 +23,11 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 # Initialize Django
 django.setup()
 
-from django.core.wsgi import get_wsgi_application
-from django.core.asgi import get_asgi_application
-
-# WSGI application
-wsgi_app = get_wsgi_application()
-# ASGI application
-asgi_app = get_asgi_application()
-
-# For compatibility with both WSGI and ASGI
-app = wsgi_app 
\ No newline at end of file
+# Build only the interface selected by SERVER_INTERFACE (ASGI by default)
+from django.conf import settings
+if settings.SERVER_INTERFACE == 'asgi':
+    from django.core.asgi import get_asgi_application
+    app = get_asgi_application()
+else:
+    from django.core.wsgi import get_wsgi_application
+    app = get_wsgi_application()
@@ -0,0 +1,124 @@
+"""
+Logging pipeline used by ``settings.LOGGING``.
+
+Records are sampled and redacted on the calling thread, then handed to a
+queue; a listener thread formats and writes them, so request threads never
+block on log I/O.
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# API keys, bearer tokens and e-mail addresses never reach the logs
+REDACT_PATTERNS = (
+    re.compile(r"sk-[A-Za-z0-9_-]{8,}"),
+    re.compile(r"(?i)bearer\s+[A-Za-z0-9._~+/=-]+"),
+    re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"),
+)
+
+
+class RedactingFilter(logging.Filter):
+    """Truncates log messages to ``max_length`` characters and masks secrets."""
+
+    def __init__(self, max_length: int = 500):
+        super().__init__()
+        self.max_length = max_length
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        extra = len(message) - self.max_length if self.max_length else 0
+        if extra > 0:
+            # Keep some slack so a secret cut at the limit is still matched
+            message = message[:self.max_length + 64]
+        for pattern in REDACT_PATTERNS:
+            message = pattern.sub("[redacted]", message)
+        if extra > 0:
+            message = f"{message[:self.max_length]}... [{extra} more chars]"
+        record.msg = message
+        record.args = None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a ``rate`` fraction of records at or below ``max_level``; louder records always pass."""
+
+    def __init__(self, rate: float = 1.0, max_level: str = "INFO"):
+        super().__init__()
+        self.rate = rate
+        self.max_level = logging.getLevelName(max_level)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > self.max_level or self.rate >= 1.0 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log aggregation."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class QueueingStreamHandler(QueueHandler):
+    """Queue handler that writes to a stream from its own listener thread.
+
+    The formatter configured on this handler is applied by the listener.
+    The listener is restarted in forked children (gunicorn preloads the app
+    in the master, and threads do not survive a fork).
+    """
+
+    def __init__(self, stream=None, maxsize: int = 10000):
+        self._maxsize = maxsize
+        self.target = logging.StreamHandler(stream or sys.stderr)
+        super().__init__(queue.Queue(maxsize))
+        self._listener = None
+        self._pid = None
+        self._start()
+        atexit.register(self._stop)
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self) -> None:
+        self.queue = queue.Queue(self._maxsize)
+        self._listener = QueueListener(self.queue, self.target, respect_handler_level=False)
+        self._listener.start()
+        self._pid = os.getpid()
+
+    def _stop(self) -> None:
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+
+    def setFormatter(self, fmt: logging.Formatter) -> None:
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve the message and traceback here; formatting happens in the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Drop rather than block the request when the writer falls behind
+            pass
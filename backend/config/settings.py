@@ -36,6 +36,9 @@ ENVIRONMENT = os.getenv('ENVIRONMENT', 'production')
 ALLOWED_HOSTS = os.getenv('ALLOWED_HOSTS', 'localhost,127.0.0.1,.onrender.com,yoko.vdmnexus.com,yokodev.vdmnexus.com,.vdmnexus.com').split(',')
 
 # Logging Configuration
+# Records are sampled, truncated and redacted, then written off-thread (see config/log.py)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -44,11 +47,25 @@ LOGGING = {
             'format': '{levelname} {asctime} {module} {process:d} {thread:d} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'config.log.JsonFormatter',
+        },
+    },
+    'filters': {
+        'sample': {
+            '()': 'config.log.SamplingFilter',
+            'rate': float(os.getenv('LOG_SAMPLE_RATE', '1.0')),  # Share of DEBUG/INFO records kept
+        },
+        'redact': {
+            '()': 'config.log.RedactingFilter',
+            'max_length': int(os.getenv('LOG_MAX_MESSAGE_LENGTH', '500')),
+        },
     },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
-            'formatter': 'verbose',
+            'class': 'config.log.QueueingStreamHandler',
+            'formatter': os.getenv('LOG_FORMAT', 'verbose'),
+            'filters': ['sample', 'redact'],
         },
     },
     'root': {
@@ -67,14 +84,10 @@ LOGGING = {
             'propagate': False,
         },
         'api': {
-            'handlers': ['console'],
-            'level': 'DEBUG',
-            'propagate': True,
+            'level': LOG_LEVEL,
         },
         'agent': {
-            'handlers': ['console'],
-            'level': 'DEBUG',
-            'propagate': True,
+            'level': LOG_LEVEL,
         },
     },
 }
@@ -128,6 +141,9 @@ TEMPLATES = [
 WSGI_APPLICATION = 'config.wsgi.application'
 ASGI_APPLICATION = 'config.asgi.application'
 
+# Interface served by app.py / gunicorn: 'asgi' (async views, uvicorn workers) or 'wsgi'
+SERVER_INTERFACE = os.getenv('SERVER_INTERFACE', 'asgi').lower()
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -140,6 +156,29 @@ DATABASES = {
     )
 }
 
+# Store flushes of several workers write at the same time; on SQLite, take the
+# write lock up front so they wait for each other instead of failing
+if DATABASES['default'].get('ENGINE') == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('OPTIONS', {})['transaction_mode'] = 'IMMEDIATE'
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Shared by every worker when REDIS_URL is set (requires the redis package)
+
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -6,10 +6,11 @@ The `urlpatterns` list routes URLs to views. For more information please see:
 """
 from django.contrib import admin
 from django.urls import path, include
-from api.views import health_check
+from api.views import health_check, metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
+    path('metrics', metrics, name='metrics'),
     path('', health_check, name='health_check'),  # Root URL shows health check
 ]
@@ -1,9 +1,15 @@
 import multiprocessing
+import os
+import shutil
+import tempfile
 
 # Number of workers = (2 x CPU cores) + 1
 workers = multiprocessing.cpu_count() * 2 + 1
-# Use sync worker for WSGI
-worker_class = 'sync'
+# Use uvicorn workers for ASGI (default), sync workers for WSGI
+if os.getenv('SERVER_INTERFACE', 'asgi').lower() == 'asgi':
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    worker_class = 'sync'
 # Maximum number of requests a worker will process before restarting
 max_requests = 1000
 # Maximum number of requests a worker will process before restarting
@@ -17,4 +23,43 @@ backlog = 2048
 # Maximum number of clients a single process can handle
 worker_connections = 1000
 # Preload the application
-preload_app = True 
\ No newline at end of file
+preload_app = True
+
+# Workers write Prometheus metrics here so /metrics can aggregate all of them;
+# set before the app (and prometheus_client) is imported
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'yokoai-metrics'))
+
+
+def on_starting(server):
+    """Start every run with an empty metrics directory."""
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def when_ready(server):
+    """Import the URLconf and model integration in the master, before workers fork.
+
+    With ``preload_app`` every worker then starts with these modules already
+    loaded instead of importing them on its first request.
+    """
+    if not server.cfg.preload_app:
+        return
+    from django.urls import get_resolver
+    from agent.pool import preload
+    get_resolver().url_patterns
+    preload()
+
+
+def post_fork(server, worker):
+    """Build the per-worker LLM clients and start the health prober right after the fork."""
+    from agent.health import get_health_monitor
+    from agent.pool import warm_up
+    warm_up()
+    get_health_monitor().start()
+
+
+def child_exit(server, worker):
+    """Drop the live-gauge files of a worker that exited."""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)